@@ -1,13 +1,16 @@
 # admin.py
 from django.contrib import admin
-from django.utils.html import format_html
-from .models import Conversation, APIKey, SystemPrompt, Config
-import json
+from django.utils.html import format_html, format_html_join
+from django.utils.safestring import mark_safe
+from .models import Conversation, Message, MessageArchive, OutboxMessage, APIKey, SystemPrompt, Config
+from .clients import GEMINI_API_KEY, mask_key
+from .router import router
+from .answer_cache import answer_cache
 
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
-    # Fields to display in the list view
-    list_display = ('sender_id', 'created_at', 'message_count', 'history_preview')
+    # Fields to display in the list view, all stored on the conversation row
+    list_display = ('sender_id', 'created_at', 'message_count', 'last_message_at', 'preview')
     
     # Fields to filter by
     list_filter = ('created_at',)
@@ -19,84 +22,129 @@ class ConversationAdmin(admin.ModelAdmin):
     ordering = ('-created_at',)
     
     # Fields to display in the detail view
-    fields = ('sender_id', 'formatted_conversation', 'history', 'created_at')
+    fields = ('sender_id', 'message_count', 'last_message_at', 'formatted_conversation', 'created_at')
     
     # Make created_at read-only since it's auto-generated
-    readonly_fields = ('created_at', 'formatted_conversation')
-    
-    def message_count(self, obj):
-        """Display the number of messages in the conversation history"""
-        try:
-            history = json.loads(obj.get_history())
-            return len(history) if isinstance(history, list) else 0
-        except (json.JSONDecodeError, TypeError):
-            return 0
-    message_count.short_description = 'Messages'
-    
-    def history_preview(self, obj):
-        """Display a preview of the conversation history"""
-        try:
-            history = json.loads(obj.get_history())
-            if isinstance(history, list) and history:
-                # Get the first message content as preview
-                first_message = history[0]
-                if isinstance(first_message, dict) and 'content' in first_message:
-                    role = first_message.get('role', 'unknown')
-                    content = first_message.get('content', '')
-                    preview = f"{role}: {content}"
-                    return (preview[:60] + '...') if len(preview) > 60 else preview
-                else:
-                    # Fallback for other formats
-                    first_message = str(first_message)
-                    return (first_message[:50] + '...') if len(first_message) > 50 else first_message
-            return "Empty"
-        except (json.JSONDecodeError, TypeError):
-            return "Invalid JSON"
-    history_preview.short_description = 'Conversation Preview'
+    readonly_fields = ('created_at', 'message_count', 'last_message_at', 'formatted_conversation')
+
+    # Messages shown per page of the detail view
+    messages_per_page = 50
     
     # Custom actions
     actions = ['clear_history']
     
     def clear_history(self, request, queryset):
         """Custom action to clear conversation history"""
-        updated = queryset.update(history="[]")
-        self.message_user(request, f'{updated} conversation(s) history cleared.')
+        pks = list(queryset.values_list('pk', flat=True))
+        Message.objects.filter(conversation__in=pks).delete()
+        MessageArchive.objects.filter(conversation__in=pks).delete()
+        # Outbox rows are keyed by message seq, which starts over after clearing
+        OutboxMessage.objects.filter(conversation__in=pks).delete()
+        Conversation.objects.filter(pk__in=pks).update(
+            message_count=0, last_message_at=None, preview='', archived_seq=0, archived_count=0,
+            summary='', summary_seq=0,
+        )
+        self.message_user(request, f'{len(pks)} conversation(s) history cleared.')
     clear_history.short_description = "Clear selected conversations history"
+
+    def get_object(self, request, object_id, from_field=None):
+        obj = super().get_object(request, object_id, from_field)
+        if obj is not None:
+            # formatted_conversation only gets the object, so the requested page travels on it
+            obj.admin_page = request.GET.get('page')
+        return obj
     
     def formatted_conversation(self, obj):
-        """Display the full conversation in a table format"""
-        try:
-            history = json.loads(obj.get_history())
-            if isinstance(history, list) and history:
-                table_rows = []
-                for i, message in enumerate(history, 1):
-                    if isinstance(message, dict) and 'role' in message and 'content' in message:
-                        role = message['role'].upper()
-                        content = message['content']
-                        table_rows.append(f"<tr><td>{i}</td><td>{role}</td><td>{content}</td></tr>")
-                    else:
-                        table_rows.append(f"<tr><td>{i}</td><td>UNKNOWN</td><td>{str(message)}</td></tr>")
-                
-                table_html = f"""
-                <table border="1" cellpadding="5" cellspacing="0">
-                    <thead>
-                        <tr>
-                            <th>#</th>
-                            <th>Role</th>
-                            <th>Message</th>
-                        </tr>
-                    </thead>
-                    <tbody>
-                        {''.join(table_rows)}
-                    </tbody>
-                </table>
-                """
-                return format_html(table_html)
+        """Display one page of the conversation in a table format, the latest page by default"""
+        if obj.pk is None or not obj.message_count:
             return "No messages"
-        except (json.JSONDecodeError, TypeError):
-            return "Invalid JSON format"
+        pages = max(1, -(-obj.message_count // self.messages_per_page))
+        try:
+            page = min(max(1, int(getattr(obj, 'admin_page', None) or pages)), pages)
+        except ValueError:
+            page = pages
+        offset = (page - 1) * self.messages_per_page
+        # Archived messages are decompressed only for the pages that show them
+        messages = obj.get_message_page(offset, self.messages_per_page)
+
+        # format_html escapes the message contents
+        rows = format_html_join(
+            '\n', '<tr><td>{}</td><td>{}</td><td style="white-space: pre-wrap">{}</td></tr>',
+            ((m['seq'], m['role'].upper(), m['content']) for m in messages),
+        )
+        links = format_html_join(' ', '{}', (
+            (format_html('<b>{}</b>', number) if number == page else format_html('<a href="?page={}">{}</a>', number, number),)
+            for number in range(1, pages + 1)
+        ))
+        archived = format_html(', {} archived', obj.archived_count) if obj.archived_count else ''
+        return format_html(
+            '<p>Page {} of {}{}: {}</p>'
+            '<table border="1" cellpadding="5" cellspacing="0">'
+            '<thead><tr><th>#</th><th>Role</th><th>Message</th></tr></thead>'
+            '<tbody>{}</tbody></table>',
+            page, pages, archived, links, rows,
+        )
     formatted_conversation.short_description = 'Conversation Table'
     
-admin.site.register(APIKey)
+@admin.register(APIKey)
+class APIKeyAdmin(admin.ModelAdmin):
+    list_display = ('name', 'masked_key', 'health', 'updated_at')
+    actions = ['reset_cooldowns']
+
+    def masked_key(self, obj):
+        return mask_key(obj.api_key)
+    masked_key.short_description = 'API Key'
+
+    def health(self, obj):
+        """Router state of each model on this key, as seen by this worker process"""
+        rows = router.state(obj.api_key)
+        if not rows:
+            return "No requests yet"
+        return format_html_join(
+            mark_safe('<br>'),
+            '{}: {}',
+            ((row['model'], format_router_state(row)) for row in rows),
+        )
+    health.short_description = 'Health'
+
+    def changelist_view(self, request, extra_context=None):
+        # The .env key has no row, so report it above the list
+        if GEMINI_API_KEY:
+            rows = router.state(GEMINI_API_KEY)
+            if rows:
+                summary = "; ".join(f"{row['model']}: {format_router_state(row)}" for row in rows)
+                self.message_user(request, f"GEMINI_API_KEY (.env) - {summary}")
+        return super().changelist_view(request, extra_context)
+
+    def reset_cooldowns(self, request, queryset):
+        """Custom action to put the selected keys back into rotation"""
+        for key in queryset:
+            router.reset(key.api_key)
+        self.message_user(request, f'{queryset.count()} key(s) cooldown reset.')
+    reset_cooldowns.short_description = "Reset cooldowns of selected keys"
+
+
+def format_router_state(row: dict) -> str:
+    status = f"cooling down {row['cooldown']:.0f}s" if row['cooldown'] else "ok"
+    latency = f", {row['latency']:.1f}s avg" if row['latency'] is not None else ""
+    errors = f", {row['rate_limited']}x429, {row['server_errors']}x5xx" if row['failures'] else ""
+    return f"{status} ({row['successes']} ok / {row['failures']} failed{errors}{latency})"
+
+
 admin.site.register(SystemPrompt)
-admin.site.register(Config)
\ No newline at end of file
+
+
+@admin.register(Config)
+class ConfigAdmin(admin.ModelAdmin):
+
+    def changelist_view(self, request, extra_context=None):
+        # Saving any config clears the answer cache, so its stats live above the list
+        stats = answer_cache.stats()
+        if answer_cache.enabled() or stats['hits'] + stats['misses']:
+            self.message_user(
+                request,
+                f"Answer cache (this worker): {stats['hits']} hits / {stats['misses']} misses "
+                f"({stats['hit_rate']:.0%}), {stats['skips']} skipped, "
+                f"{stats['size']}/{stats['max_entries']} entries, {stats['evictions']} evicted",
+            )
+        return super().changelist_view(request, extra_context)
\ No newline at end of file
@@ -0,0 +1,149 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from .config import config_cache
+from . import metrics
+
+# --- Environment Variables ---
+# Gemini work done at once by this process: replies, each of which may use several requests
+# (fallbacks, hedges), media descriptions and summaries
+GEMINI_MAX_IN_FLIGHT = int(os.getenv("GEMINI_MAX_IN_FLIGHT", "32"))
+# Callers allowed to wait for a slot, and for how long, before they are shed
+GEMINI_MAX_WAITING = int(os.getenv("GEMINI_MAX_WAITING", "64"))
+GEMINI_QUEUE_TIMEOUT = float(os.getenv("GEMINI_QUEUE_TIMEOUT", "30"))
+# Senders whose token bucket is remembered
+SENDER_BUCKETS = int(os.getenv("SENDER_BUCKETS", "10000"))
+
+DEFAULT_OVERLOAD_MESSAGE = (
+    "Thanks for your message! We're getting a lot of messages right now and will get back to you shortly."
+)
+ASYNC_POLL_INTERVAL = 0.05
+
+throttled = metrics.registry.register(metrics.Counter(
+    "mbot_admission_throttled", "Batches answered with the overload message because their sender exceeded the per-sender rate.",
+))
+shed = metrics.registry.register(metrics.Counter(
+    "mbot_admission_shed", "Gemini calls refused because too many were in flight.", ("reason",),
+))
+
+
+class SenderRateLimiter:
+    """
+    A token bucket per sender: sender_rate_per_minute replies refill over a minute,
+    up to sender_burst at once. A rate of 0 turns the limit off.
+    """
+
+    def __init__(self, max_senders: int = SENDER_BUCKETS):
+        self.max_senders = max_senders
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, sender_id: str) -> bool:
+        rate = config_cache.get_float("sender_rate_per_minute", 20.0) / 60
+        if rate <= 0:
+            return True
+        burst = max(1.0, config_cache.get_float("sender_burst", 10.0))
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(sender_id, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[sender_id] = (tokens, now)
+            while len(self._buckets) > self.max_senders:
+                # A forgotten sender starts over with a full bucket
+                self._buckets.popitem(last=False)
+        if not allowed:
+            throttled.inc()
+        return allowed
+
+
+class ConcurrencyLimiter:
+    """
+    Caps Gemini calls in flight at once. Callers beyond the cap wait, but only
+    max_waiting of them and only for `timeout` seconds; the rest are refused so
+    the caller can shed the request instead of piling up.
+    """
+
+    def __init__(self, max_in_flight: int = GEMINI_MAX_IN_FLIGHT, max_waiting: int = GEMINI_MAX_WAITING,
+                 timeout: float = GEMINI_QUEUE_TIMEOUT):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def _try_acquire(self) -> bool:
+        if self.in_flight < self.max_in_flight:
+            self.in_flight += 1
+            return True
+        return False
+
+    def _start_waiting(self) -> bool:
+        if self.waiting >= self.max_waiting:
+            shed.inc(reason="queue_full")
+            return False
+        self.waiting += 1
+        return True
+
+    def acquire(self) -> bool:
+        with self._condition:
+            if self._try_acquire():
+                return True
+            if not self._start_waiting():
+                return False
+            try:
+                acquired = self._condition.wait_for(self._try_acquire, self.timeout)
+            finally:
+                self.waiting -= 1
+        if not acquired:
+            shed.inc(reason="timeout")
+        return acquired
+
+    async def async_acquire(self) -> bool:
+        """Async version of acquire; polls instead of blocking the event loop."""
+        with self._condition:
+            if self._try_acquire():
+                return True
+            if not self._start_waiting():
+                return False
+        deadline = time.monotonic() + self.timeout
+        try:
+            while time.monotonic() < deadline:
+                await asyncio.sleep(ASYNC_POLL_INTERVAL)
+                with self._condition:
+                    if self._try_acquire():
+                        return True
+        finally:
+            with self._condition:
+                self.waiting -= 1
+        shed.inc(reason="timeout")
+        return False
+
+    def release(self):
+        with self._condition:
+            self.in_flight = max(0, self.in_flight - 1)
+            self._condition.notify()
+
+    def stats(self) -> dict:
+        with self._condition:
+            return {
+                "in_flight": self.in_flight,
+                "max_in_flight": self.max_in_flight,
+                "waiting": self.waiting,
+                "max_waiting": self.max_waiting,
+            }
+
+
+sender_limiter = SenderRateLimiter()
+gemini_limiter = ConcurrencyLimiter()
+
+
+def overload_reply() -> list:
+    """The canned reply sent when a reply is shed."""
+    return [{"text": config_cache.get("overload_message", DEFAULT_OVERLOAD_MESSAGE) or DEFAULT_OVERLOAD_MESSAGE}]
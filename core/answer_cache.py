@@ -0,0 +1,133 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+from .config import config_cache
+from .sys_prompt import get_prompt_with_version
+
+logger = logging.getLogger(__name__)
+
+# --- Environment Variables ---
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "1000"))
+
+
+def normalize(text: str) -> str:
+    """
+    Folds case, width and punctuation so "Price?" and "price" share an entry.
+    Only punctuation and symbols are dropped: Bengali vowel signs are combining
+    marks, so stripping every non-word character would mangle the words.
+    """
+    text = unicodedata.normalize("NFKC", text).casefold()
+    text = "".join(" " if unicodedata.category(char)[0] in "PS" else char for char in text)
+    return " ".join(text.split())
+
+
+class AnswerCache:
+    """
+    Replies to repeated questions, keyed by the normalized last user message, the
+    system prompt version, the config values and the few messages before it.
+    Entries expire after answer_cache_ttl seconds; the least recently used are
+    evicted past ANSWER_CACHE_MAX_ENTRIES. Kept per process.
+    """
+
+    def __init__(self, max_entries: int = ANSWER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.skips = 0
+        self.evictions = 0
+
+    def enabled(self) -> bool:
+        return config_cache.get_bool("answer_cache", False)
+
+    def _skipped(self, text: str) -> bool:
+        """Matches the answer_cache_skip config: one regular expression per line."""
+        for pattern in (config_cache.get("answer_cache_skip", "") or "").splitlines():
+            pattern = pattern.strip()
+            if not pattern:
+                continue
+            try:
+                if re.search(pattern, text, re.IGNORECASE):
+                    return True
+            except re.error:
+                logger.warning(f"Invalid answer_cache_skip pattern: {pattern}")
+        return False
+
+    def key(self, context: list) -> str | None:
+        """Cache key for a reply to `context`, or None if it must not be cached."""
+        if not context or context[-1]["role"] != "user":
+            return None
+        question = normalize(context[-1]["content"])
+        if not question or self._skipped(context[-1]["content"]) or self._skipped(question):
+            with self._lock:
+                self.skips += 1
+            return None
+
+        size = max(0, config_cache.get_int("answer_cache_context", 1))
+        previous = [
+            (message["role"], normalize(message["content"]))
+            for message in (context[-1 - size:-1] if size else [])
+            if message["role"] != "summary"
+        ]
+        _, prompt_version = get_prompt_with_version()
+        raw = json.dumps([prompt_version, config_cache.version(), previous, question], ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str) -> list | None:
+        ttl = config_cache.get_int("answer_cache_ttl", 3600)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and now - entry[0] < ttl:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def put(self, key: str, reply: list):
+        if not reply:
+            return
+        with self._lock:
+            self._entries[key] = (time.monotonic(), reply)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "skips": self.skips,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+answer_cache = AnswerCache()
+
+
+def cached_reply_key(context: list) -> str | None:
+    """The answer cache key for this context, or None when the cache is off or skips it."""
+    if not answer_cache.enabled():
+        return None
+    return answer_cache.key(context)
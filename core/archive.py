@@ -0,0 +1,60 @@
+import logging
+import os
+import threading
+
+from .config import config_cache
+from .models import Conversation
+from .worker import get_task_queue
+
+logger = logging.getLogger(__name__)
+
+# --- Environment Variables ---
+# Messages kept as plain Message rows per conversation; older ones are archived
+HISTORY_HOT_MESSAGES = int(os.getenv("HISTORY_HOT_MESSAGES", "200"))
+# Archive once a conversation is this many messages past the cap, so chunks are not tiny
+HISTORY_ARCHIVE_BATCH = int(os.getenv("HISTORY_ARCHIVE_BATCH", "100"))
+
+
+def min_hot_messages() -> int:
+    """The most messages load_history can ask for, which must never come from the archive."""
+    if config_cache.get_int('context_tokens', 0):
+        return config_cache.get_int('context_max_messages', 100)
+    return config_cache.get_int('remember', 20)
+
+
+def archive_conversation(conversation: Conversation, keep: int = HISTORY_HOT_MESSAGES) -> int:
+    """
+    Archives the conversation's messages beyond the hot window. With the token budget
+    on, only messages already folded into the summary are archived, since the summary
+    job reads the ones after summary_seq.
+    """
+    keep = max(keep, min_hot_messages())
+    upto_seq = conversation.summary_seq if config_cache.get_int('context_tokens', 0) else None
+    return conversation.archive_messages(keep, upto_seq)
+
+
+_scheduled = set()
+_scheduled_lock = threading.Lock()
+
+def maybe_schedule_archive(conversation: Conversation):
+    """Queues archival in the background once the hot window is a batch past its cap."""
+    if conversation.message_count - conversation.archived_count <= HISTORY_HOT_MESSAGES + HISTORY_ARCHIVE_BATCH:
+        return
+    with _scheduled_lock:
+        if conversation.pk in _scheduled:
+            return
+        _scheduled.add(conversation.pk)
+    if not get_task_queue().submit(_archive_in_background, conversation.pk):
+        with _scheduled_lock:
+            _scheduled.discard(conversation.pk)
+
+
+def _archive_in_background(conversation_id: int):
+    try:
+        conversation = Conversation.objects.get(pk=conversation_id)
+        archived = archive_conversation(conversation)
+        if archived:
+            logger.info(f"Archived {archived} messages of conversation {conversation_id}")
+    finally:
+        with _scheduled_lock:
+            _scheduled.discard(conversation_id)
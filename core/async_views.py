@@ -0,0 +1,354 @@
+import asyncio
+import json
+import logging
+import time
+
+import httpx
+from asgiref.sync import sync_to_async
+
+from django.http import HttpResponse, JsonResponse, HttpResponseForbidden
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+
+from .models import Conversation
+from . import views
+from .views import (
+    add_user_message_to_history,
+    add_postback_to_history,
+    add_model_message_to_history,
+    build_generate_config,
+    describe_events,
+    event_correlation_id,
+    get_api_keys,
+    parse_reply,
+    record_attempt,
+    save_reply,
+    verify_signature,
+    webhook_view,
+)
+from .clients import get_client, mask_key
+from .admission import gemini_limiter, overload_reply, sender_limiter
+from .answer_cache import answer_cache, cached_reply_key
+from .config import config_cache
+from .contents import to_contents
+from .context import load_history, build_context
+from .coalesce import AsyncSenderCoalescer
+from .dedup import get_dedup_store
+from .events import REPLY_TYPES, classify_event, split_events
+from . import log, metrics
+from .outbox import async_deliver
+from .hedge import async_hedged_reply, get_hedge_delay
+from .router import router
+from .stream import JSONArrayStreamParser
+from .session import get_async_client
+from .worker import queue_enabled
+
+logger = logging.getLogger(__name__)
+
+# --- Facebook Messenger API Helpers ---
+
+async def async_send_api_request(payload: dict) -> bool:
+    """Async version of views.send_api_request."""
+    params = {"access_token": views.PAGE_TOKEN}
+    try:
+        r = await get_async_client().post(views.SEND_API_URL, params=params, json=payload)
+        r.raise_for_status()
+        response_data = r.json()
+        if "error" in response_data:
+            logger.error(f"FB Send API Error: {response_data['error']}")
+            return False
+        return True
+    except (httpx.HTTPError, ValueError) as e:
+        logger.error(f"Failed to send FB API request: {e}")
+        return False
+
+async def async_send_message(recipient_id: str, message: dict):
+    """Sends a message object (text, attachment, quick replies) via Facebook."""
+    payload = {"recipient": {"id": recipient_id}, "message": message, "messaging_type": "RESPONSE"}
+    with metrics.span("send_message"):
+        return await async_send_api_request(payload)
+
+async def async_send_action(recipient_id: str, action: str):
+    """Sends sender actions like 'typing_on' or 'mark_seen'."""
+    payload = {"recipient": {"id": recipient_id}, "sender_action": action}
+    with metrics.span("send_action"):
+        return await async_send_api_request(payload)
+
+
+# --- AI Core Logic ---
+
+async def async_process_reply(history: list, model: str, api_key: str) -> list:
+    """Async version of views.process_reply using the client.aio surface."""
+    start = time.monotonic()
+    router.begin(api_key, model)
+    try:
+        client = get_client(api_key)
+        # May create or refresh the Gemini context cache, keep that off the thread the ORM calls share
+        config = await sync_to_async(build_generate_config, thread_sensitive=False)(history, model, api_key)
+        response = await client.aio.models.generate_content(
+            model=model,
+            contents=to_contents(history),
+            config=config,
+        )
+        metrics.record_usage(model, response.usage_metadata)
+        reply = parse_reply(response.text)
+
+    except asyncio.CancelledError:
+        # Lost a hedge race, the pair did nothing wrong
+        router.record_cancelled(api_key, model)
+        record_attempt(model, api_key, start, "cancelled")
+        raise
+    except Exception as e:
+        logger.error(f"AI generation error from {model} using {mask_key(api_key)}: {e}")
+        router.record_failure(api_key, model, e)
+        record_attempt(model, api_key, start, "error")
+        return []
+
+    if reply:
+        router.record_success(api_key, model, time.monotonic() - start)
+    else:
+        router.record_failure(api_key, model)
+    record_attempt(model, api_key, start, "success" if reply else "invalid")
+    return reply
+
+async def async_ai_reply(history: list) -> list:
+    """Async version of views.ai_reply, trying pairs in the router's order."""
+    api_keys = await sync_to_async(get_api_keys)()
+    candidates = router.candidates(api_keys)
+    delay = await sync_to_async(get_hedge_delay)(candidates)
+    if delay is not None:
+        max_hedges = await sync_to_async(config_cache.get_int)("hedge_max", 1)
+        return await async_hedged_reply(history, candidates, async_process_reply, delay, max_hedges)
+
+    for attempt, (key, model) in enumerate(candidates):
+        if attempt:
+            metrics.gemini_fallbacks.inc()
+        response = await async_process_reply(history, model, key)
+        if response:
+            return response
+        logger.error(f"Failed to get response from {model} using {mask_key(key)}")
+
+    logger.error("[FAIL] No valid response from any model/key")
+    return []
+
+async def async_process_reply_stream(history: list, model: str, api_key: str):
+    """Async version of views.process_reply_stream."""
+    start = time.monotonic()
+    router.begin(api_key, model)
+    parts = 0
+    usage_metadata = None
+    try:
+        client = get_client(api_key)
+        config = await sync_to_async(build_generate_config, thread_sensitive=False)(history, model, api_key)
+        parser = JSONArrayStreamParser()
+        async for chunk in await client.aio.models.generate_content_stream(
+            model=model,
+            contents=to_contents(history),
+            config=config,
+        ):
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            for res_part in parser.feed(chunk.text or ""):
+                parts += 1
+                yield res_part
+        parser.close()
+
+    except (GeneratorExit, asyncio.CancelledError):
+        router.record_cancelled(api_key, model)
+        record_attempt(model, api_key, start, "cancelled")
+        raise
+    except Exception as e:
+        logger.error(f"AI streaming error from {model} using {mask_key(api_key)}: {e}")
+        if isinstance(e, ValueError):
+            metrics.json_decode_failures.inc()
+        router.record_failure(api_key, model, e)
+        record_attempt(model, api_key, start, "error")
+        return
+    finally:
+        metrics.record_usage(model, usage_metadata)
+
+    if parts:
+        router.record_success(api_key, model, time.monotonic() - start)
+    else:
+        router.record_failure(api_key, model)
+    record_attempt(model, api_key, start, "success" if parts else "invalid")
+
+async def async_stream_ai_reply(history: list):
+    """Async version of views.stream_ai_reply."""
+    api_keys = await sync_to_async(get_api_keys)()
+    for attempt, (key, model) in enumerate(router.candidates(api_keys)):
+        if attempt:
+            metrics.gemini_fallbacks.inc()
+        parts = 0
+        async for res_part in async_process_reply_stream(history, model, key):
+            parts += 1
+            yield res_part
+        if parts:
+            return
+        logger.error(f"Failed to get response from {model} using {mask_key(key)}")
+
+    logger.error("[FAIL] No valid response from any model/key")
+
+
+# --- Main Webhook Logic ---
+
+async def async_get_or_create_conversation(sender_id: str):
+    conversation, _ = await Conversation.objects.aget_or_create(sender_id=sender_id)
+    return conversation
+
+coalescer = AsyncSenderCoalescer()
+
+async def async_process_events(sender_id: str, events: list):
+    """Async version of views.process_events."""
+    accepted = []
+    for event in events:
+        event_type = classify_event(event)
+        if event_type not in REPLY_TYPES:
+            logger.info(f"Ignoring {event_type} event.")
+            continue
+
+        mid = event["message"].get("mid") if event_type == "message" else None
+        if mid and await sync_to_async(get_dedup_store().is_duplicate)(mid):
+            logger.info(f"Ignoring duplicate mid {mid}")
+            metrics.dedup_hits.inc()
+            continue
+
+        accepted.append(event)
+
+    if not accepted:
+        return False
+
+    window = await sync_to_async(config_cache.get_float)('coalesce_window', 0.0)
+    result = await coalescer.submit(sender_id, accepted, window, async_process_batch)
+    return True if result is None else result
+
+async def async_process_batch(sender_id: str, events: list):
+    """Async version of views.process_batch."""
+    throttled = not await sync_to_async(sender_limiter.allow)(sender_id)
+
+    with metrics.span("conversation_load"):
+        conversation = await async_get_or_create_conversation(sender_id)
+        history, first_seq = await sync_to_async(load_history)(conversation)
+    stored_count = len(history)
+
+    user_input_received = False
+
+    await async_send_action(sender_id, "mark_seen")
+
+    # Workers may add events to a batch out of order, Facebook's timestamp is authoritative
+    for event in sorted(events, key=lambda e: e.get("timestamp", 0)):
+        if "message" in event:
+            # Attachments are described by a blocking Gemini call, keep it off the event loop
+            updated_history = await sync_to_async(add_user_message_to_history, thread_sensitive=False)(
+                history, event["message"], describe=not throttled,
+            )
+            if updated_history:
+                history = updated_history
+                user_input_received = True
+
+        elif "postback" in event:
+            history = add_postback_to_history(history, event["postback"])
+            user_input_received = True
+
+    if not user_input_received:
+        return False
+
+    await async_send_action(sender_id, "typing_on")
+
+    context = await sync_to_async(build_context)(conversation, history, first_seq, stored_count)
+
+    cache_key = await sync_to_async(cached_reply_key)(context)
+    model_responses = answer_cache.get(cache_key) if cache_key else None
+    if model_responses is None and throttled:
+        logger.warning(f"Throttled {sender_id}, sending the overload message")
+        model_responses = await sync_to_async(overload_reply)()
+    if model_responses is None:
+        if not await gemini_limiter.async_acquire():
+            logger.warning(f"Overloaded, sending {sender_id} the overload message")
+            model_responses = await sync_to_async(overload_reply)()
+        else:
+            try:
+                if await sync_to_async(config_cache.get_bool)('stream_replies', False):
+                    await async_send_streamed_reply(sender_id, conversation, history, stored_count, context)
+                    return True
+
+                model_responses = await async_ai_reply(context)
+            finally:
+                gemini_limiter.release()
+            if cache_key:
+                answer_cache.put(cache_key, model_responses)
+
+    await async_send_action(sender_id, "typing_off")
+
+    final_history = add_model_message_to_history(history, model_responses)
+    await sync_to_async(save_reply)(conversation, final_history[stored_count:], model_responses)
+    # Parts must arrive in order, so they are sent one after another
+    if not await async_deliver(conversation, async_send_message):
+        logger.error(f"Failed to send the reply to {sender_id}, retrying in the background")
+
+    return True
+
+async def async_send_streamed_reply(sender_id: str, conversation, history: list, stored_count: int, context: list):
+    """Async version of views.send_streamed_reply."""
+    unsaved = history[stored_count:]
+    delivered = True
+    replies = async_stream_ai_reply(context)
+    try:
+        async for res_part in replies:
+            await sync_to_async(save_reply)(conversation, unsaved + add_model_message_to_history([], [res_part]), [res_part])
+            unsaved = []
+            if delivered and not await async_deliver(conversation, async_send_message):
+                logger.error(f"Failed to send the reply to {sender_id}, retrying in the background")
+                delivered = False
+    finally:
+        # Close the Gemini stream now rather than whenever the generator is collected
+        await replies.aclose()
+
+    if unsaved:
+        await sync_to_async(save_reply)(conversation, unsaved, [])
+
+    await async_send_action(sender_id, "typing_off")
+
+async def async_handle_events(events: list):
+    """Processes one sender's events, logging instead of raising on failure."""
+    sender_id = events[0].get("sender", {}).get("id")
+    if not sender_id:
+        return
+    with log.correlation(event_correlation_id(events)):
+        try:
+            await async_process_events(sender_id, events)
+        except Exception as e:
+            logger.error(f"Error processing {describe_events(events)}. Exception: {e}", exc_info=True)
+
+# Strong references to fire-and-forget tasks so they are not garbage collected
+_background_tasks = set()
+
+@require_http_methods(["GET", "POST"])
+@csrf_exempt
+async def async_webhook_view(request):
+    """Async webhook endpoint for Facebook Messenger, served under ASGI."""
+    if request.method == "GET":
+        # Verification handshake has no I/O, reuse the sync view
+        return webhook_view(request)
+
+    if not verify_signature(request):
+        logger.warning("Invalid signature in webhook request.")
+        return HttpResponseForbidden("Invalid signature")
+
+    try:
+        data = json.loads(request.body.decode("utf-8"))
+    except json.JSONDecodeError:
+        logger.error("Invalid JSON received in webhook request body.")
+        return HttpResponse("Invalid JSON", status=400)
+
+    # Different senders run concurrently, a sender's own events stay in order
+    events_by_sender = split_events(data)
+
+    if queue_enabled():
+        for events in events_by_sender.values():
+            task = asyncio.create_task(async_handle_events(events))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+    else:
+        await asyncio.gather(*(async_handle_events(events) for events in events_by_sender.values()))
+
+    return JsonResponse({"status": "ok"})
@@ -0,0 +1,55 @@
+import logging
+import os
+import threading
+
+from google import genai
+
+logger = logging.getLogger(__name__)
+
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+
+# --- Gemini Client Registry ---
+# genai.Client sets up auth and its own HTTP connection pool, so one warm client is
+# kept per API key and shared by every thread (and by client.aio on the async path).
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(api_key: str | None = None) -> genai.Client:
+    """
+    Returns the cached client for api_key, creating it on first use.
+    api_key=None gives the default client, configured from the environment.
+    """
+    client = _clients.get(api_key)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(api_key)
+            if client is None:
+                client = genai.Client(api_key=api_key) if api_key else genai.Client()
+                _clients[api_key] = client
+    return client
+
+def evict_client(api_key: str | None):
+    """Drops the cached client for api_key, e.g. after the key was changed or deleted."""
+    with _clients_lock:
+        if _clients.pop(api_key, None) is not None:
+            logger.info(f"Evicted Gemini client for key {mask_key(api_key)}")
+
+def prewarm_clients() -> int:
+    """Creates clients for the .env key and every APIKey row. Returns the number of clients."""
+    from .models import APIKey
+
+    keys = [GEMINI_API_KEY] if GEMINI_API_KEY else []
+    keys += [key.get_api_key() for key in APIKey.objects.all()]
+    for key in keys:
+        try:
+            get_client(key)
+        except Exception as e:
+            logger.error(f"Failed to create Gemini client for key {mask_key(key)}: {e}")
+    logger.info(f"Pre-warmed {len(_clients)} Gemini clients")
+    return len(_clients)
+
+def mask_key(api_key: str | None) -> str:
+    if not api_key:
+        return "default"
+    return f"{api_key[:4]}...{api_key[-4:]}"
@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+
+class SenderCoalescer:
+    """
+    Collects a sender's consecutive events into one batch and runs batches for the
+    same sender one at a time.
+
+    The first event of a batch makes its caller the batch leader: it waits out the
+    window, then takes the sender lock and hands every event collected so far to the
+    handler. Callers whose events join an open batch return immediately. Events that
+    arrive while a batch is being processed start the next batch, which keeps
+    collecting until the current one has finished.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._sender_locks = {}
+
+    @contextmanager
+    def sender_lock(self, sender_id: str):
+        with self._lock:
+            entry = self._sender_locks.setdefault(sender_id, [threading.Lock(), 0])
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._sender_locks[sender_id]
+
+    def submit(self, sender_id: str, events: list, window: float, handler):
+        """Adds events to the sender's open batch. Returns handler's result if this caller led the batch."""
+        with self._lock:
+            batch = self._pending.get(sender_id)
+            if batch is not None:
+                batch.extend(events)
+                return None
+            self._pending[sender_id] = list(events)
+
+        if window > 0:
+            time.sleep(window)
+        with self.sender_lock(sender_id):
+            with self._lock:
+                events = self._pending.pop(sender_id)
+            return handler(sender_id, events)
+
+
+class AsyncSenderCoalescer:
+    """SenderCoalescer for the async path, run on a single event loop."""
+
+    def __init__(self):
+        self._pending = {}
+        self._sender_locks = {}
+
+    @asynccontextmanager
+    async def sender_lock(self, sender_id: str):
+        entry = self._sender_locks.setdefault(sender_id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._sender_locks[sender_id]
+
+    async def submit(self, sender_id: str, events: list, window: float, handler):
+        batch = self._pending.get(sender_id)
+        if batch is not None:
+            batch.extend(events)
+            return None
+        self._pending[sender_id] = list(events)
+
+        if window > 0:
+            await asyncio.sleep(window)
+        async with self.sender_lock(sender_id):
+            events = self._pending.pop(sender_id)
+            return await handler(sender_id, events)
@@ -0,0 +1,98 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Other processes only see a Config change once their copy expires
+CONFIG_CACHE_TTL = float(os.getenv("CONFIG_CACHE_TTL", "30"))
+
+_MISSING = object()
+
+
+class ConfigCache:
+    """
+    In-memory copy of every Config row, loaded in one query.
+    Values are parsed once per load; saves and deletes in this process
+    invalidate it through signals, other processes pick changes up after the TTL.
+    """
+
+    def __init__(self, ttl: float = CONFIG_CACHE_TTL):
+        self.ttl = ttl
+        self._values = None
+        self._parsed = {}
+        self._version = ""
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self._values = None
+            self._parsed = {}
+
+    def _get_values(self) -> dict:
+        values = self._values
+        if values is None or time.monotonic() - self._loaded_at > self.ttl:
+            from .models import Config
+
+            with self._lock:
+                values = {
+                    name: value.strip() if value is not None else None
+                    for name, value in Config.objects.values_list("name", "value")
+                }
+                self._values = values
+                self._version = hashlib.sha256(json.dumps(sorted(values.items())).encode()).hexdigest()[:16]
+                self._parsed = {}
+                self._loaded_at = time.monotonic()
+        return values
+
+    def _get_parsed(self, name: str, parser, default):
+        values = self._get_values()
+        key = (name, parser)
+        parsed = self._parsed.get(key, _MISSING)
+        if parsed is _MISSING:
+            raw = values.get(name)
+            if raw is None:
+                logger.warning(f"{name} config not found. Using default value.")
+                parsed = default
+            else:
+                try:
+                    parsed = parser(raw)
+                except (ValueError, TypeError):
+                    logger.warning(f"Invalid value for {name} config. Using default value.")
+                    parsed = default
+            self._parsed[key] = parsed
+        return parsed
+
+    def version(self) -> str:
+        """Hash of every config value, changing whenever a reload finds different values."""
+        self._get_values()
+        return self._version
+
+    def get(self, name: str, default=None):
+        """Returns the stripped string value of a config, or default."""
+        return self._get_parsed(name, str, default)
+
+    def get_int(self, name: str, default: int | None = None) -> int | None:
+        return self._get_parsed(name, int, default)
+
+    def get_float(self, name: str, default: float | None = None) -> float | None:
+        return self._get_parsed(name, float, default)
+
+    def get_bool(self, name: str, default: bool = False) -> bool:
+        return self._get_parsed(name, parse_bool, default)
+
+
+def parse_bool(value: str) -> bool:
+    lowered = value.lower()
+    if lowered in ("1", "true", "yes", "on"):
+        return True
+    if lowered in ("0", "false", "no", "off", ""):
+        return False
+    raise ValueError(value)
+
+
+config_cache = ConfigCache()
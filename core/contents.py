@@ -0,0 +1,26 @@
+from google.genai import types
+
+# Stored roles -> Gemini roles
+ROLES = {"user": "user", "assistant": "model", "summary": "user"}
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def to_contents(history: list) -> list[types.Content]:
+    """
+    Converts role/content dicts into Gemini turns. Consecutive messages of the same
+    role become parts of one turn, and a message's text is never rewritten, so the
+    turns sent for a conversation only grow at the end: the prefix already sent is
+    byte-identical on the next request and can be served from Gemini's implicit cache.
+    """
+    contents = []
+    for message in history:
+        role = ROLES.get(message["role"], "user")
+        text = message["content"]
+        if message["role"] == "summary":
+            text = SUMMARY_PREFIX + text
+        part = types.Part(text=text)
+        if contents and contents[-1].role == role and message["role"] != "summary":
+            contents[-1].parts.append(part)
+        else:
+            contents.append(types.Content(role=role, parts=[part]))
+    return contents
@@ -0,0 +1,169 @@
+import logging
+import threading
+
+from google.genai import types
+
+from .admission import gemini_limiter
+from .clients import get_client
+from .config import config_cache
+from . import metrics
+from .models import Conversation
+from .worker import get_task_queue
+
+logger = logging.getLogger(__name__)
+
+SUMMARY_MODEL = "gemini-2.5-flash"
+SUMMARY_PROMPT = (
+    "You maintain a short running summary of a customer conversation with a shop's assistant. "
+    "Update the summary with the new messages. Keep names, products, prices, orders, "
+    "addresses and anything the customer asked for or was promised. "
+    "Answer with the summary only, in at most 150 words.\n\n"
+    "Current summary:\n{summary}\n\nNew messages:\n{transcript}"
+)
+# Most messages folded into the summary by one background run
+SUMMARY_MAX_MESSAGES = 200
+# Fixed cost of a message's role and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Fast local token estimate: about 4 ASCII characters per token, while non-Latin
+    scripts such as Bengali tokenize to roughly one token per 2 characters.
+    """
+    ascii_chars = sum(1 for char in text if char.isascii())
+    return ascii_chars // 4 + (len(text) - ascii_chars) // 2 + 1
+
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+
+
+def aligned_start(first_seq: int, start: int, step: int, round_up: bool) -> int:
+    """
+    Moves the window's first message onto a seq just after a multiple of `step`.
+    The window start then stays put for `step` messages instead of sliding every
+    turn, which keeps the beginning of the request (its cacheable prefix) unchanged.
+    """
+    if step <= 1:
+        return start
+    seq = first_seq + start
+    boundary = -(-(seq - 1) // step) if round_up else (seq - 1) // step
+    return max(0, boundary * step + 1 - first_seq)
+
+
+def load_history(conversation: Conversation) -> tuple[list, int | None]:
+    """
+    Loads the stored messages a reply may use, with one indexed LIMIT query.
+    Returns them as role/content dicts together with the seq of the first one.
+    """
+    if config_cache.get_int('context_tokens', 0):
+        limit = config_cache.get_int('context_max_messages', 100)
+    else:
+        limit = config_cache.get_int('remember', 20)
+    rows = conversation.get_messages(limit=limit, with_seq=True)
+    history = [{"role": row["role"], "content": row["content"]} for row in rows]
+    return history, rows[0]["seq"] if rows else None
+
+
+def build_context(conversation: Conversation, history: list, first_seq: int | None, stored_count: int) -> list:
+    """
+    Picks the messages sent to Gemini. With the context_tokens config set, the newest
+    messages are added until the token budget is full, behind the conversation's
+    summary; older turns are folded into the summary in the background.
+    Without it, at most the last `remember` messages are sent.
+    Either way the window is trimmed context_trim_step messages at a time.
+    """
+    budget = config_cache.get_int('context_tokens', 0)
+    step = config_cache.get_int('context_trim_step', 10)
+    if not budget:
+        start = max(0, len(history) - config_cache.get_int('remember', 20))
+        if first_seq is not None:
+            # Rounding up keeps the window within `remember`, the new user turns are still kept
+            start = min(aligned_start(first_seq, start, step, round_up=True), stored_count)
+        return history[start:]
+
+    summary = None
+    used = 0
+    if conversation.summary:
+        summary = {"role": "summary", "content": conversation.summary}
+        used = message_tokens(summary)
+
+    # The new user turns are always sent, even if they alone exceed the budget
+    start = len(history)
+    while start > 0:
+        cost = message_tokens(history[start - 1])
+        if used + cost > budget and start <= stored_count:
+            break
+        used += cost
+        start -= 1
+
+    if first_seq is not None:
+        # Trimming further keeps within the budget; the new user turns are still kept
+        if start < stored_count:
+            start = min(aligned_start(first_seq, start, step, round_up=True), stored_count)
+        # Stored messages are numbered consecutively, so history[i] has seq first_seq + i
+        dropped_upto = first_seq + min(start, stored_count) - 1
+        if dropped_upto - conversation.summary_seq >= config_cache.get_int('summary_batch', 10):
+            schedule_summary(conversation.pk, dropped_upto)
+
+    window = history[start:]
+    return [summary] + window if summary else window
+
+
+_scheduled = set()
+_scheduled_lock = threading.Lock()
+
+def schedule_summary(conversation_id: int, upto_seq: int):
+    """Queues a background summary update, at most one per conversation at a time."""
+    with _scheduled_lock:
+        if conversation_id in _scheduled:
+            return
+        _scheduled.add(conversation_id)
+    if not get_task_queue().submit(update_summary, conversation_id, upto_seq):
+        logger.warning(f"Task queue full, skipping summary of conversation {conversation_id}")
+        with _scheduled_lock:
+            _scheduled.discard(conversation_id)
+
+
+def update_summary(conversation_id: int, upto_seq: int):
+    """Folds the messages after summary_seq, up to upto_seq, into the conversation's summary."""
+    try:
+        conversation = Conversation.objects.get(pk=conversation_id)
+        if conversation.summary_seq >= upto_seq:
+            return
+        messages = list(
+            conversation.messages.filter(seq__gt=conversation.summary_seq, seq__lte=upto_seq)
+            .order_by('seq').values('seq', 'role', 'content')[:SUMMARY_MAX_MESSAGES]
+        )
+        if not messages:
+            return
+
+        transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+        # Summaries count against the same in-flight cap as replies; a skipped one is scheduled again later
+        if not gemini_limiter.acquire():
+            logger.warning(f"Too many Gemini calls in flight, skipping summary of conversation {conversation_id}")
+            return
+        try:
+            response = get_client().models.generate_content(
+                model=SUMMARY_MODEL,
+                contents=SUMMARY_PROMPT.format(summary=conversation.summary or "(none)", transcript=transcript),
+                config=types.GenerateContentConfig(thinking_config=types.ThinkingConfig(thinking_budget=0)),
+            )
+        finally:
+            gemini_limiter.release()
+        metrics.record_usage(SUMMARY_MODEL, response.usage_metadata)
+        summary = (response.text or "").strip()
+        if not summary:
+            logger.error(f"Empty summary for conversation {conversation_id}")
+            return
+
+        # Only apply it if no other run moved the summary on in the meantime
+        updated = Conversation.objects.filter(pk=conversation_id, summary_seq=conversation.summary_seq).update(
+            summary=summary, summary_seq=messages[-1]['seq'],
+        )
+        if updated:
+            logger.info(f"Summarized conversation {conversation_id} up to message {messages[-1]['seq']}")
+    finally:
+        with _scheduled_lock:
+            _scheduled.discard(conversation_id)
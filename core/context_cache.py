@@ -0,0 +1,104 @@
+import logging
+import threading
+import time
+
+from google.genai import types
+
+from .clients import get_client, mask_key
+from .config import config_cache
+
+logger = logging.getLogger(__name__)
+
+# How long to stop retrying after Gemini refuses to cache the prompt (e.g. it is
+# shorter than the model's minimum cacheable size)
+FAILURE_BACKOFF = 600
+
+
+class PromptContextCache:
+    """
+    Registers the system prompt as Gemini cached content, one entry per
+    (api key, model, prompt version), and extends its TTL before it expires.
+    Requests then reference the cache by name instead of resending the prompt.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._failures = {}
+        # Keys whose cache is being created or refreshed by some request right now
+        self._busy = set()
+        self._lock = threading.Lock()
+
+    def enabled(self) -> bool:
+        return config_cache.get_bool("gemini_context_cache", False)
+
+    def get_cached_content(self, api_key: str | None, model: str, prompt: str, version: str) -> str | None:
+        """Returns the cached content name for this prompt, or None to send it inline."""
+        ttl = config_cache.get_int("gemini_context_cache_ttl", 3600)
+        # Refresh once less than a tenth of the TTL is left, so requests never race the expiry
+        refresh_margin = max(60, ttl // 10)
+        key = (api_key, model)
+        now = time.monotonic()
+
+        if self._failures.get((api_key, model, version), 0) > now:
+            return None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            current = entry if entry and entry["version"] == version else None
+            if current and current["expires_at"] - now > refresh_margin:
+                return current["name"]
+            if key in self._busy:
+                # Another request is talking to Gemini for this key, don't wait for its round-trip
+                return current["name"] if current and current["expires_at"] > now else None
+            self._busy.add(key)
+
+        # The network calls run outside the lock, so other replies are never held up by them
+        try:
+            if current and self._refresh(api_key, current, ttl):
+                return current["name"]
+
+            try:
+                cached = get_client(api_key).caches.create(
+                    model=model,
+                    config=types.CreateCachedContentConfig(
+                        display_name=f"mbot-system-prompt-{version}",
+                        system_instruction=prompt,
+                        ttl=f"{ttl}s",
+                    ),
+                )
+            except Exception as e:
+                logger.warning(f"Context caching unavailable for {model} using {mask_key(api_key)}: {e}")
+                self._failures[(api_key, model, version)] = now + FAILURE_BACKOFF
+                return None
+
+            with self._lock:
+                self._entries[key] = {"name": cached.name, "version": version, "expires_at": now + ttl}
+            if entry:
+                # The prompt changed, stop paying storage for the old version
+                self._delete(api_key, entry["name"])
+            logger.info(f"Cached system prompt {version} for {model} as {cached.name}")
+            return cached.name
+        finally:
+            with self._lock:
+                self._busy.discard(key)
+
+    def _refresh(self, api_key: str | None, entry: dict, ttl: int) -> bool:
+        try:
+            get_client(api_key).caches.update(
+                name=entry["name"],
+                config=types.UpdateCachedContentConfig(ttl=f"{ttl}s"),
+            )
+        except Exception as e:
+            logger.warning(f"Failed to refresh cached content {entry['name']}: {e}")
+            return False
+        entry["expires_at"] = time.monotonic() + ttl
+        return True
+
+    def _delete(self, api_key: str | None, name: str):
+        try:
+            get_client(api_key).caches.delete(name=name)
+        except Exception as e:
+            logger.warning(f"Failed to delete cached content {name}: {e}")
+
+
+prompt_context_cache = PromptContextCache()
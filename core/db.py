@@ -0,0 +1,38 @@
+import functools
+import logging
+import os
+import random
+import time
+
+from django.db import OperationalError, connection
+
+logger = logging.getLogger(__name__)
+
+# --- Environment Variables ---
+# Extra attempts for a write that still finds SQLite locked after its busy timeout
+DB_LOCK_RETRIES = int(os.getenv("DB_LOCK_RETRIES", "3"))
+DB_LOCK_BACKOFF = float(os.getenv("DB_LOCK_BACKOFF", "0.05"))
+
+
+def is_lock_error(error: Exception) -> bool:
+    return isinstance(error, OperationalError) and "locked" in str(error)
+
+
+def retry_on_lock(func):
+    """
+    Retries a write with jittered exponential backoff when SQLite reports the
+    database as locked. Inside an outer transaction the error is raised as is,
+    since only the whole transaction can be retried.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        for attempt in range(DB_LOCK_RETRIES + 1):
+            try:
+                return func(*args, **kwargs)
+            except OperationalError as e:
+                if not is_lock_error(e) or attempt == DB_LOCK_RETRIES or connection.in_atomic_block:
+                    raise
+                delay = DB_LOCK_BACKOFF * 2 ** attempt * (1 + random.random())
+                logger.warning(f"Database locked in {func.__name__}, retrying in {delay:.2f}s")
+                time.sleep(delay)
+    return wrapper
@@ -0,0 +1,163 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from .db import retry_on_lock
+
+logger = logging.getLogger(__name__)
+
+# --- Environment Variables ---
+# "db" shares seen message IDs between every worker through the ProcessedMessage
+# table, "redis" through DEDUP_REDIS_URL, "memory" keeps them per process only.
+DEDUP_BACKEND = os.getenv("DEDUP_BACKEND", "db")
+DEDUP_TTL = int(os.getenv("DEDUP_TTL", "86400"))
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "10000"))
+DEDUP_REDIS_URL = os.getenv("DEDUP_REDIS_URL", "redis://localhost:6379/0")
+
+# --- Shared Backends ---
+# claim(mid, ttl) records the mid and returns True only for the first caller.
+
+class MemoryBackend:
+    """No shared state: the store's local LRU is the only record."""
+
+    def claim(self, mid: str, ttl: int) -> bool:
+        return True
+
+
+class DatabaseBackend:
+    """Claims message IDs through the unique index on ProcessedMessage.mid."""
+
+    PURGE_INTERVAL = 600
+
+    def __init__(self):
+        self._last_purge = 0.0
+
+    @retry_on_lock
+    def claim(self, mid: str, ttl: int) -> bool:
+        from .models import ProcessedMessage
+
+        now = timezone.now()
+        self._maybe_purge()
+        try:
+            with transaction.atomic():
+                ProcessedMessage.objects.create(mid=mid, expires_at=now + timedelta(seconds=ttl))
+            return True
+        except IntegrityError:
+            # Take over an expired row, otherwise another worker already has it
+            return bool(
+                ProcessedMessage.objects.filter(mid=mid, expires_at__lte=now)
+                .update(expires_at=now + timedelta(seconds=ttl))
+            )
+
+    def _maybe_purge(self):
+        from .models import ProcessedMessage
+
+        if time.monotonic() - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = time.monotonic()
+        deleted, _ = ProcessedMessage.objects.filter(expires_at__lte=timezone.now()).delete()
+        if deleted:
+            logger.info(f"Purged {deleted} expired message IDs")
+
+
+class RedisBackend:
+    """
+    Claims message IDs with SET NX EX. Any client exposing redis-py's
+    set(name, value, nx=, ex=) works, so tests can pass an in-memory stand-in.
+    """
+
+    def __init__(self, client=None, prefix: str = "mbot:mid:"):
+        if client is None:
+            import redis
+
+            client = redis.Redis.from_url(DEDUP_REDIS_URL)
+        self.client = client
+        self.prefix = prefix
+
+    def claim(self, mid: str, ttl: int) -> bool:
+        return bool(self.client.set(f"{self.prefix}{mid}", 1, nx=True, ex=ttl))
+
+
+BACKENDS = {
+    "memory": MemoryBackend,
+    "db": DatabaseBackend,
+    "redis": RedisBackend,
+}
+
+# --- Dedup Store ---
+
+class DedupStore:
+    """
+    Remembers processed message IDs in a bounded local LRU (with TTL) in front of
+    a shared backend, so redeliveries are caught even when another worker got them first.
+    """
+
+    def __init__(self, backend, ttl: int = DEDUP_TTL, max_entries: int = DEDUP_MAX_ENTRIES):
+        self.backend = backend
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def is_duplicate(self, mid: str) -> bool:
+        """Records mid and returns True if it was already processed."""
+        now = time.monotonic()
+        with self._lock:
+            expires_at = self._seen.get(mid)
+            if expires_at is not None and expires_at > now:
+                self._seen.move_to_end(mid)
+                self.hits += 1
+                return True
+
+        try:
+            claimed = self.backend.claim(mid, self.ttl)
+        except Exception as e:
+            # Answering twice is better than not answering at all
+            logger.error(f"Dedup backend failed, relying on local state: {e}")
+            self.errors += 1
+            claimed = True
+
+        with self._lock:
+            self._seen[mid] = now + self.ttl
+            self._seen.move_to_end(mid)
+            while len(self._seen) > self.max_entries:
+                self._seen.popitem(last=False)
+                self.evictions += 1
+            if claimed:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return not claimed
+
+    def stats(self) -> dict:
+        return {
+            "backend": type(self.backend).__name__,
+            "size": len(self._seen),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "errors": self.errors,
+        }
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_dedup_store() -> DedupStore:
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = DedupStore(BACKENDS[DEDUP_BACKEND]())
+    return _store
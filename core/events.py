@@ -0,0 +1,49 @@
+from . import metrics
+
+# --- Webhook Event Types ---
+# Events that carry user input and get a reply; every other type is dropped in the webhook
+REPLY_TYPES = frozenset({"message", "postback"})
+# Messenger's other event fields, checked in this order; anything else counts as "other"
+NOTIFICATION_TYPES = ("delivery", "read", "reaction", "referral", "optin", "account_linking", "policy_enforcement")
+
+webhook_events = metrics.registry.register(metrics.Counter(
+    "mbot_webhook_events", "Webhook messaging events by type, before any processing.", ("type",),
+))
+
+
+def classify_event(event: dict) -> str:
+    """
+    Names an event's type from its fields alone, without I/O. Echoes of the page's
+    own messages and messages with neither text nor attachments are their own types,
+    so only "message" and "postback" carry user input.
+    """
+    if not event.get("sender", {}).get("id"):
+        return "no_sender"
+    if "message" in event:
+        msg = event["message"]
+        if msg.get("is_echo"):
+            return "echo"
+        if msg.get("text") or msg.get("attachments"):
+            return "message"
+        return "empty_message"
+    if "postback" in event:
+        return "postback"
+    for event_type in NOTIFICATION_TYPES:
+        if event_type in event:
+            return event_type
+    return "other"
+
+
+def split_events(data: dict) -> dict:
+    """
+    Classifies and counts a webhook payload's messaging events, and groups the ones
+    to reply to by sender, keeping their order.
+    """
+    events_by_sender = {}
+    for entry in data.get("entry", []):
+        for event in entry.get("messaging", []):
+            event_type = classify_event(event)
+            webhook_events.inc(type=event_type)
+            if event_type in REPLY_TYPES:
+                events_by_sender.setdefault(event["sender"]["id"], []).append(event)
+    return events_by_sender
@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from django.db import close_old_connections
+
+from .clients import mask_key
+from .config import config_cache
+from . import metrics
+from .router import router
+
+logger = logging.getLogger(__name__)
+
+HEDGE_WORKERS = int(os.getenv("HEDGE_WORKERS", "16"))
+# Used with hedge_after=p95 until the primary pair has enough latency samples
+DEFAULT_HEDGE_AFTER = 8.0
+
+
+class HedgeStats:
+    """How often hedges fire, how often they win, and how many requests they waste."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.replies = 0
+        self.hedged_replies = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.wasted = 0
+
+    def record(self, hedges: int, hedge_won: bool, wasted: int):
+        with self._lock:
+            self.replies += 1
+            self.hedges += hedges
+            self.hedged_replies += 1 if hedges else 0
+            self.hedge_wins += 1 if hedge_won else 0
+            # Losing requests still run (and are billed) on Gemini's side
+            self.wasted += wasted
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "replies": self.replies,
+                "hedged_replies": self.hedged_replies,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "wasted_requests": self.wasted,
+                "hedge_rate": self.hedged_replies / self.replies if self.replies else 0.0,
+            }
+
+
+hedge_stats = HedgeStats()
+
+
+def get_hedge_delay(candidates: list) -> float | None:
+    """
+    Seconds to wait on the primary attempt before hedging, from the hedge_after config:
+    a number of seconds, or "p95" for the primary pair's observed p95 latency.
+    None when hedging is off.
+    """
+    value = (config_cache.get("hedge_after", "") or "").lower()
+    if not value or len(candidates) < 2:
+        return None
+    if value == "p95":
+        key, model = candidates[0]
+        delay = router.latency_quantile(key, model, 0.95)
+        return delay if delay is not None else DEFAULT_HEDGE_AFTER
+    try:
+        delay = float(value)
+    except ValueError:
+        logger.warning("Invalid value for hedge_after config. Hedging disabled.")
+        return None
+    return delay if delay > 0 else None
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=HEDGE_WORKERS, thread_name_prefix="mbot-hedge")
+    return _executor
+
+
+def _run_attempt(process, history: list, model: str, key: str) -> list:
+    try:
+        return process(history, model, key)
+    finally:
+        close_old_connections()
+
+
+def hedged_reply(history: list, candidates: list, process, delay: float) -> list:
+    """
+    Tries candidates like ai_reply, but if no attempt has answered after `delay`
+    seconds, starts the next candidate alongside it. The first valid reply wins;
+    attempts that already started cannot be interrupted and are left to finish.
+    """
+    max_hedges = config_cache.get_int("hedge_max", 1)
+    remaining = iter(candidates)
+    running = {}
+    hedges = 0
+
+    def launch(is_hedge: bool) -> bool:
+        pair = next(remaining, None)
+        if pair is None:
+            return False
+        key, model = pair
+        if is_hedge:
+            logger.info(f"Hedging after {delay:.1f}s with {model} using {mask_key(key)}")
+        running[get_executor().submit(_run_attempt, process, history, model, key)] = is_hedge
+        return True
+
+    launch(False)
+    while running:
+        can_hedge = delay is not None and hedges < max_hedges
+        done, _ = wait(running, timeout=delay if can_hedge else None, return_when=FIRST_COMPLETED)
+        if not done:
+            if launch(True):
+                hedges += 1
+            else:
+                delay = None
+            continue
+
+        for future in done:
+            is_hedge = running.pop(future)
+            reply = future.result()
+            if reply:
+                wasted = sum(1 for other in running if not other.cancel())
+                hedge_stats.record(hedges, is_hedge, wasted)
+                return reply
+
+        # Every running attempt failed: fall back to the next candidate
+        if not running and launch(False):
+            metrics.gemini_fallbacks.inc()
+
+    hedge_stats.record(hedges, False, 0)
+    logger.error("[FAIL] No valid response from any model/key")
+    return []
+
+
+async def async_hedged_reply(history: list, candidates: list, process, delay: float, max_hedges: int) -> list:
+    """Async version of hedged_reply; losing attempts are cancelled outright."""
+    remaining = iter(candidates)
+    running = {}
+    hedges = 0
+
+    def launch(is_hedge: bool) -> bool:
+        pair = next(remaining, None)
+        if pair is None:
+            return False
+        key, model = pair
+        if is_hedge:
+            logger.info(f"Hedging after {delay:.1f}s with {model} using {mask_key(key)}")
+        running[asyncio.create_task(process(history, model, key))] = is_hedge
+        return True
+
+    launch(False)
+    while running:
+        can_hedge = delay is not None and hedges < max_hedges
+        done, _ = await asyncio.wait(running, timeout=delay if can_hedge else None, return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            if launch(True):
+                hedges += 1
+            else:
+                delay = None
+            continue
+
+        for task in done:
+            is_hedge = running.pop(task)
+            reply = task.result()
+            if reply:
+                for other in running:
+                    other.cancel()
+                # A cancelled request may already have been billed for its input tokens
+                hedge_stats.record(hedges, is_hedge, len(running))
+                return reply
+
+        if not running and launch(False):
+            metrics.gemini_fallbacks.inc()
+
+    hedge_stats.record(hedges, False, 0)
+    logger.error("[FAIL] No valid response from any model/key")
+    return []
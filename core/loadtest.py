@@ -0,0 +1,245 @@
+"""
+Local stand-ins for the Send API and Gemini, used by the loadtest command to drive
+the real webhook path without network access or API quota, and the throwaway
+database the benchmark commands run against.
+"""
+import asyncio
+import hashlib
+import hmac
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import urlparse
+
+from django.db import connection
+from django.db.backends import utils as db_utils
+from django.test.utils import setup_test_environment, teardown_test_environment
+from google.genai import errors, types
+
+
+@contextmanager
+def throwaway_db(name: str):
+    """
+    Runs the block against a fresh SQLite test database in a temporary directory,
+    so benchmark rows never reach the real one.
+    """
+    setup_test_environment()
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            connection.settings_dict["TEST"]["NAME"] = os.path.join(tmp_dir, f"{name}.sqlite3")
+            old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            try:
+                yield
+            finally:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+    finally:
+        teardown_test_environment()
+
+
+def signed_body(secret: str, events: list) -> tuple[bytes, str]:
+    """Encodes webhook events and signs them like Facebook does (X-Hub-Signature-256)."""
+    body = json.dumps({"object": "page", "entry": [{"messaging": events}]}).encode("utf-8")
+    signature = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).hexdigest()
+    return body, f"sha256={signature}"
+
+
+def percentile(values: list, quantile: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, int(round(quantile * len(values))) - 1))]
+
+
+# --- Fake Send API ---
+
+class FakeSendAPI:
+    """
+    A local HTTP server answering Send API requests after `latency` seconds.
+    A share `error_rate` of requests fail, alternating between 500s and Graph
+    API error bodies. Records when each recipient got its first message.
+    """
+
+    def __init__(self, latency: float = 0.05, error_rate: float = 0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.messages = 0
+        self.actions = 0
+        self.first_message_at = {}
+        self._server = None
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v23.0/me/messages"
+
+    def start(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            # Keep-alive, so the bot's connection pool is exercised like against Graph API
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self):
+                payload = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                status, body = api.handle(urlparse(self.path).path, payload)
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="fake-send-api", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def handle(self, path: str, payload: dict) -> tuple[int, dict]:
+        time.sleep(self.latency)
+        received_at = time.perf_counter()
+        failed = random.random() < self.error_rate
+        with self._lock:
+            self.requests += 1
+            if failed:
+                self.errors += 1
+            elif "message" in payload:
+                self.messages += 1
+                self.first_message_at.setdefault(payload["recipient"]["id"], received_at)
+            else:
+                self.actions += 1
+        if failed:
+            if random.random() < 0.5:
+                return 500, {"error": {"message": "Fake server error", "code": 1}}
+            return 200, {"error": {"message": "Fake Graph API error", "code": 10}}
+        return 200, {"recipient_id": payload.get("recipient", {}).get("id"), "message_id": "m_fake"}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"requests": self.requests, "errors": self.errors, "messages": self.messages, "actions": self.actions}
+
+
+# --- Fake Gemini ---
+
+class FakeGemini:
+    """
+    An injectable stand-in for genai.Client covering the calls the bot makes:
+    models.generate_content(_stream) and their client.aio versions. Replies after
+    `latency` seconds, or raises a 503 ServerError for a share `error_rate` of calls.
+    """
+
+    def __init__(self, latency: float = 1.0, error_rate: float = 0.0, parts: int = 1, stream_chunks: int = 3):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.reply = json.dumps([{"text": f"Fake reply part {i + 1}"} for i in range(parts)])
+        self.stream_chunks = max(1, stream_chunks)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+        self.models = SimpleNamespace(
+            generate_content=self._generate_content,
+            generate_content_stream=self._generate_content_stream,
+        )
+        self.aio = SimpleNamespace(models=SimpleNamespace(
+            generate_content=self._agenerate_content,
+            generate_content_stream=self._agenerate_content_stream,
+        ))
+
+    def __call__(self, api_key=None):
+        """Stands in for clients.get_client, returning the same fake for every key."""
+        return self
+
+    def _start_call(self):
+        with self._lock:
+            self.calls += 1
+            failed = random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if failed:
+            raise errors.ServerError(503, {"error": {"code": 503, "message": "Fake overload", "status": "UNAVAILABLE"}})
+
+    def _usage(self, contents) -> types.GenerateContentResponseUsageMetadata:
+        return types.GenerateContentResponseUsageMetadata(
+            prompt_token_count=len(str(contents)) // 4,
+            candidates_token_count=len(self.reply) // 4,
+        )
+
+    def _response(self, text: str, contents):
+        return SimpleNamespace(text=text, usage_metadata=self._usage(contents))
+
+    def _chunks(self) -> list:
+        size = -(-len(self.reply) // self.stream_chunks)
+        return [self.reply[i:i + size] for i in range(0, len(self.reply), size)]
+
+    def _generate_content(self, model, contents, config=None):
+        time.sleep(self.latency)
+        self._start_call()
+        return self._response(self.reply, contents)
+
+    def _generate_content_stream(self, model, contents, config=None):
+        self._start_call()
+        for chunk in self._chunks():
+            time.sleep(self.latency / self.stream_chunks)
+            yield self._response(chunk, contents)
+
+    async def _agenerate_content(self, model, contents, config=None):
+        await asyncio.sleep(self.latency)
+        self._start_call()
+        return self._response(self.reply, contents)
+
+    async def _agenerate_content_stream(self, model, contents, config=None):
+        self._start_call()
+
+        async def chunks():
+            for chunk in self._chunks():
+                await asyncio.sleep(self.latency / self.stream_chunks)
+                yield self._response(chunk, contents)
+        return chunks()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"calls": self.calls, "errors": self.errors}
+
+
+# --- DB query counting ---
+
+class QueryCounter:
+    """Counts SQL statements run on any thread's connection while active."""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+        self._original = None
+
+    def __enter__(self):
+        counter = self
+        original = self._original = db_utils.CursorWrapper._execute_with_wrappers
+
+        def counted(cursor, sql, params, many, executor):
+            with counter._lock:
+                counter.count += 1
+            return original(cursor, sql, params, many, executor)
+
+        db_utils.CursorWrapper._execute_with_wrappers = counted
+        return self
+
+    def __exit__(self, *exc_info):
+        db_utils.CursorWrapper._execute_with_wrappers = self._original
@@ -0,0 +1,157 @@
+"""
+Logging set up from settings.LOGGING: records are queued on the request thread and
+written by a background listener as JSON lines to a size-rotated file.
+"""
+import atexit
+import contextvars
+import copy
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import uuid
+import zlib
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+# Identifies the webhook request or event batch a record was logged for
+correlation_id = contextvars.ContextVar("correlation_id", default="")
+
+
+@contextmanager
+def correlation(value: str | None = None):
+    """Tags every record logged inside the block, on this thread or task, with value."""
+    token = correlation_id.set(value or uuid.uuid4().hex[:12])
+    try:
+        yield
+    finally:
+        correlation_id.reset(token)
+
+
+class CorrelationFilter(logging.Filter):
+    """Copies the current correlation ID onto the record while still on the logging thread."""
+
+    def filter(self, record):
+        record.correlation_id = correlation_id.get()
+        return True
+
+
+class ContentSampler(logging.Filter):
+    """
+    Keeps a `rate` share of INFO records logged with extra={"content": True}
+    (message texts). The choice follows the correlation ID, so an event's user
+    and model messages are kept or dropped together.
+    """
+
+    def __init__(self, rate: float = 1.0):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if not getattr(record, "content", False) or record.levelno > logging.INFO or self.rate >= 1:
+            return True
+        cid = getattr(record, "correlation_id", "") or correlation_id.get()
+        if cid:
+            return zlib.crc32(cid.encode()) % 10000 < self.rate * 10000
+        return random.random() < self.rate
+
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "correlation_id": getattr(record, "correlation_id", ""),
+            "thread": record.threadName,
+        }
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class BackgroundQueueHandler(QueueHandler):
+    """
+    Hands records to a QueueListener thread that does the formatting and file I/O.
+    The listener is restarted in a forked child, where the parent's thread is gone,
+    with a target from make_target() so each process can write its own file.
+    """
+
+    def __init__(self, make_target, maxsize: int):
+        super().__init__(queue.Queue(maxsize))
+        self.make_target = make_target
+        self.target = None
+        self.dropped = 0
+        self._pid = None
+        self._listener = None
+        self._start_lock = threading.Lock()
+        self._start()
+        atexit.register(self.stop)
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue.maxsize)
+            self.target = self.make_target()
+            self._listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+            self._listener.start()
+            self._pid = os.getpid()
+
+    def stop(self):
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+    def prepare(self, record):
+        # Keep the record's fields for the JSON formatter, but resolve everything that
+        # may not be safe to touch later from another thread: arguments and tracebacks
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Losing a log line is better than blocking a request on the disk
+            self.dropped += 1
+
+    def emit(self, record):
+        if self._pid != os.getpid():
+            self._start()
+        super().emit(record)
+
+
+def queue_handler(filename, max_bytes: int = 10 * 1024 * 1024, backup_count: int = 5,
+                  content_sample_rate: float = 1.0, queue_size: int = 10000) -> logging.Handler:
+    """
+    Handler factory for settings.LOGGING. Rotation is per process, so a "{pid}" in
+    filename is replaced with the writing process's ID; without it, several worker
+    processes would rotate the same file independently and lose lines.
+    """
+    def make_target() -> logging.Handler:
+        target = RotatingFileHandler(
+            str(filename).replace("{pid}", str(os.getpid())),
+            maxBytes=max_bytes, backupCount=backup_count, encoding="utf-8", delay=True,
+        )
+        target.setFormatter(JSONFormatter())
+        return target
+
+    handler = BackgroundQueueHandler(make_target, queue_size)
+    handler.addFilter(CorrelationFilter())
+    handler.addFilter(ContentSampler(content_sample_rate))
+    return handler
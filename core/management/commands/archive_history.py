@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand
+from django.db.models import F
+
+from core.archive import HISTORY_HOT_MESSAGES, archive_conversation, min_hot_messages
+from core.models import Conversation
+
+
+class Command(BaseCommand):
+    help = (
+        "Moves messages beyond each conversation's hot window into compressed "
+        "MessageArchive chunks. Run it periodically, e.g. from cron."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--keep", type=int, default=HISTORY_HOT_MESSAGES,
+            help="Messages to keep as Message rows per conversation (HISTORY_HOT_MESSAGES).",
+        )
+        parser.add_argument("--dry-run", action="store_true", help="Only report what would be archived.")
+
+    def handle(self, *args, **options):
+        keep = options["keep"]
+        if keep < min_hot_messages():
+            self.stderr.write(f"--keep {keep} is below the {min_hot_messages()} messages a reply may load, using that.")
+            keep = min_hot_messages()
+
+        candidates = Conversation.objects.filter(message_count__gt=F("archived_count") + keep)
+        if options["dry_run"]:
+            count = candidates.count()
+            self.stdout.write(f"{count} conversation(s) have more than {keep} hot messages.")
+            return
+
+        conversations = messages = 0
+        for conversation in candidates.iterator():
+            archived = archive_conversation(conversation, keep)
+            if archived:
+                conversations += 1
+                messages += archived
+        self.stdout.write(f"Archived {messages} message(s) from {conversations} conversation(s).")
@@ -0,0 +1,94 @@
+import threading
+import time
+from unittest import mock
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, close_old_connections, connection
+
+from core import db, views
+from core.loadtest import percentile, throwaway_db
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures conversation save throughput with N concurrent workers under each "
+        "SQLite profile in settings.DB_PROFILES. Each save is one simulated request: "
+        "get_or_create the conversation, append a user and model message, end the request."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=8, help="Concurrent worker threads.")
+        parser.add_argument("--saves", type=int, default=100, help="Saves per worker.")
+        parser.add_argument("--senders", type=int, default=0, help="Distinct conversations (default: one per worker).")
+        parser.add_argument(
+            "--profiles", default=",".join(settings.DB_PROFILES),
+            help="Comma separated DB_PROFILES to compare.",
+        )
+
+    def handle(self, *args, **options):
+        original = {key: connection.settings_dict.get(key) for key in ("OPTIONS", "CONN_MAX_AGE", "CONN_HEALTH_CHECKS")}
+        try:
+            for profile in options["profiles"].split(","):
+                self.stdout.write(self.run_profile(profile.strip(), options))
+        finally:
+            connection.settings_dict.update(original)
+
+    def run_profile(self, profile: str, options) -> str:
+        # Every thread's connection is built from this same settings dict
+        connection.close()
+        connection.settings_dict.update({
+            "OPTIONS": {}, "CONN_MAX_AGE": 0, "CONN_HEALTH_CHECKS": False,
+            **settings.DB_PROFILES[profile],
+        })
+        # Lock retries are part of the tuned profiles, the default one runs as before them
+        retries = db.DB_LOCK_RETRIES if profile != "default" else 0
+
+        with throwaway_db(f"bench_{profile}"):
+            connection.close()
+            with mock.patch.object(db, "DB_LOCK_RETRIES", retries):
+                saves, errors, latencies, elapsed = self.run_workers(options)
+
+        latencies.sort()
+        return (
+            f"{profile:<11} {options['workers']} workers: {saves / elapsed:.0f} saves/s "
+            f"({saves} ok, {errors} failed in {elapsed:.2f}s), "
+            f"p50 {percentile(latencies, 0.5) * 1000:.1f} ms, p95 {percentile(latencies, 0.95) * 1000:.1f} ms, "
+            f"p99 {percentile(latencies, 0.99) * 1000:.1f} ms"
+        )
+
+    def run_workers(self, options) -> tuple[int, int, list, float]:
+        senders = options["senders"] or options["workers"]
+        lock = threading.Lock()
+        results = {"saves": 0, "errors": 0}
+        latencies = []
+        barrier = threading.Barrier(options["workers"])
+
+        def work(worker: int):
+            barrier.wait()
+            for i in range(options["saves"]):
+                start = time.perf_counter()
+                try:
+                    conversation = views.get_or_create_conversation(f"bench-{(worker + i) % senders}")
+                    conversation.append_messages([
+                        {"role": "user", "content": f"Question {i} from worker {worker}"},
+                        {"role": "assistant", "content": f"Answer {i} to worker {worker}"},
+                    ])
+                    outcome = "saves"
+                except OperationalError:
+                    outcome = "errors"
+                finally:
+                    # End of the simulated request: closes the connection unless CONN_MAX_AGE keeps it
+                    close_old_connections()
+                with lock:
+                    results[outcome] += 1
+                    latencies.append(time.perf_counter() - start)
+            connection.close()
+
+        threads = [threading.Thread(target=work, args=(worker,)) for worker in range(options["workers"])]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results["saves"], results["errors"], latencies, time.perf_counter() - start
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from core import outbox, views
+from core.models import OutboxMessage
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends every due outbox reply part and purges old delivered ones. Web processes "
+        "retry on their own; run this from cron to drain parts left behind by a restart."
+    )
+
+    def handle(self, *args, **options):
+        waiting = outbox.deliver_due(views.send_message)
+        purged = outbox.purge_sent()
+        failed = OutboxMessage.objects.filter(status=OutboxMessage.FAILED).count()
+        self.stdout.write(f"{waiting} part(s) still waiting, {failed} given up, {purged} delivered part(s) purged.")
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory
+
+from core import views, async_views
+from core.loadtest import FakeGemini, FakeSendAPI, QueryCounter, percentile, signed_body, throwaway_db
+from core.models import APIKey, SystemPrompt
+from core.worker import get_task_queue, queue_enabled
+
+LOADTEST_SECRET = "loadtest-secret"
+
+
+def interval(options) -> float:
+    """Seconds between sends, 0 to send every message at once."""
+    return 1 / options["rate"] if options["rate"] > 0 else 0.0
+
+
+class Command(BaseCommand):
+    help = (
+        "Sends HMAC-signed webhook messages at a target rate through the real webhook path, "
+        "against a local fake Send API server and a fake Gemini client, and reports throughput, "
+        "latency percentiles, DB queries and outbound calls per message. --mode both compares "
+        "the WSGI view (a fixed pool of threads) with the ASGI one (one event loop)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=200, help="Messages to send, one per sender.")
+        parser.add_argument("--rate", type=float, default=20.0, help="Target messages per second, 0 sends them all at once.")
+        parser.add_argument("--mode", choices=["wsgi", "asgi", "both"], default="wsgi", help="Webhook view to drive.")
+        parser.add_argument("--threads", type=int, default=8, help="Threads serving requests in wsgi mode.")
+        parser.add_argument("--llm-latency", type=float, default=1.0, help="Fake Gemini latency (s).")
+        parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Share of Gemini calls failing with 503.")
+        parser.add_argument("--parts", type=int, default=1, help="Message parts in each fake reply.")
+        parser.add_argument("--send-latency", type=float, default=0.05, help="Fake Send API latency (s).")
+        parser.add_argument("--send-error-rate", type=float, default=0.0, help="Share of Send API calls failing.")
+
+    def handle(self, *args, **options):
+        modes = ["wsgi", "asgi"] if options["mode"] == "both" else [options["mode"]]
+        for mode in modes:
+            self.stdout.write(self.run_mode(mode, options))
+
+    def run_mode(self, mode: str, options) -> str:
+        send_api = FakeSendAPI(options["send_latency"], options["send_error_rate"]).start()
+        gemini = FakeGemini(options["llm_latency"], options["llm_error_rate"], options["parts"])
+        try:
+            with throwaway_db(f"loadtest_{mode}"):
+                # Two keys, so Gemini errors exercise the fallback path
+                APIKey.objects.create(name="loadtest-1", api_key="loadtest-key-1")
+                APIKey.objects.create(name="loadtest-2", api_key="loadtest-key-2")
+                SystemPrompt.objects.create(name="loadtest", prompt="Reply with a JSON array of messages.")
+                with mock.patch.object(views, "APP_SECRET", LOADTEST_SECRET), \
+                        mock.patch.object(views, "GEMINI_API_KEY", None), \
+                        mock.patch.object(views, "PAGE_TOKEN", "loadtest"), \
+                        mock.patch.object(views, "SEND_API_URL", send_api.url), \
+                        mock.patch.object(views, "get_client", gemini), \
+                        mock.patch.object(async_views, "get_client", gemini), \
+                        QueryCounter() as queries:
+                    run = self.run_wsgi if mode == "wsgi" else self.run_asgi
+                    sent_at, acks, elapsed = run(self.build_requests(options["messages"], mode), options)
+                return self.report(mode, options, sent_at, acks, elapsed, send_api, gemini, queries)
+        finally:
+            send_api.stop()
+
+    def build_requests(self, count: int, mode: str) -> list:
+        """Signed webhook requests, each carrying one text message from its own sender."""
+        factory = RequestFactory()
+        requests = []
+        for i in range(count):
+            sender_id = f"loadtest-{mode}-{i}"
+            body, signature = signed_body(LOADTEST_SECRET, [{
+                "sender": {"id": sender_id},
+                "recipient": {"id": "page"},
+                "timestamp": int(time.time() * 1000),
+                "message": {"mid": f"m_loadtest_{mode}_{i}", "text": f"Hello, message {i}"},
+            }])
+            request = factory.post(
+                "/webhook/", body, content_type="application/json", HTTP_X_HUB_SIGNATURE_256=signature,
+            )
+            requests.append((sender_id, request))
+        return requests
+
+    def run_wsgi(self, requests: list, options) -> tuple[dict, list, float]:
+        sent_at, acks = {}, []
+
+        def post(sender_id, request):
+            views.webhook_view(request)
+            acks.append(time.perf_counter() - sent_at[sender_id])
+
+        start = time.perf_counter()
+        # Open loop: requests are sent on schedule, whether or not earlier ones finished
+        with ThreadPoolExecutor(max_workers=options["threads"]) as pool:
+            for i, (sender_id, request) in enumerate(requests):
+                delay = start + i * interval(options) - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                # Timed from submission, so waiting for a free thread counts as latency
+                sent_at[sender_id] = time.perf_counter()
+                pool.submit(post, sender_id, request)
+        if queue_enabled():
+            get_task_queue().join()
+        return sent_at, acks, time.perf_counter() - start
+
+    def run_asgi(self, requests: list, options) -> tuple[dict, list, float]:
+        sent_at, acks = {}, []
+
+        async def post(sender_id, request):
+            sent_at[sender_id] = time.perf_counter()
+            await async_views.async_webhook_view(request)
+            acks.append(time.perf_counter() - sent_at[sender_id])
+
+        async def run_all():
+            tasks = []
+            for i, (sender_id, request) in enumerate(requests):
+                delay = start + i * interval(options) - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                tasks.append(asyncio.create_task(post(sender_id, request)))
+            await asyncio.gather(*tasks)
+            # In queue mode the view returns before the reply is sent
+            while async_views._background_tasks:
+                await asyncio.gather(*list(async_views._background_tasks), return_exceptions=True)
+
+        start = time.perf_counter()
+        asyncio.run(run_all())
+        return sent_at, acks, time.perf_counter() - start
+
+    def report(self, mode: str, options, sent_at: dict, acks: list, elapsed: float, send_api, gemini, queries) -> str:
+        count = len(sent_at)
+        replies = sorted(
+            send_api.first_message_at[sender_id] - sent
+            for sender_id, sent in sent_at.items() if sender_id in send_api.first_message_at
+        )
+        acks = sorted(acks)
+        target = f"at {options['rate']:g}/s target" if options["rate"] > 0 else "all at once"
+        send_stats, gemini_stats = send_api.stats(), gemini.stats()
+
+        def latencies(values):
+            return ", ".join(f"p{int(q * 100)} {percentile(values, q) * 1000:.0f} ms" for q in (0.5, 0.95, 0.99))
+
+        return "\n".join([
+            f"{mode}: {count} messages {target}, "
+            f"{count / elapsed:.1f}/s over {elapsed:.2f}s",
+            f"replied      {len(replies)}/{count} ({len(replies) / elapsed:.1f} replies/s)",
+            f"reply time   {latencies(replies)}",
+            f"ack time     {latencies(acks)}",
+            f"per message  {queries.count / count:.1f} DB queries, "
+            f"{send_stats['requests'] / count:.1f} Send API calls, {gemini_stats['calls'] / count:.2f} Gemini calls",
+            f"errors       {send_stats['errors']} Send API, {gemini_stats['errors']} Gemini",
+        ])
@@ -0,0 +1,96 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from core.clients import get_client
+from core.config import config_cache
+from core.contents import to_contents
+from core.context import aligned_start, estimate_tokens
+from core.models import Conversation
+
+
+def serialize(contents: list) -> str:
+    """The contents roughly as they go over the wire, for comparing request prefixes."""
+    return json.dumps([content.model_dump(mode="json", exclude_none=True) for content in contents], ensure_ascii=False)
+
+
+def common_prefix(a: str, b: str) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+def request_points(messages: list) -> list:
+    """Indexes after which a reply was requested: the last user message before a model turn."""
+    return [
+        i for i, message in enumerate(messages)
+        if message["role"] == "user" and (i + 1 == len(messages) or messages[i + 1]["role"] != "user")
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays stored conversations to compare the old str(history) request format with "
+        "structured contents: tokens per request, and how much of each request repeats the "
+        "previous one's prefix (what Gemini's implicit cache can serve)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--conversations", type=int, default=50, help="Most recent conversations to replay.")
+        parser.add_argument(
+            "--count-tokens", metavar="MODEL", default="",
+            help="Count tokens with Gemini's count_tokens for this model instead of estimating locally.",
+        )
+
+    def handle(self, *args, **options):
+        remember = config_cache.get_int("remember", 20)
+        step = config_cache.get_int("context_trim_step", 10)
+        model = options["count_tokens"]
+
+        def count(contents) -> int:
+            if model:
+                return get_client().models.count_tokens(model=model, contents=contents).total_tokens
+            if isinstance(contents, str):
+                return estimate_tokens(contents)
+            return sum(estimate_tokens(part.text) for content in contents for part in content.parts)
+
+        totals = {"requests": 0, "old_tokens": 0, "new_tokens": 0, "old_bytes": 0, "new_bytes": 0,
+                  "old_reused": 0, "new_reused": 0}
+        for conversation in Conversation.objects.order_by("-updated_at")[:options["conversations"]]:
+            messages = conversation.get_messages()
+            previous_old = previous_new = ""
+            for i in request_points(messages):
+                history = messages[:i + 1]
+                old_window = history[-remember:]
+                start = aligned_start(1, max(0, len(history) - remember), step, round_up=True)
+                new_window = history[min(start, len(history) - 1):]
+
+                old_request = str(old_window)
+                new_contents = to_contents(new_window)
+                new_request = serialize(new_contents)
+
+                totals["requests"] += 1
+                totals["old_tokens"] += count(old_request)
+                totals["new_tokens"] += count(new_contents)
+                totals["old_bytes"] += len(old_request)
+                totals["new_bytes"] += len(new_request)
+                totals["old_reused"] += common_prefix(previous_old, old_request)
+                totals["new_reused"] += common_prefix(previous_new, new_request)
+                previous_old, previous_new = old_request, new_request
+
+        if not totals["requests"]:
+            self.stdout.write("No stored conversations to replay.")
+            return
+
+        saved = totals["old_tokens"] - totals["new_tokens"]
+        self.stdout.write("\n".join([
+            f"{totals['requests']} requests replayed (remember={remember}, context_trim_step={step}), "
+            f"tokens {'from count_tokens' if model else 'estimated locally'}",
+            f"tokens/request   str(history) {totals['old_tokens'] / totals['requests']:.0f}, "
+            f"contents {totals['new_tokens'] / totals['requests']:.0f} "
+            f"({saved / max(1, totals['old_tokens']):.1%} saved)",
+            f"prefix reused    str(history) {totals['old_reused'] / max(1, totals['old_bytes']):.1%}, "
+            f"contents {totals['new_reused'] / max(1, totals['new_bytes']):.1%} of request bytes",
+        ]))
@@ -0,0 +1,168 @@
+import hashlib
+import logging
+import mimetypes
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from django.db import IntegrityError, close_old_connections
+from google.genai import types
+
+from .admission import gemini_limiter
+from .clients import get_client
+from . import metrics
+from .models import MediaDescription
+
+logger = logging.getLogger(__name__)
+
+# --- Environment Variables ---
+# Inline Gemini requests are limited to 20 MB, larger attachments are not described
+MEDIA_MAX_BYTES = int(os.getenv("MEDIA_MAX_BYTES", str(20 * 1024 * 1024)))
+MEDIA_WORKERS = int(os.getenv("MEDIA_WORKERS", "4"))
+MEDIA_TIMEOUT = (3.05, 15)
+
+MEDIA_MODEL = "gemini-2.5-flash"
+DEFAULT_MEDIA_PROMPT = "Describe this media content in less."
+CHUNK_SIZE = 64 * 1024
+THUMBS_UP_STICKER_ID = 369239263222822
+
+
+class MediaTooLarge(Exception):
+    pass
+
+
+class MediaOverloaded(Exception):
+    pass
+
+
+# Attachments come from Facebook's CDN, not graph.facebook.com, so they get their own pool
+_session = requests.Session()
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=MEDIA_WORKERS, thread_name_prefix="mbot-media")
+    return _executor
+
+
+def download_media(media_url: str) -> tuple[bytes, str, str]:
+    """
+    Streams an attachment into memory, stopping at MEDIA_MAX_BYTES.
+    Returns the content, its mime type and its sha256 hex digest.
+    """
+    with _session.get(media_url, stream=True, timeout=MEDIA_TIMEOUT) as resp:
+        resp.raise_for_status()
+        if int(resp.headers.get("Content-Length") or 0) > MEDIA_MAX_BYTES:
+            raise MediaTooLarge(f"Attachment is {resp.headers['Content-Length']} bytes")
+
+        digest = hashlib.sha256()
+        chunks = []
+        size = 0
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            if size > MEDIA_MAX_BYTES:
+                raise MediaTooLarge(f"Attachment exceeds {MEDIA_MAX_BYTES} bytes")
+            digest.update(chunk)
+            chunks.append(chunk)
+
+        mime_type = (resp.headers.get("Content-Type") or "").split(";")[0].strip()
+        if not mime_type or mime_type == "application/octet-stream":
+            mime_type = mimetypes.guess_type(media_url.split("?")[0])[0] or "application/octet-stream"
+    return b"".join(chunks), mime_type, digest.hexdigest()
+
+
+def describe_media(data: bytes, mime_type: str, prompt: str = DEFAULT_MEDIA_PROMPT) -> str:
+    """Asks Gemini to describe the media, sent inline instead of through a Files API upload."""
+    # Descriptions count against the same in-flight cap as replies
+    if not gemini_limiter.acquire():
+        raise MediaOverloaded("Too many Gemini calls in flight")
+    try:
+        response = get_client().models.generate_content(
+            model=MEDIA_MODEL,
+            contents=[types.Part.from_bytes(data=data, mime_type=mime_type), prompt],
+        )
+    finally:
+        gemini_limiter.release()
+    metrics.record_usage(MEDIA_MODEL, response.usage_metadata)
+    return response.text.strip()
+
+
+@metrics.span("process_media")
+def process_media(media_url: str, prompt: str = DEFAULT_MEDIA_PROMPT) -> str:
+    """
+    Describes the attachment at media_url. Descriptions are cached by content hash,
+    so the same product photo or forwarded image is only sent to Gemini once.
+    """
+    data, mime_type, sha256 = download_media(media_url)
+
+    # Cached descriptions were written for the default prompt only
+    cacheable = prompt == DEFAULT_MEDIA_PROMPT
+    if cacheable:
+        cached = MediaDescription.objects.filter(sha256=sha256).values_list("description", flat=True).first()
+        if cached is not None:
+            logger.info(f"Media description cache hit for {sha256[:12]}")
+            return cached
+
+    description = describe_media(data, mime_type, prompt)
+    if cacheable:
+        try:
+            MediaDescription.objects.create(sha256=sha256, mime_type=mime_type, size=len(data), description=description)
+        except IntegrityError:
+            # Another worker described the same file at the same time
+            pass
+    return description
+
+
+def _describe_attachment(attachment: dict) -> str:
+    attachment_type = attachment.get("type")
+    payload = attachment.get("payload") or {}
+    if payload.get("sticker_id") == THUMBS_UP_STICKER_ID:
+        return ">thumbsup sticker"
+    try:
+        url = payload["url"]
+    except KeyError:
+        # Fallback for unexpected format from user
+        logger.error("Unexpected attachment format from user")
+        return f'>user sent an "{attachment_type}" can\'t be seen'
+
+    try:
+        attachment_content = process_media(str(url))
+    except MediaTooLarge as e:
+        logger.warning(f"Skipping attachment: {e}")
+        return f'>user sent an "{attachment_type}" too large to be seen'
+    except MediaOverloaded as e:
+        logger.warning(f"Skipping attachment: {e}")
+        return f'>user sent an "{attachment_type}" not described'
+    except Exception as e:
+        logger.error(f"Failed to process attachment: {e}")
+        return f'>user sent an "{attachment_type}" can\'t be seen'
+    return f'>user sent an "{attachment_type}" which may have: {attachment_content}'
+
+
+def _describe_attachment_in_pool(attachment: dict) -> str:
+    try:
+        return _describe_attachment(attachment)
+    finally:
+        close_old_connections()
+
+
+def attachment_placeholders(attachments: list) -> list:
+    """Names each attachment without downloading it or calling Gemini, for a throttled sender."""
+    return [
+        ">thumbsup sticker" if (attachment.get("payload") or {}).get("sticker_id") == THUMBS_UP_STICKER_ID
+        else f'>user sent an "{attachment.get("type")}" not described'
+        for attachment in attachments
+    ]
+
+
+def describe_attachments(attachments: list) -> list:
+    """Describes every attachment of a message at the same time, keeping their order."""
+    if len(attachments) == 1:
+        return [_describe_attachment(attachments[0])]
+    return list(get_executor().map(_describe_attachment_in_pool, attachments))
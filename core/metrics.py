@@ -0,0 +1,207 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# --- Environment Variables ---
+# When set, /metrics requires an "Authorization: Bearer <token>" header
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds; from a local DB query up to a slow Gemini reply
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing count, per combination of label values."""
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        # Counter samples end in _total, and HELP/TYPE must name the same family
+        self.family = f"{name}_total"
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple((name, labels.get(name, "")) for name in self.labelnames)
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+    def samples(self) -> list:
+        with self._lock:
+            return [(self.family, key, value) for key, value in self._values.items()]
+
+
+class Histogram:
+    """Observations counted into cumulative buckets, with their sum and count."""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.family = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple((name, labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (last one is +Inf), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self) -> list:
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                    cumulative += bucket_count
+                    samples.append((f"{self.name}_bucket", key + (("le", _format_value(float(bound))),), cumulative))
+                samples.append((f"{self.name}_sum", key, total))
+                samples.append((f"{self.name}_count", key, count))
+        return samples
+
+
+class Registry:
+    """Holds the process's metrics and renders them in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, stats: dict | None = None) -> str:
+        """
+        Renders every metric. `stats` maps a metric prefix to a stats() dict, such as
+        the dedup store's; its numeric values are exported as gauges.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.family} {metric.documentation}")
+            lines.append(f"# TYPE {metric.family} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        for prefix, values in (stats or {}).items():
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE {prefix}_{key} gauge")
+                lines.append(f"{prefix}_{key} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+# --- Metrics ---
+# Values are per process: with several workers, Prometheus scrapes each one.
+
+stage_seconds = registry.register(Histogram(
+    "mbot_stage_seconds", "Time spent in each stage of handling a message.", ("stage",),
+))
+gemini_request_seconds = registry.register(Histogram(
+    "mbot_gemini_request_seconds", "Duration of each Gemini reply attempt.", ("model", "key", "outcome"),
+))
+gemini_fallbacks = registry.register(Counter(
+    "mbot_gemini_fallbacks", "Reply attempts made after an earlier key/model failed.",
+))
+gemini_tokens = registry.register(Counter(
+    "mbot_gemini_tokens", "Tokens reported in Gemini usage_metadata.", ("model", "type"),
+))
+gemini_responses = registry.register(Counter(
+    "mbot_gemini_responses", "Gemini responses that reported usage_metadata.", ("model",),
+))
+gemini_cache_hits = registry.register(Counter(
+    "mbot_gemini_cache_hits", "Gemini responses with part of the prompt served from cache.", ("model",),
+))
+dedup_hits = registry.register(Counter(
+    "mbot_dedup_hits", "Webhook messages dropped as already processed.",
+))
+json_decode_failures = registry.register(Counter(
+    "mbot_json_decode_failures", "Model replies that were not a valid JSON array.",
+))
+
+
+def span(stage: str):
+    """Times the enclosed block into mbot_stage_seconds; also usable as a decorator."""
+    return stage_seconds.time(stage=stage)
+
+
+# usage_metadata field -> token type label
+USAGE_FIELDS = {
+    "prompt_token_count": "prompt",
+    "cached_content_token_count": "cached",
+    "candidates_token_count": "output",
+    "thoughts_token_count": "thoughts",
+}
+
+def record_usage(model: str, usage_metadata):
+    """Adds a response's token usage to mbot_gemini_tokens_total."""
+    if usage_metadata is None:
+        return
+    gemini_responses.inc(model=model)
+    if getattr(usage_metadata, "cached_content_token_count", None):
+        gemini_cache_hits.inc(model=model)
+    for field, token_type in USAGE_FIELDS.items():
+        count = getattr(usage_metadata, field, None)
+        if count:
+            gemini_tokens.inc(count, model=model, type=token_type)
+
+
+def cache_stats() -> dict:
+    """Share of Gemini responses, and of prompt tokens, that were served from cache."""
+    responses = sum(value for _, _, value in gemini_responses.samples())
+    hits = sum(value for _, _, value in gemini_cache_hits.samples())
+    prompt = sum(value for _, labels, value in gemini_tokens.samples() if ("type", "prompt") in labels)
+    cached = sum(value for _, labels, value in gemini_tokens.samples() if ("type", "cached") in labels)
+    return {
+        "responses": responses,
+        "hit_ratio": hits / responses if responses else 0.0,
+        "token_ratio": cached / prompt if prompt else 0.0,
+    }
@@ -0,0 +1,95 @@
+# Generated by Django 5.2.5 on 2026-10-18 04:16
+
+import json
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def load_history(raw):
+    try:
+        history = json.loads(raw or "[]")
+    except (json.JSONDecodeError, TypeError):
+        return []
+    return history if isinstance(history, list) else []
+
+
+def history_to_messages(apps, schema_editor):
+    """Merges duplicate conversations per sender and moves each history blob into Message rows."""
+    Conversation = apps.get_model('core', 'Conversation')
+    Message = apps.get_model('core', 'Message')
+
+    conversations = {}
+    for conversation in Conversation.objects.order_by('created_at', 'id').iterator():
+        conversations.setdefault(conversation.sender_id, []).append(conversation)
+
+    for duplicates in conversations.values():
+        keeper = duplicates[0]
+        history = []
+        for conversation in duplicates:
+            history.extend(load_history(conversation.history))
+
+        messages = []
+        for seq, message in enumerate(history, 1):
+            if isinstance(message, dict) and 'content' in message:
+                role, content = message.get('role', 'unknown'), message['content']
+            else:
+                role, content = 'unknown', message
+            if not isinstance(content, str):
+                content = json.dumps(content)
+            messages.append(Message(conversation=keeper, seq=seq, role=str(role)[:20], content=content))
+        Message.objects.bulk_create(messages, batch_size=500)
+
+        if len(duplicates) > 1:
+            Conversation.objects.filter(pk__in=[c.pk for c in duplicates[1:]]).delete()
+
+
+def messages_to_history(apps, schema_editor):
+    Conversation = apps.get_model('core', 'Conversation')
+    Message = apps.get_model('core', 'Message')
+
+    for conversation in Conversation.objects.iterator():
+        history = [
+            {'role': role, 'content': content}
+            for role, content in Message.objects.filter(conversation=conversation)
+            .order_by('seq').values_list('role', 'content')
+        ]
+        conversation.history = json.dumps(history)
+        conversation.save(update_fields=['history'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0006_processedmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Message',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.PositiveIntegerField()),
+                ('role', models.CharField(max_length=20)),
+                ('content', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='core.conversation')),
+            ],
+            options={
+                'verbose_name': 'Message',
+                'verbose_name_plural': 'Messages',
+                'ordering': ['conversation', 'seq'],
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'seq'), name='unique_message_seq')],
+            },
+        ),
+        migrations.RunPython(history_to_messages, messages_to_history),
+        migrations.RemoveField(
+            model_name='conversation',
+            name='history',
+        ),
+        migrations.AlterField(
+            model_name='conversation',
+            name='sender_id',
+            field=models.CharField(max_length=255, unique=True),
+        ),
+    ]
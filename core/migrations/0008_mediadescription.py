@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-18 04:21
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0007_message'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaDescription',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('mime_type', models.CharField(max_length=255)),
+                ('size', models.PositiveIntegerField()),
+                ('description', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name': 'Media Description',
+                'verbose_name_plural': 'Media Descriptions',
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
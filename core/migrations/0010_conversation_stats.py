@@ -0,0 +1,48 @@
+# Generated by Django 5.2.5 on 2026-10-18 04:34
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+PREVIEW_LENGTH = 100
+
+
+def fill_stats(apps, schema_editor):
+    """Computes the stored stats of existing conversations from their messages."""
+    Conversation = apps.get_model('core', 'Conversation')
+    Message = apps.get_model('core', 'Message')
+
+    stats = Message.objects.values('conversation').annotate(count=Count('id'), last_at=Max('created_at'), last_seq=Max('seq'))
+    for row in stats.iterator():
+        last = Message.objects.filter(conversation=row['conversation'], seq=row['last_seq']).values('role', 'content').first()
+        preview = f"{last['role']}: {last['content']}"
+        if len(preview) > PREVIEW_LENGTH:
+            preview = preview[:PREVIEW_LENGTH - 3] + '...'
+        Conversation.objects.filter(pk=row['conversation']).update(
+            message_count=row['count'], last_message_at=row['last_at'], preview=preview,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0009_conversation_summary'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='preview',
+            field=models.CharField(blank=True, default='', max_length=100),
+        ),
+        migrations.RunPython(fill_stats, migrations.RunPython.noop),
+    ]
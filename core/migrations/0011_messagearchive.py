@@ -0,0 +1,42 @@
+# Generated by Django 5.2.5 on 2026-10-18 04:35
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0010_conversation_stats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='archived_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='archived_seq',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='MessageArchive',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('first_seq', models.PositiveIntegerField()),
+                ('last_seq', models.PositiveIntegerField()),
+                ('count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archives', to='core.conversation')),
+            ],
+            options={
+                'verbose_name': 'Message Archive',
+                'verbose_name_plural': 'Message Archives',
+                'ordering': ['conversation', 'first_seq'],
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'first_seq'), name='unique_archive_first_seq')],
+            },
+        ),
+    ]
@@ -1,4 +1,10 @@
-from django.db import models
+import json
+import zlib
+
+from django.db import IntegrityError, models, transaction
+from django.utils import timezone
+
+from .db import retry_on_lock
 
 class SystemPrompt(models.Model):
     name = models.CharField(max_length=255, unique=True)
@@ -31,15 +37,127 @@ class APIKey(models.Model):
         return f'{self.name} -> {self.api_key[:4]}...{self.api_key[-4:]}'
     
 
+PREVIEW_LENGTH = 100
+
+def message_preview(message: dict) -> str:
+    preview = f"{message['role']}: {message['content']}"
+    return (preview[:PREVIEW_LENGTH - 3] + '...') if len(preview) > PREVIEW_LENGTH else preview
+
+
 class Conversation(models.Model):
-    sender_id = models.CharField(max_length=255)
-    history = models.TextField(default="[]", blank=True, null=True)
+    sender_id = models.CharField(max_length=255, unique=True)
+    # Rolling summary of the turns up to summary_seq, which no longer fit in the context
+    summary = models.TextField(blank=True, default="")
+    summary_seq = models.PositiveIntegerField(default=0)
+    # Kept up to date by append_messages, so listing conversations never reads Message rows
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
+    preview = models.CharField(max_length=PREVIEW_LENGTH, blank=True, default="")
+    # Messages up to archived_seq were moved into compressed MessageArchive chunks
+    archived_seq = models.PositiveIntegerField(default=0)
+    archived_count = models.PositiveIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     
+    def get_messages(self, limit: int | None = None, with_seq: bool = False) -> list:
+        """
+        Returns the last `limit` messages (all if None) as role/content dicts, oldest first.
+        Archived messages are only read when the hot Message rows are not enough.
+        """
+        fields = ('seq', 'role', 'content') if with_seq else ('role', 'content')
+        messages = self.messages.order_by('-seq').values(*fields)
+        if limit is not None:
+            messages = messages[:limit]
+        messages = list(reversed(messages))
+
+        if self.archived_count and (limit is None or len(messages) < limit):
+            archived = []
+            for archive in self.archives.order_by('-first_seq'):
+                archived[:0] = archive.get_messages()
+                if limit is not None and len(archived) + len(messages) >= limit:
+                    break
+            if limit is not None:
+                archived = archived[max(0, len(archived) + len(messages) - limit):]
+            messages = [{field: m[field] for field in fields} for m in archived] + messages
+        return messages
+
+    def get_message_page(self, offset: int, limit: int) -> list:
+        """Messages offset to offset + limit in seq order, archived ones included, for the admin."""
+        archived = []
+        if offset < self.archived_count:
+            position = 0
+            for archive in self.archives.order_by('first_seq'):
+                if position + archive.count > offset:
+                    archived += archive.get_messages()[max(0, offset - position):]
+                position += archive.count
+                if len(archived) >= limit or position >= offset + limit:
+                    break
+        archived = archived[:limit]
+        hot_offset = max(0, offset - self.archived_count)
+        hot = self.messages.order_by('seq').values('seq', 'role', 'content')[hot_offset:hot_offset + limit - len(archived)]
+        return archived + list(hot)
+
+    @retry_on_lock
+    def archive_messages(self, keep: int, upto_seq: int | None = None) -> int:
+        """
+        Moves every message but the last `keep` (at least one) into a compressed
+        MessageArchive chunk, stopping at upto_seq if given. Returns how many moved.
+        """
+        keep = max(1, keep)
+        with transaction.atomic():
+            last_seq = self.messages.aggregate(last=models.Max('seq'))['last'] or 0
+            cutoff = last_seq - keep
+            if upto_seq is not None:
+                cutoff = min(cutoff, upto_seq)
+            rows = list(self.messages.filter(seq__lte=cutoff).order_by('seq').values('seq', 'role', 'content', 'created_at'))
+            if not rows:
+                return 0
+            MessageArchive.objects.create(
+                conversation=self,
+                first_seq=rows[0]['seq'],
+                last_seq=rows[-1]['seq'],
+                count=len(rows),
+                data=MessageArchive.compress(rows),
+            )
+            self.messages.filter(seq__lte=rows[-1]['seq']).delete()
+            Conversation.objects.filter(pk=self.pk).update(
+                archived_seq=rows[-1]['seq'], archived_count=models.F('archived_count') + len(rows),
+            )
+        self.archived_seq = rows[-1]['seq']
+        self.archived_count += len(rows)
+        return len(rows)
+
     def get_history(self):
-        return self.history if self.history else "[]"
-    
+        """The full history as a JSON string, in the format of the old history column."""
+        return json.dumps(self.get_messages())
+
+    @retry_on_lock
+    def append_messages(self, messages: list) -> int | None:
+        """Appends role/content dicts after the current last message, returning the first one's seq."""
+        if not messages:
+            return None
+        for attempt in range(3):
+            try:
+                with transaction.atomic():
+                    last_seq = self.messages.aggregate(last=models.Max('seq'))['last'] or 0
+                    Message.objects.bulk_create(
+                        Message(conversation=self, seq=last_seq + i, role=m['role'], content=m['content'])
+                        for i, m in enumerate(messages, 1)
+                    )
+                    now = timezone.now()
+                    preview = message_preview(messages[-1])
+                    Conversation.objects.filter(pk=self.pk).update(
+                        message_count=models.F('message_count') + len(messages),
+                        last_message_at=now, preview=preview, updated_at=now,
+                    )
+                self.message_count += len(messages)
+                self.last_message_at, self.preview, self.updated_at = now, preview, now
+                return last_seq + 1
+            except IntegrityError:
+                # Another writer took the same seq numbers, recompute and retry
+                if attempt == 2:
+                    raise
+
     class Meta:
         verbose_name = 'Conversation'
         verbose_name_plural = 'Conversations'
@@ -47,7 +165,94 @@ class Conversation(models.Model):
 
     def __str__(self):
         return self.sender_id
+
+
+class MessageArchive(models.Model):
+    """A run of a conversation's older messages, stored as zlib-compressed JSON."""
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='archives')
+    first_seq = models.PositiveIntegerField()
+    last_seq = models.PositiveIntegerField()
+    count = models.PositiveIntegerField()
+    data = models.BinaryField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Message Archive'
+        verbose_name_plural = 'Message Archives'
+        ordering = ['conversation', 'first_seq']
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'first_seq'], name='unique_archive_first_seq'),
+        ]
+
+    @staticmethod
+    def compress(messages: list) -> bytes:
+        rows = [
+            {'seq': m['seq'], 'role': m['role'], 'content': m['content'],
+             'created_at': m['created_at'].isoformat() if m.get('created_at') else None}
+            for m in messages
+        ]
+        return zlib.compress(json.dumps(rows, ensure_ascii=False).encode('utf-8'), 9)
+
+    def get_messages(self) -> list:
+        """The archived messages as seq/role/content/created_at dicts, oldest first."""
+        return json.loads(zlib.decompress(bytes(self.data)))
+
+    def __str__(self):
+        return f'{self.conversation_id}#{self.first_seq}-{self.last_seq}'
+
+
+class Message(models.Model):
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='messages')
+    seq = models.PositiveIntegerField()
+    role = models.CharField(max_length=20)
+    content = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Message'
+        verbose_name_plural = 'Messages'
+        ordering = ['conversation', 'seq']
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='unique_message_seq'),
+        ]
+
+    def __str__(self):
+        return f'{self.conversation_id}#{self.seq} {self.role}'
     
+class OutboxMessage(models.Model):
+    """A reply part waiting for the Send API, stored together with the message it delivers."""
+    PENDING = 'pending'
+    SENDING = 'sending'
+    SENT = 'sent'
+    FAILED = 'failed'
+    STATUS_CHOICES = [(PENDING, 'Pending'), (SENDING, 'Sending'), (SENT, 'Sent'), (FAILED, 'Failed')]
+
+    conversation = models.ForeignKey(Conversation, on_delete=models.CASCADE, related_name='outbox')
+    # seq of the assistant Message this part was saved as; parts go out in seq order
+    seq = models.PositiveIntegerField()
+    message = models.JSONField()
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        verbose_name = 'Outbox Message'
+        verbose_name_plural = 'Outbox Messages'
+        ordering = ['conversation', 'seq']
+        constraints = [
+            models.UniqueConstraint(fields=['conversation', 'seq'], name='unique_outbox_seq'),
+        ]
+        indexes = [
+            models.Index(fields=['status', 'next_attempt_at'], name='outbox_due'),
+        ]
+
+    def __str__(self):
+        return f'{self.conversation_id}#{self.seq} {self.status}'
+
+
 class Config(models.Model):
     name = models.CharField(max_length=255, unique=True)
     value = models.TextField()
@@ -59,4 +264,31 @@ class Config(models.Model):
         ordering = ['-updated_at']
         
     def __str__(self):
-        return self.name
\ No newline at end of file
+        return self.name
+
+class ProcessedMessage(models.Model):
+    mid = models.CharField(max_length=255, unique=True)
+    expires_at = models.DateTimeField(db_index=True)
+
+    class Meta:
+        verbose_name = 'Processed Message'
+        verbose_name_plural = 'Processed Messages'
+
+    def __str__(self):
+        return self.mid
+
+
+class MediaDescription(models.Model):
+    sha256 = models.CharField(max_length=64, unique=True)
+    mime_type = models.CharField(max_length=255)
+    size = models.PositiveIntegerField()
+    description = models.TextField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        verbose_name = 'Media Description'
+        verbose_name_plural = 'Media Descriptions'
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return f'{self.mime_type} {self.sha256[:12]}'
@@ -0,0 +1,214 @@
+import logging
+import os
+import random
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from . import metrics
+from .db import retry_on_lock
+from .models import Conversation, OutboxMessage
+
+logger = logging.getLogger(__name__)
+
+# --- Environment Variables ---
+# Sends per reply part before it is given up as failed
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Retry n waits OUTBOX_BACKOFF * 2^(n-1) seconds, up to OUTBOX_MAX_BACKOFF, with jitter
+OUTBOX_BACKOFF = float(os.getenv("OUTBOX_BACKOFF", "2"))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", "600"))
+# A part still marked sending after this long belongs to a worker that died mid-send
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+# How often the delivery worker looks for due retries while any are waiting
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+# Delivered parts are kept this long, then purged
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", "86400"))
+
+deliveries = metrics.registry.register(metrics.Counter(
+    "mbot_outbox_deliveries", "Send API attempts for outbox reply parts.", ("outcome",),
+))
+
+
+@retry_on_lock
+def save_reply(conversation: Conversation, messages: list, parts: list):
+    """
+    Appends the new turns and queues the reply parts in one transaction. The parts
+    are the last len(parts) messages, so each is keyed by its message's seq.
+    """
+    with transaction.atomic():
+        first_seq = conversation.append_messages(messages)
+        start = first_seq + len(messages) - len(parts)
+        OutboxMessage.objects.bulk_create(
+            OutboxMessage(conversation=conversation, seq=start + i, message=part)
+            for i, part in enumerate(parts)
+        )
+
+
+def backoff(attempts: int) -> float:
+    """Seconds to wait before retry number `attempts`."""
+    delay = min(OUTBOX_MAX_BACKOFF, OUTBOX_BACKOFF * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1.0)
+
+
+def undelivered(conversation_id: int) -> list:
+    """The conversation's parts still to send, oldest first. Each waits behind the ones before it."""
+    return list(
+        OutboxMessage.objects.filter(conversation_id=conversation_id, status__in=[OutboxMessage.PENDING, OutboxMessage.SENDING])
+        .order_by('seq')
+    )
+
+
+@retry_on_lock
+def claim(part: OutboxMessage) -> bool:
+    """
+    Claims a part that is due and not being sent by a live worker. The update only
+    matches the row as it was read, so just one worker gets to send it.
+    """
+    now = timezone.now()
+    if part.next_attempt_at > now:
+        return False
+    if part.status == OutboxMessage.SENDING and part.claimed_at > now - timedelta(seconds=OUTBOX_LEASE):
+        return False
+    return bool(OutboxMessage.objects.filter(pk=part.pk, status=part.status, claimed_at=part.claimed_at).update(
+        status=OutboxMessage.SENDING, claimed_at=now,
+    ))
+
+
+@retry_on_lock
+def finish(part: OutboxMessage, delivered: bool):
+    """Marks a claimed part sent, or schedules its retry with backoff until it runs out of attempts."""
+    now = timezone.now()
+    outbox = OutboxMessage.objects.filter(pk=part.pk)
+    if delivered:
+        outbox.update(status=OutboxMessage.SENT, sent_at=now, attempts=part.attempts + 1)
+        deliveries.inc(outcome="sent")
+        return
+    attempts = part.attempts + 1
+    if attempts >= OUTBOX_MAX_ATTEMPTS:
+        outbox.update(status=OutboxMessage.FAILED, attempts=attempts)
+        deliveries.inc(outcome="failed")
+        logger.error(f"Giving up on reply part {part} after {attempts} attempts")
+        return
+    outbox.update(
+        status=OutboxMessage.PENDING, attempts=attempts,
+        next_attempt_at=now + timedelta(seconds=backoff(attempts)),
+    )
+    deliveries.inc(outcome="retry")
+
+
+def deliver(conversation: Conversation, send) -> bool:
+    """
+    Sends the conversation's due parts in order with send(recipient_id, message),
+    stopping at the first one that is not due or fails. Returns False if any part
+    is left undelivered.
+    """
+    for part in undelivered(conversation.pk):
+        if not claim(part):
+            return False
+        delivered = send(conversation.sender_id, part.message)
+        finish(part, delivered)
+        if not delivered:
+            delivery_worker.wake()
+            return False
+    return True
+
+
+async def async_deliver(conversation: Conversation, send) -> bool:
+    """Async version of deliver, for an async send."""
+    for part in await sync_to_async(undelivered)(conversation.pk):
+        if not await sync_to_async(claim)(part):
+            return False
+        delivered = await send(conversation.sender_id, part.message)
+        await sync_to_async(finish)(part, delivered)
+        if not delivered:
+            delivery_worker.wake()
+            return False
+    return True
+
+
+def deliver_due(send) -> int:
+    """Delivers every conversation's due parts. Returns how many parts are still waiting."""
+    now = timezone.now()
+    stale = now - timedelta(seconds=OUTBOX_LEASE)
+    # Parts never tried yet are being sent by the request that saved them, unless it died
+    conversation_ids = set(
+        OutboxMessage.objects.filter(status=OutboxMessage.PENDING, next_attempt_at__lte=now)
+        .filter(Q(attempts__gt=0) | Q(created_at__lte=stale))
+        .values_list('conversation_id', flat=True)
+    ) | set(
+        OutboxMessage.objects.filter(status=OutboxMessage.SENDING, claimed_at__lte=stale)
+        .values_list('conversation_id', flat=True)
+    )
+    for conversation in Conversation.objects.filter(pk__in=conversation_ids):
+        deliver(conversation, send)
+    return OutboxMessage.objects.filter(status__in=[OutboxMessage.PENDING, OutboxMessage.SENDING]).count()
+
+
+def purge_sent() -> int:
+    """Deletes delivered parts older than OUTBOX_RETENTION."""
+    cutoff = timezone.now() - timedelta(seconds=OUTBOX_RETENTION)
+    deleted, _ = OutboxMessage.objects.filter(status=OutboxMessage.SENT, sent_at__lte=cutoff).delete()
+    return deleted
+
+
+class DeliveryWorker:
+    """
+    A daemon thread that retries failed parts once their backoff is over. It polls
+    while parts are waiting and sleeps until woken otherwise.
+    """
+
+    PURGE_INTERVAL = 600
+
+    def __init__(self, poll_interval: float = OUTBOX_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+
+    def start(self):
+        """Starts the thread. Safe to call more than once."""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="mbot-outbox", daemon=True)
+            self._thread.start()
+
+    def wake(self):
+        """Starts the worker if needed and makes it look for due parts now."""
+        self.start()
+        self._wake.set()
+
+    def _run(self):
+        # Sends through views.send_message, looked up per run so it can be replaced
+        from . import views
+
+        while True:
+            self._wake.clear()
+            waiting = 0
+            close_old_connections()
+            try:
+                waiting = deliver_due(views.send_message)
+                self._maybe_purge()
+            except Exception as e:
+                logger.error(f"Outbox delivery failed: {e}", exc_info=True)
+                waiting = 1
+            finally:
+                close_old_connections()
+            self._wake.wait(self.poll_interval if waiting else None)
+
+    def _maybe_purge(self):
+        if time.monotonic() - self._last_purge < self.PURGE_INTERVAL:
+            return
+        self._last_purge = time.monotonic()
+        deleted = purge_sent()
+        if deleted:
+            logger.info(f"Purged {deleted} delivered outbox messages")
+
+
+delivery_worker = DeliveryWorker()
@@ -0,0 +1,173 @@
+import itertools
+from collections import deque
+import logging
+import threading
+import time
+
+from .clients import mask_key
+
+logger = logging.getLogger(__name__)
+
+# Preference order: every healthy key is tried on a model before falling back to the next
+MODELS = ["gemini-2.5-pro", "gemini-2.5-flash"]
+
+# Cooldown base (seconds) by failure kind, doubled per consecutive failure up to MAX_COOLDOWN
+RATE_LIMIT_COOLDOWN = 30
+SERVER_ERROR_COOLDOWN = 5
+FAILURE_COOLDOWN = 10
+MAX_COOLDOWN = 600
+# Invalid or empty replies only cool a pair down once they repeat
+FAILURE_THRESHOLD = 3
+# Weight of the newest sample in the latency moving average
+LATENCY_ALPHA = 0.2
+# Recent successful latencies kept per pair for quantiles
+LATENCY_SAMPLES = 100
+
+
+class PairHealth:
+    """Success, latency and error history for one (api key, model) pair."""
+
+    def __init__(self):
+        self.successes = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.server_errors = 0
+        self.consecutive_failures = 0
+        self.latency = None
+        self.samples = deque(maxlen=LATENCY_SAMPLES)
+        self.in_flight = 0
+        self.cooldown_until = 0.0
+        self.last_error = ""
+
+    def cooling_down(self, now: float) -> bool:
+        return self.cooldown_until > now
+
+
+class ModelRouter:
+    """
+    Orders (key, model) attempts for ai_reply. Pairs that hit 429s, 5xx errors or
+    repeated bad replies are put on an exponentially growing cooldown and only tried
+    once every healthy pair has failed. Healthy keys on the same model are balanced by
+    in-flight requests, then latency. State is kept per process.
+    """
+
+    def __init__(self, models: list = MODELS):
+        self.models = models
+        self._health = {}
+        self._lock = threading.Lock()
+        self._rotation = itertools.count()
+
+    def _get(self, api_key: str, model: str) -> PairHealth:
+        health = self._health.get((api_key, model))
+        if health is None:
+            health = self._health.setdefault((api_key, model), PairHealth())
+        return health
+
+    def candidates(self, api_keys: list) -> list:
+        """Returns every (key, model) pair in the order they should be tried."""
+        now = time.monotonic()
+        keys = list(dict.fromkeys(api_keys))
+        if not keys:
+            return []
+        # Rotate the starting key so equally loaded keys share traffic
+        offset = next(self._rotation) % len(keys)
+        keys = keys[offset:] + keys[:offset]
+
+        healthy, cooling = [], []
+        with self._lock:
+            for model_rank, model in enumerate(self.models):
+                pairs = [(key, model, self._get(key, model)) for key in keys]
+                ready = [p for p in pairs if not p[2].cooling_down(now)]
+                ready.sort(key=lambda p: (p[2].in_flight, p[2].latency or 0.0))
+                healthy += [(key, model) for key, model, _ in ready]
+                cooling += [(h.cooldown_until, model_rank, key, model) for key, model, h in pairs if h.cooling_down(now)]
+        cooling.sort()
+        return healthy + [(key, model) for _, _, key, model in cooling]
+
+    def begin(self, api_key: str, model: str):
+        with self._lock:
+            self._get(api_key, model).in_flight += 1
+
+    def record_success(self, api_key: str, model: str, latency: float):
+        with self._lock:
+            health = self._get(api_key, model)
+            health.in_flight = max(0, health.in_flight - 1)
+            health.successes += 1
+            health.consecutive_failures = 0
+            health.cooldown_until = 0.0
+            health.latency = latency if health.latency is None else (
+                LATENCY_ALPHA * latency + (1 - LATENCY_ALPHA) * health.latency
+            )
+            health.samples.append(latency)
+
+    def record_cancelled(self, api_key: str, model: str):
+        """Ends an attempt that was abandoned before it finished, without judging the pair."""
+        with self._lock:
+            health = self._get(api_key, model)
+            health.in_flight = max(0, health.in_flight - 1)
+
+    def latency_quantile(self, api_key: str, model: str, quantile: float, min_samples: int = 20) -> float | None:
+        """Latency quantile of recent successes, or None until there are enough samples."""
+        with self._lock:
+            samples = sorted(self._get(api_key, model).samples)
+        if len(samples) < min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(len(samples) * quantile))]
+
+    def record_failure(self, api_key: str, model: str, error: Exception | None = None):
+        """Records a failed attempt; error=None means the reply was empty or not valid JSON."""
+        code = getattr(error, "code", None)
+        with self._lock:
+            health = self._get(api_key, model)
+            health.in_flight = max(0, health.in_flight - 1)
+            health.failures += 1
+            health.consecutive_failures += 1
+            health.last_error = str(error or 'invalid reply')[:200]
+
+            if code == 429:
+                health.rate_limited += 1
+                base = RATE_LIMIT_COOLDOWN
+            elif isinstance(code, int) and code >= 500:
+                health.server_errors += 1
+                base = SERVER_ERROR_COOLDOWN
+            elif health.consecutive_failures >= FAILURE_THRESHOLD:
+                base = FAILURE_COOLDOWN
+            else:
+                return
+
+            cooldown = min(MAX_COOLDOWN, base * 2 ** (health.consecutive_failures - 1))
+            health.cooldown_until = time.monotonic() + cooldown
+        logger.warning(f"Cooling down {model} using {mask_key(api_key)} for {cooldown:.0f}s ({health.last_error})")
+
+    def reset(self, api_key: str | None = None):
+        """Clears cooldowns for one key, or for every key."""
+        with self._lock:
+            for (key, _), health in self._health.items():
+                if api_key is None or key == api_key:
+                    health.cooldown_until = 0.0
+                    health.consecutive_failures = 0
+
+    def state(self, api_key: str) -> list:
+        """Per-model health of a key, for the admin."""
+        now = time.monotonic()
+        rows = []
+        with self._lock:
+            for model in self.models:
+                health = self._health.get((api_key, model))
+                if health is None:
+                    continue
+                rows.append({
+                    "model": model,
+                    "successes": health.successes,
+                    "failures": health.failures,
+                    "rate_limited": health.rate_limited,
+                    "server_errors": health.server_errors,
+                    "latency": health.latency,
+                    "in_flight": health.in_flight,
+                    "cooldown": max(0.0, health.cooldown_until - now),
+                    "last_error": health.last_error,
+                })
+        return rows
+
+
+router = ModelRouter()
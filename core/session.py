@@ -0,0 +1,103 @@
+import asyncio
+import os
+import threading
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- Environment Variables ---
+SEND_API_POOL_SIZE = int(os.getenv("SEND_API_POOL_SIZE", "10"))
+SEND_API_CONNECT_TIMEOUT = float(os.getenv("SEND_API_CONNECT_TIMEOUT", "3.05"))
+SEND_API_READ_TIMEOUT = float(os.getenv("SEND_API_READ_TIMEOUT", "10"))
+SEND_API_KEEPALIVE = float(os.getenv("SEND_API_KEEPALIVE", "60"))
+
+SEND_API_TIMEOUT = (SEND_API_CONNECT_TIMEOUT, SEND_API_READ_TIMEOUT)
+
+# --- Sync Session ---
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    """
+    Returns the process-wide keep-alive session for graph.facebook.com.
+    Connections are reused across requests instead of paying a TLS handshake per call.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                # pool_block makes threads wait for a free connection instead of opening
+                # throwaway ones past the limit, so pool_maxsize is a real ceiling
+                adapter = HTTPAdapter(
+                    pool_connections=1,
+                    pool_maxsize=SEND_API_POOL_SIZE,
+                    pool_block=True,
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+# --- Async Client ---
+
+_async_client = None
+_async_client_loop = None
+
+def get_async_client() -> httpx.AsyncClient:
+    """Returns a shared keep-alive AsyncClient bound to the running event loop."""
+    global _async_client, _async_client_loop
+    loop = asyncio.get_running_loop()
+    if _async_client is None or _async_client_loop is not loop:
+        _async_client = httpx.AsyncClient(
+            timeout=httpx.Timeout(SEND_API_READ_TIMEOUT, connect=SEND_API_CONNECT_TIMEOUT),
+            limits=httpx.Limits(
+                max_connections=SEND_API_POOL_SIZE,
+                max_keepalive_connections=SEND_API_POOL_SIZE,
+                keepalive_expiry=SEND_API_KEEPALIVE,
+            ),
+        )
+        _async_client_loop = loop
+    return _async_client
+
+# --- Stats ---
+
+def pool_stats() -> dict:
+    """
+    Reports connection pool usage for sizing SEND_API_POOL_SIZE.
+    'opened' counts connections created since startup; if it keeps growing with traffic
+    the pool is too small or the server is closing idle connections.
+    """
+    stats = {"maxsize": SEND_API_POOL_SIZE, "hosts": {}}
+    if _session is not None:
+        adapter = _session.get_adapter("https://")
+        for key in adapter.poolmanager.pools.keys():
+            pool = adapter.poolmanager.pools[key]
+            # urllib3 pre-fills the queue with None placeholders, one per free slot
+            slots = list(pool.pool.queue) if pool.pool is not None else []
+            stats["hosts"][pool.host] = {
+                "requests": pool.num_requests,
+                "opened": pool.num_connections,
+                "in_use": SEND_API_POOL_SIZE - len(slots),
+                "idle": sum(1 for conn in slots if conn is not None),
+            }
+    if _async_client is not None:
+        connections = getattr(getattr(_async_client._transport, "_pool", None), "connections", [])
+        stats["async"] = {
+            "open": len(connections),
+            "idle": sum(1 for conn in connections if conn.is_idle()),
+        }
+    return stats
+
+
+def pool_gauges() -> dict:
+    """pool_stats() flattened for the metrics endpoint, with the sync pool summed over hosts."""
+    stats = pool_stats()
+    gauges = {"maxsize": stats["maxsize"]}
+    for key in ("requests", "opened", "in_use", "idle"):
+        gauges[key] = sum(host[key] for host in stats["hosts"].values())
+    for key, value in stats.get("async", {}).items():
+        gauges[f"async_{key}"] = value
+    return gauges
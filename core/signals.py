@@ -0,0 +1,34 @@
+from django.db.models.signals import pre_save, post_save, post_delete
+from django.dispatch import receiver
+
+from .answer_cache import answer_cache
+from .clients import evict_client
+from .config import config_cache
+from .models import APIKey, Config, SystemPrompt
+from .sys_prompt import invalidate_prompt
+
+
+@receiver(pre_save, sender=APIKey)
+def evict_changed_api_key(sender, instance, **kwargs):
+    """Evicts the cached client for the old key when an APIKey's value changes."""
+    if not instance.pk:
+        return
+    old_key = APIKey.objects.filter(pk=instance.pk).values_list("api_key", flat=True).first()
+    if old_key is not None and old_key != instance.api_key:
+        evict_client(old_key)
+
+@receiver(post_delete, sender=APIKey)
+def evict_deleted_api_key(sender, instance, **kwargs):
+    evict_client(instance.api_key)
+
+@receiver(post_save, sender=Config)
+@receiver(post_delete, sender=Config)
+def invalidate_config_cache(sender, **kwargs):
+    config_cache.invalidate()
+    answer_cache.clear()
+
+@receiver(post_save, sender=SystemPrompt)
+@receiver(post_delete, sender=SystemPrompt)
+def invalidate_system_prompt(sender, **kwargs):
+    invalidate_prompt()
+    answer_cache.clear()
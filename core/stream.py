@@ -0,0 +1,77 @@
+import json
+
+
+class JSONArrayStreamParser:
+    """
+    Incrementally parses a streamed top-level JSON array, such as the model's
+    list of reply parts. feed() returns every element that was completed by the
+    new text, so each part can be sent before the rest has been generated.
+    """
+
+    def __init__(self):
+        self._started = False
+        self._finished = False
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+        self._element = []
+        self._after_comma = False
+
+    def feed(self, text: str) -> list:
+        elements = []
+        for char in text:
+            if self._finished:
+                if not char.isspace():
+                    raise ValueError("Unexpected data after the end of the JSON array")
+                continue
+
+            if not self._started:
+                if char == "[":
+                    self._started = True
+                    self._depth = 1
+                elif not char.isspace():
+                    raise ValueError(f"Expected a JSON array, got {char!r}")
+                continue
+
+            if self._in_string:
+                self._element.append(char)
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+            elif char in "]}":
+                self._depth -= 1
+
+            if self._depth == 1 and char == ",":
+                elements.append(self._pop_element())
+                self._after_comma = True
+            elif self._depth == 0:
+                # Closing bracket of the top-level array
+                if "".join(self._element).strip():
+                    elements.append(self._pop_element())
+                elif self._after_comma:
+                    raise ValueError("Trailing comma in JSON array")
+                self._finished = True
+            else:
+                self._element.append(char)
+        return elements
+
+    def close(self):
+        """Raises ValueError if the stream ended before the array was closed."""
+        if not self._finished:
+            raise ValueError("JSON array was not closed")
+
+    def _pop_element(self):
+        text = "".join(self._element)
+        self._element = []
+        if not text.strip():
+            raise ValueError("Empty element in JSON array")
+        return json.loads(text)
@@ -1,16 +1,58 @@
+import hashlib
+import logging
 import os
+import threading
+import time
+
+from django.db.models import Count, Max
+
 from .models import SystemPrompt
 
+logger = logging.getLogger(__name__)
 
-def get_prompt():
-    prompt_parts = []
+# How long a process trusts its assembled prompt before re-checking the database
+# fingerprint and file mtimes. Saves in this process invalidate it immediately.
+PROMPT_CACHE_TTL = float(os.getenv("PROMPT_CACHE_TTL", "30"))
+
+FALLBACK_PROMPT = (
+    "You are an AI customer service assistant for a Facebook page business. "
+    "Your prompts may not be set up yet."
+)
+
+_cache = {"prompt": None, "version": None, "fingerprint": None, "checked_at": 0.0}
+_cache_lock = threading.Lock()
+
+
+def get_prompts_dir() -> str:
     prompts_dir = os.path.join(os.path.dirname(__file__), "..", "prompts")
-    prompts_dir = os.path.abspath(prompts_dir)
+    return os.path.abspath(prompts_dir)
+
+
+def get_fingerprint() -> tuple:
+    """
+    Cheap summary of every prompt source: one aggregate query plus a stat per file.
+    The prompt is only re-assembled when this changes.
+    """
+    db_state = SystemPrompt.objects.aggregate(count=Count("id"), updated=Max("updated_at"))
+    prompts_dir = get_prompts_dir()
+    file_state = ()
+    if os.path.isdir(prompts_dir):
+        file_state = tuple(
+            (entry.name, entry.stat().st_mtime_ns)
+            for entry in sorted(os.scandir(prompts_dir), key=lambda e: e.name)
+            if entry.name.endswith(".txt")
+        )
+    return (db_state["count"], db_state["updated"], file_state)
+
+
+def build_prompt():
+    prompt_parts = []
+    prompts_dir = get_prompts_dir()
 
     try:
         # Try from database
-        prompts = SystemPrompt.objects.all()
-        if prompts.exists():
+        prompts = list(SystemPrompt.objects.all())
+        if prompts:
             for prompt in prompts:
                 prompt_parts.append(prompt.prompt.strip())
             return "\n\n".join(prompt_parts)
@@ -33,7 +75,36 @@ def get_prompt():
         print(f"Error getting prompt: {e}")
 
     # Fallback
-    return (
-        "You are an AI customer service assistant for a Facebook page business. "
-        "Your prompts may not be set up yet."
-    )
+    return FALLBACK_PROMPT
+
+
+def get_prompt_with_version() -> tuple[str, str]:
+    """Returns the assembled system prompt and a short hash identifying its content."""
+    now = time.monotonic()
+    if _cache["prompt"] is not None and now - _cache["checked_at"] < PROMPT_CACHE_TTL:
+        return _cache["prompt"], _cache["version"]
+
+    with _cache_lock:
+        try:
+            fingerprint = get_fingerprint()
+        except Exception as e:
+            logger.error(f"Error checking prompt sources: {e}")
+            fingerprint = None
+
+        if _cache["prompt"] is None or fingerprint is None or fingerprint != _cache["fingerprint"]:
+            prompt = build_prompt()
+            _cache["prompt"] = prompt
+            _cache["version"] = hashlib.sha256(prompt.encode("utf-8")).hexdigest()[:16]
+            _cache["fingerprint"] = fingerprint
+        _cache["checked_at"] = now
+        return _cache["prompt"], _cache["version"]
+
+
+def get_prompt():
+    return get_prompt_with_version()[0]
+
+
+def invalidate_prompt():
+    """Forces the next get_prompt call to re-check its sources."""
+    _cache["checked_at"] = 0.0
+    _cache["fingerprint"] = None
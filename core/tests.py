@@ -1,3 +1,1356 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import hmac
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.db import IntegrityError, connection
+from django.db.migrations.executor import MigrationExecutor
+from django.db.models import QuerySet
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.utils import timezone
+
+from . import (
+    admission, answer_cache as answer_cache_module, archive, context, context_cache, dedup, events, hedge, log,
+    media, metrics, outbox, router as router_module, sys_prompt, views,
+)
+from .admission import ConcurrencyLimiter, SenderRateLimiter
+from .answer_cache import AnswerCache, cached_reply_key, normalize
+from .coalesce import SenderCoalescer
+from .config import config_cache
+from .context_cache import PromptContextCache
+from .dedup import DatabaseBackend, DedupStore, MemoryBackend, RedisBackend
+from .events import classify_event, split_events
+from .models import Config, Conversation, MediaDescription, Message, OutboxMessage, ProcessedMessage, SystemPrompt
+from .router import ModelRouter
+from .stream import JSONArrayStreamParser
+
+
+class Clock:
+    """A monotonic clock the tests move by hand."""
+
+    def __init__(self, now: float = 1000.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def patch_clock(test, module) -> Clock:
+    """Replaces module.time.monotonic with a Clock for the rest of the test."""
+    clock = Clock()
+    patcher = mock.patch.object(module.time, "monotonic", clock)
+    patcher.start()
+    test.addCleanup(patcher.stop)
+    return clock
+
+
+class FakeRedis:
+    """The subset of redis-py RedisBackend uses, with expiry on a Clock."""
+
+    def __init__(self, clock: Clock):
+        self.clock = clock
+        self.keys = {}
+
+    def set(self, name, value, nx=False, ex=None):
+        expires_at = self.keys.get(name)
+        if nx and expires_at is not None and expires_at > self.clock():
+            return None
+        self.keys[name] = self.clock() + ex
+        return True
+
+
+class GeminiError(Exception):
+    def __init__(self, code):
+        super().__init__(f"{code} error")
+        self.code = code
+
+
+def set_config(test, **values):
+    """Stores Config rows for one test. They roll back with the test, so the cache is dropped afterwards too."""
+    for name, value in values.items():
+        Config.objects.update_or_create(name=name, defaults={"value": str(value)})
+    test.addCleanup(config_cache.invalidate)
+
+
+def gemini_response(text: str):
+    """A generate_content response with just the fields the views read."""
+    return mock.Mock(text=text, usage_metadata=None)
+
+
+# --- System Prompt ---
+
+class SystemPromptCacheTests(TestCase):
+
+    def setUp(self):
+        self.clock = patch_clock(self, sys_prompt)
+        patcher = mock.patch.dict(sys_prompt._cache, prompt=None, version=None, fingerprint=None, checked_at=0.0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        SystemPrompt.objects.create(name="rules", prompt="Be polite.")
+
+    def test_prompt_is_built_once_within_the_ttl(self):
+        with mock.patch.object(sys_prompt, "build_prompt", wraps=sys_prompt.build_prompt) as build:
+            first = sys_prompt.get_prompt_with_version()
+            with self.assertNumQueries(0):
+                self.assertEqual(sys_prompt.get_prompt_with_version(), first)
+        self.assertEqual(first[0], "Be polite.")
+        build.assert_called_once()
+
+    def test_unchanged_sources_are_not_rebuilt_after_the_ttl(self):
+        sys_prompt.get_prompt_with_version()
+        self.clock.now += sys_prompt.PROMPT_CACHE_TTL + 1
+        with mock.patch.object(sys_prompt, "build_prompt") as build:
+            sys_prompt.get_prompt_with_version()
+        build.assert_not_called()
+
+    def test_change_from_another_process_is_picked_up_after_the_ttl(self):
+        _, version = sys_prompt.get_prompt_with_version()
+        # A queryset update sends no signal, like a save in another process
+        SystemPrompt.objects.update(prompt="Be brief.", updated_at=timezone.now() + timedelta(seconds=1))
+        self.assertEqual(sys_prompt.get_prompt_with_version()[1], version)
+        self.clock.now += sys_prompt.PROMPT_CACHE_TTL + 1
+        prompt, new_version = sys_prompt.get_prompt_with_version()
+        self.assertEqual(prompt, "Be brief.")
+        self.assertNotEqual(new_version, version)
+
+    def test_save_in_this_process_invalidates_at_once(self):
+        _, version = sys_prompt.get_prompt_with_version()
+        SystemPrompt.objects.create(name="tone", prompt="Use emoji.")
+        self.assertNotEqual(sys_prompt.get_prompt_with_version()[1], version)
+
+
+class PromptContextCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = patch_clock(self, context_cache)
+        self.ttl = 600
+        patchers = [
+            mock.patch.object(context_cache, "get_client"),
+            mock.patch.object(context_cache.config_cache, "get_int", lambda name, default=None: self.ttl),
+        ]
+        self.caches = patchers[0].start().return_value.caches
+        for patcher in patchers[1:]:
+            patcher.start()
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        self.caches.create.side_effect = self.create
+        self.cache = PromptContextCache()
+
+    def create(self, **kwargs):
+        cached = mock.Mock()
+        cached.name = f"cachedContents/{self.caches.create.call_count}"
+        return cached
+
+    def get(self, version: str = "v1") -> str | None:
+        return self.cache.get_cached_content("key", "flash", "Be polite.", version)
+
+    def test_prompt_is_cached_once_per_key_and_model(self):
+        self.assertEqual(self.get(), "cachedContents/1")
+        self.assertEqual(self.get(), "cachedContents/1")
+        self.caches.create.assert_called_once()
+        self.assertEqual(self.cache.get_cached_content("key", "pro", "Be polite.", "v1"), "cachedContents/2")
+
+    def test_entry_is_refreshed_before_it_expires(self):
+        self.get()
+        # The refresh margin is a tenth of the TTL, but at least a minute
+        self.clock.now += self.ttl - 59
+        self.assertEqual(self.get(), "cachedContents/1")
+        self.caches.update.assert_called_once()
+        self.caches.create.assert_called_once()
+
+    def test_failed_refresh_creates_a_new_entry(self):
+        self.get()
+        self.caches.update.side_effect = RuntimeError("gone")
+        self.clock.now += self.ttl - 59
+        self.assertEqual(self.get(), "cachedContents/2")
+        self.caches.delete.assert_called_once_with(name="cachedContents/1")
+
+    def test_new_prompt_version_replaces_and_deletes_the_old_entry(self):
+        self.get("v1")
+        self.assertEqual(self.get("v2"), "cachedContents/2")
+        self.caches.delete.assert_called_once_with(name="cachedContents/1")
+
+    def test_refused_prompt_is_sent_inline_until_the_backoff_ends(self):
+        self.caches.create.side_effect = RuntimeError("too small")
+        self.assertIsNone(self.get())
+        self.assertIsNone(self.get())
+        self.caches.create.assert_called_once()
+        self.clock.now += context_cache.FAILURE_BACKOFF + 1
+        self.get()
+        self.assertEqual(self.caches.create.call_count, 2)
+
+    def test_busy_key_does_not_wait_for_the_other_request(self):
+        self.cache._busy.add(("key", "flash"))
+        self.assertIsNone(self.get())
+        self.caches.create.assert_not_called()
+
+
+# --- Dedup ---
+
+class DedupStoreTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = patch_clock(self, dedup)
+
+    def test_second_sighting_is_a_duplicate(self):
+        store = DedupStore(MemoryBackend(), ttl=60)
+        self.assertFalse(store.is_duplicate("m1"))
+        self.assertTrue(store.is_duplicate("m1"))
+        self.assertEqual((store.hits, store.misses), (1, 1))
+
+    def test_local_entries_expire_after_ttl(self):
+        store = DedupStore(MemoryBackend(), ttl=60)
+        store.is_duplicate("m1")
+        self.clock.now += 61
+        self.assertFalse(store.is_duplicate("m1"))
+
+    def test_least_recently_seen_entry_is_evicted(self):
+        store = DedupStore(MemoryBackend(), ttl=60, max_entries=2)
+        store.is_duplicate("m1")
+        store.is_duplicate("m2")
+        store.is_duplicate("m1")  # refreshes m1, so m2 is the oldest
+        store.is_duplicate("m3")
+        self.assertEqual(store.evictions, 1)
+        self.assertTrue(store.is_duplicate("m1"))
+        self.assertFalse(store.is_duplicate("m2"))
+
+    def test_backend_failure_lets_the_message_through(self):
+        backend = mock.Mock()
+        backend.claim.side_effect = ConnectionError("down")
+        store = DedupStore(backend, ttl=60)
+        self.assertFalse(store.is_duplicate("m1"))
+        self.assertEqual(store.errors, 1)
+
+    def test_redis_backend_shares_claims_between_stores(self):
+        redis = FakeRedis(self.clock)
+        first = DedupStore(RedisBackend(redis), ttl=60)
+        second = DedupStore(RedisBackend(redis), ttl=60)
+        self.assertFalse(first.is_duplicate("m1"))
+        # A different worker has no local entry, the backend catches it
+        self.assertTrue(second.is_duplicate("m1"))
+        self.assertIn("mbot:mid:m1", redis.keys)
+
+    def test_redis_claim_expires_with_ttl(self):
+        backend = RedisBackend(FakeRedis(self.clock))
+        self.assertTrue(backend.claim("m1", 60))
+        self.assertFalse(backend.claim("m1", 60))
+        self.clock.now += 61
+        self.assertTrue(backend.claim("m1", 60))
+
+
+class DatabaseBackendTests(TestCase):
+
+    def test_first_claim_wins_until_the_row_expires(self):
+        backend = DatabaseBackend()
+        self.assertTrue(backend.claim("m1", 60))
+        self.assertFalse(backend.claim("m1", 60))
+        ProcessedMessage.objects.update(expires_at=timezone.now() - timedelta(seconds=1))
+        # An expired row is taken over, once
+        self.assertTrue(backend.claim("m1", 60))
+        self.assertFalse(backend.claim("m1", 60))
+
+
+# --- Message Storage ---
+
+class MessageStorageTests(TestCase):
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(sender_id="u1")
+
+    def append(self, *contents) -> int:
+        return self.conversation.append_messages([{"role": "user", "content": c} for c in contents])
+
+    def test_appended_messages_get_consecutive_seqs(self):
+        self.assertEqual(self.append("a", "b"), 1)
+        self.assertEqual(self.append("c"), 3)
+        self.assertIsNone(self.conversation.append_messages([]))
+        self.assertEqual(list(self.conversation.messages.values_list("seq", "content")), [(1, "a"), (2, "b"), (3, "c")])
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.message_count, self.conversation.preview), (3, "user: c"))
+
+    def test_get_messages_returns_the_last_ones_oldest_first(self):
+        self.append("a", "b", "c")
+        self.assertEqual([m["content"] for m in self.conversation.get_messages()], ["a", "b", "c"])
+        self.assertEqual(self.conversation.get_messages(limit=2, with_seq=True), [
+            {"seq": 2, "role": "user", "content": "b"}, {"seq": 3, "role": "user", "content": "c"},
+        ])
+        self.assertEqual(json.loads(self.conversation.get_history())[0], {"role": "user", "content": "a"})
+
+    def stale_aggregate(self, conflicts: int):
+        """Makes the first `conflicts` reads of the last seq miss the newest message, like a racing writer."""
+        real_aggregate = QuerySet.aggregate
+        stale = iter([{"last": 1}] * conflicts)
+
+        def aggregate(queryset, *args, **kwargs):
+            return next(stale, None) or real_aggregate(queryset, *args, **kwargs)
+
+        return mock.patch.object(QuerySet, "aggregate", autospec=True, side_effect=aggregate)
+
+    def test_seq_conflict_is_retried_with_a_fresh_seq(self):
+        self.append("a", "b")
+        with self.stale_aggregate(conflicts=2):
+            self.assertEqual(self.append("c"), 3)
+        self.assertEqual(list(self.conversation.messages.values_list("seq", "content")), [(1, "a"), (2, "b"), (3, "c")])
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 3)
+
+    def test_seq_conflict_is_raised_after_three_attempts(self):
+        self.append("a", "b")
+        with self.stale_aggregate(conflicts=3), self.assertRaises(IntegrityError):
+            self.append("c")
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.message_count, 2)
+
+
+class HistoryToMessagesMigrationTests(TransactionTestCase):
+    """0007 moves each history blob into Message rows and merges duplicate conversations."""
+
+    before = [("core", "0006_processedmessage")]
+    after = [("core", "0007_message")]
+
+    def setUp(self):
+        self.executor = MigrationExecutor(connection)
+        self.addCleanup(self.migrate, self.executor.loader.graph.leaf_nodes())
+        self.migrate(self.before)
+
+    def migrate(self, targets):
+        self.executor.loader.build_graph()
+        self.executor.migrate(targets)
+        return self.executor.loader.project_state(targets).apps
+
+    def test_histories_are_split_merged_and_restored(self):
+        apps = self.executor.loader.project_state(self.before).apps
+        OldConversation = apps.get_model("core", "Conversation")
+        first = OldConversation.objects.create(sender_id="dup", history=json.dumps([
+            {"role": "user", "content": "a"}, {"role": "assistant", "content": "b"},
+        ]))
+        OldConversation.objects.create(sender_id="dup", history=json.dumps([{"role": "user", "content": "c"}]))
+        OldConversation.objects.create(sender_id="broken", history="not json")
+        OldConversation.objects.create(sender_id="object", history='{"role": "user"}')
+        OldConversation.objects.create(sender_id="odd", history=json.dumps([
+            "plain", {"role": "a-role-longer-than-twenty-chars", "content": {"x": 1}}, {"role": "user"},
+        ]))
+
+        apps = self.migrate(self.after)
+        NewConversation = apps.get_model("core", "Conversation")
+        Message = apps.get_model("core", "Message")
+        self.assertEqual(sorted(NewConversation.objects.values_list("sender_id", flat=True)), [
+            "broken", "dup", "object", "odd",
+        ])
+        # Duplicates are merged into the oldest conversation, their histories in order
+        self.assertEqual(NewConversation.objects.get(sender_id="dup").pk, first.pk)
+        self.assertEqual(list(Message.objects.filter(conversation_id=first.pk).values_list("seq", "role", "content")), [
+            (1, "user", "a"), (2, "assistant", "b"), (3, "user", "c"),
+        ])
+        # Blobs that are not a JSON list keep their conversation but give no messages
+        self.assertFalse(Message.objects.filter(conversation__sender_id__in=["broken", "object"]).exists())
+        self.assertEqual(list(Message.objects.filter(conversation__sender_id="odd").values_list("role", "content")), [
+            ("unknown", "plain"), ("a-role-longer-than-t", '{"x": 1}'), ("unknown", '{"role": "user"}'),
+        ])
+
+        apps = self.migrate(self.before)
+        OldConversation = apps.get_model("core", "Conversation")
+        self.assertEqual(json.loads(OldConversation.objects.get(sender_id="dup").history), [
+            {"role": "user", "content": "a"}, {"role": "assistant", "content": "b"}, {"role": "user", "content": "c"},
+        ])
+        self.assertEqual(OldConversation.objects.get(sender_id="broken").history, "[]")
+
+
+# --- Coalescing ---
+
+class SenderCoalescerTests(SimpleTestCase):
+
+    def test_without_window_each_submit_is_its_own_batch(self):
+        coalescer = SenderCoalescer()
+        batches = []
+        handler = lambda sender_id, events: batches.append((sender_id, events)) or True
+        self.assertTrue(coalescer.submit("a", [1], 0, handler))
+        self.assertTrue(coalescer.submit("a", [2], 0, handler))
+        self.assertEqual(batches, [("a", [1]), ("a", [2])])
+
+    def test_events_within_the_window_join_the_open_batch(self):
+        coalescer = SenderCoalescer()
+        batches = []
+        leader = threading.Thread(target=coalescer.submit, args=("a", [1], 0.2, lambda s, e: batches.append(e)))
+        leader.start()
+        time.sleep(0.05)
+        # Joining callers return at once, their events go out with the leader's batch
+        self.assertIsNone(coalescer.submit("a", [2], 0.2, lambda s, e: batches.append(e)))
+        self.assertIsNone(coalescer.submit("a", [3], 0.2, lambda s, e: batches.append(e)))
+        leader.join()
+        self.assertEqual(batches, [[1, 2, 3]])
+
+    def test_batches_of_one_sender_never_overlap(self):
+        coalescer = SenderCoalescer()
+        running, overlaps, batches = [], [], []
+        started = threading.Event()
+
+        def handler(sender_id, events):
+            if running:
+                overlaps.append(events)
+            running.append(events)
+            started.set()
+            time.sleep(0.1)
+            running.pop()
+            batches.append(events)
+
+        first = threading.Thread(target=coalescer.submit, args=("a", [1], 0, handler))
+        first.start()
+        started.wait()
+        # Arrives mid-batch: waits for the sender lock and starts the next batch
+        coalescer.submit("a", [2], 0, handler)
+        first.join()
+        self.assertEqual(overlaps, [])
+        self.assertEqual(batches, [[1], [2]])
+        self.assertEqual(coalescer._sender_locks, {})
+
+
+# --- Router ---
+
+class ModelRouterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = patch_clock(self, router_module)
+        self.router = ModelRouter(["pro", "flash"])
+
+    def test_every_healthy_key_is_tried_on_a_model_before_the_next(self):
+        candidates = self.router.candidates(["k1", "k2"])
+        self.assertEqual([model for _, model in candidates], ["pro", "pro", "flash", "flash"])
+        self.assertEqual({key for key, _ in candidates[:2]}, {"k1", "k2"})
+
+    def test_rate_limited_pair_moves_to_the_end_until_its_cooldown_ends(self):
+        self.router.begin("k1", "pro")
+        self.router.record_failure("k1", "pro", GeminiError(429))
+        self.assertEqual(self.router.candidates(["k1"]), [("k1", "flash"), ("k1", "pro")])
+        self.clock.now += router_module.RATE_LIMIT_COOLDOWN + 1
+        self.assertEqual(self.router.candidates(["k1"]), [("k1", "pro"), ("k1", "flash")])
+
+    def test_cooldown_doubles_per_consecutive_failure_up_to_the_cap(self):
+        for attempt in range(1, 12):
+            self.router.record_failure("k1", "pro", GeminiError(503))
+            expected = min(router_module.MAX_COOLDOWN, router_module.SERVER_ERROR_COOLDOWN * 2 ** (attempt - 1))
+            self.assertEqual(self.router.state("k1")[0]["cooldown"], expected)
+
+    def test_invalid_replies_cool_down_only_once_they_repeat(self):
+        for _ in range(router_module.FAILURE_THRESHOLD - 1):
+            self.router.record_failure("k1", "pro")
+        self.assertEqual(self.router.state("k1")[0]["cooldown"], 0)
+        self.router.record_failure("k1", "pro")
+        expected = router_module.FAILURE_COOLDOWN * 2 ** (router_module.FAILURE_THRESHOLD - 1)
+        self.assertEqual(self.router.state("k1")[0]["cooldown"], expected)
+
+    def test_success_and_reset_clear_the_cooldown(self):
+        self.router.record_failure("k1", "pro", GeminiError(429))
+        self.router.record_success("k1", "pro", 1.0)
+        self.assertEqual(self.router.state("k1")[0]["cooldown"], 0)
+        self.router.record_failure("k2", "pro", GeminiError(429))
+        self.router.reset("k2")
+        self.assertEqual(self.router.candidates(["k2"])[0], ("k2", "pro"))
+
+    def test_less_loaded_key_goes_first(self):
+        self.router.begin("k1", "pro")
+        for _ in range(4):
+            self.assertEqual(self.router.candidates(["k1", "k2"])[0], ("k2", "pro"))
+
+
+# --- Hedging ---
+
+class HedgedReplyTests(SimpleTestCase):
+
+    def setUp(self):
+        self.settings = {"hedge_max": 1}
+        patchers = [
+            mock.patch.object(hedge, "hedge_stats", hedge.HedgeStats()),
+            mock.patch.object(hedge.config_cache, "get", lambda name, default=None: self.settings.get(name, default)),
+            mock.patch.object(hedge.config_cache, "get_int", lambda name, default=None: self.settings.get(name, default)),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.release = threading.Event()
+        self.addCleanup(self.release.set)
+        self.calls = []
+
+    def process(self, history, model, key):
+        """Model "slow" hangs until the test ends, "bad" gives no reply, the rest answer at once."""
+        self.calls.append(model)
+        if model == "slow":
+            self.release.wait(5)
+        return [] if model == "bad" else [{"text": model}]
+
+    def test_hedge_delay_from_config(self):
+        pairs = [("k", "pro"), ("k", "flash")]
+        self.assertIsNone(hedge.get_hedge_delay(pairs))
+        self.settings["hedge_after"] = "2.5"
+        self.assertEqual(hedge.get_hedge_delay(pairs), 2.5)
+        self.assertIsNone(hedge.get_hedge_delay(pairs[:1]))
+        self.settings["hedge_after"] = "p95"
+        self.assertEqual(hedge.get_hedge_delay([("unseen", "pro"), ("k", "flash")]), hedge.DEFAULT_HEDGE_AFTER)
+        self.settings["hedge_after"] = "soon"
+        self.assertIsNone(hedge.get_hedge_delay(pairs))
+
+    def test_fast_primary_is_not_hedged(self):
+        self.assertEqual(hedge.hedged_reply([], [("k", "pro"), ("k", "flash")], self.process, 1.0), [{"text": "pro"}])
+        self.assertEqual(self.calls, ["pro"])
+        self.assertEqual(hedge.hedge_stats.stats()["hedges"], 0)
+
+    def test_slow_primary_is_hedged_and_the_first_reply_wins(self):
+        reply = hedge.hedged_reply([], [("k", "slow"), ("k", "flash"), ("k", "pro")], self.process, 0.01)
+        self.assertEqual(reply, [{"text": "flash"}])
+        self.assertEqual(self.calls, ["slow", "flash"])
+        stats = hedge.hedge_stats.stats()
+        self.assertEqual((stats["hedges"], stats["hedge_wins"], stats["wasted_requests"]), (1, 1, 1))
+
+    def test_failed_attempt_falls_back_to_the_next_pair(self):
+        reply = hedge.hedged_reply([], [("k", "bad"), ("k", "pro")], self.process, 1.0)
+        self.assertEqual(reply, [{"text": "pro"}])
+        self.assertEqual(hedge.hedge_stats.stats()["hedges"], 0)
+
+    def test_async_losing_attempt_is_cancelled(self):
+        cancelled = []
+
+        async def process(history, model, key):
+            if model == "slow":
+                try:
+                    await asyncio.sleep(5)
+                except asyncio.CancelledError:
+                    cancelled.append(model)
+                    raise
+            return [{"text": model}]
+
+        reply = asyncio.run(hedge.async_hedged_reply([], [("k", "slow"), ("k", "flash")], process, 0.01, 1))
+        self.assertEqual(reply, [{"text": "flash"}])
+        self.assertEqual(cancelled, ["slow"])
+
+
+# --- Media ---
+
+def media_response(data: bytes, content_type: str = "image/jpeg", length: int | None = None):
+    """A streamed requests response for an attachment download."""
+    response = mock.MagicMock()
+    response.__enter__.return_value = response
+    response.headers = {"Content-Type": content_type, "Content-Length": str(len(data) if length is None else length)}
+    response.iter_content.side_effect = lambda size: [data[i:i + size] for i in range(0, len(data), size)]
+    return response
+
+
+class MediaTests(TestCase):
+
+    def setUp(self):
+        patchers = [
+            mock.patch.object(media._session, "get"),
+            mock.patch.object(media, "describe_media", return_value="a red shirt"),
+        ]
+        self.get, self.describe = [patcher.start() for patcher in patchers]
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+        self.get.return_value = media_response(b"photo")
+
+    def image(self, url: str) -> dict:
+        return {"type": "image", "payload": {"url": url}}
+
+    def test_description_is_cached_by_content_hash(self):
+        self.assertEqual(media.process_media("https://cdn/a.jpg"), "a red shirt")
+        # The same bytes under another URL, e.g. a forwarded photo
+        self.get.return_value = media_response(b"photo")
+        self.assertEqual(media.process_media("https://cdn/b.jpg"), "a red shirt")
+        self.describe.assert_called_once_with(b"photo", "image/jpeg", media.DEFAULT_MEDIA_PROMPT)
+        self.assertEqual(MediaDescription.objects.get().sha256, hashlib.sha256(b"photo").hexdigest())
+
+    def test_custom_prompt_is_not_cached(self):
+        media.process_media("https://cdn/a.jpg", prompt="Read the text.")
+        self.get.return_value = media_response(b"photo")
+        media.process_media("https://cdn/a.jpg", prompt="Read the text.")
+        self.assertEqual(self.describe.call_count, 2)
+        self.assertFalse(MediaDescription.objects.exists())
+
+    def test_mime_type_falls_back_to_the_url(self):
+        self.get.return_value = media_response(b"clip", content_type="application/octet-stream")
+        media.process_media("https://cdn/clip.mp4?token=x")
+        self.assertEqual(self.describe.call_args.args[1], "video/mp4")
+
+    def test_oversized_attachment_is_not_described(self):
+        self.get.return_value = media_response(b"photo", length=media.MEDIA_MAX_BYTES + 1)
+        self.assertEqual(media.describe_attachments([self.image("https://cdn/big.jpg")]), [
+            '>user sent an "image" too large to be seen',
+        ])
+        # Without a Content-Length the download stops once it passes the cap
+        with mock.patch.object(media, "MEDIA_MAX_BYTES", 3):
+            self.get.return_value = media_response(b"photo", length=0)
+            self.assertIn("too large", media.describe_attachments([self.image("https://cdn/big.jpg")])[0])
+        self.describe.assert_not_called()
+
+    def test_stickers_and_broken_attachments(self):
+        self.assertEqual(media.describe_attachments([
+            {"type": "image", "payload": {"sticker_id": media.THUMBS_UP_STICKER_ID}},
+        ]), [">thumbsup sticker"])
+        self.assertEqual(media.describe_attachments([{"type": "file", "payload": {}}]), [
+            '>user sent an "file" can\'t be seen',
+        ])
+
+    def test_attachments_are_described_together_in_order(self):
+        with mock.patch.object(media, "process_media", side_effect=lambda url: url.rsplit("/", 1)[1]) as process:
+            descriptions = media.describe_attachments([self.image("https://cdn/1"), self.image("https://cdn/2")])
+        self.assertEqual(descriptions, [
+            '>user sent an "image" which may have: 1', '>user sent an "image" which may have: 2',
+        ])
+        self.assertEqual(process.call_count, 2)
+
+
+# --- Context ---
+
+def padded(text: str) -> str:
+    """36 ASCII characters, which context.message_tokens counts as 14 tokens."""
+    return text.ljust(36, ".")
+
+
+class BuildContextTests(TestCase):
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(sender_id="u1", summary=padded("summary"))
+        self.conversation.append_messages([{"role": "user", "content": padded(f"m{i}")} for i in range(1, 11)])
+        patcher = mock.patch.object(context, "schedule_summary")
+        self.schedule = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def context_for(self, *new_turns, **config) -> list:
+        set_config(self, **config)
+        history, first_seq = context.load_history(self.conversation)
+        stored_count = len(history)
+        history += [{"role": "user", "content": turn} for turn in new_turns]
+        window = context.build_context(self.conversation, history, first_seq, stored_count)
+        return [m["content"].rstrip(".") for m in window]
+
+    def test_newest_messages_fill_the_budget_behind_the_summary(self):
+        self.assertEqual(context.message_tokens({"role": "user", "content": padded("m1")}), 14)
+        # Summary, new turn and two stored messages are 56 tokens, a third would be 70
+        self.assertEqual(self.context_for(padded("new"), context_tokens=64, context_trim_step=1), [
+            "summary", "m9", "m10", "new",
+        ])
+
+    def test_window_start_is_aligned_up_to_the_trim_step(self):
+        # The budget reaches back to m8, aligning to seq 4k + 1 trims it to m9
+        self.assertEqual(self.context_for(padded("new"), context_tokens=78, context_trim_step=4), [
+            "summary", "m9", "m10", "new",
+        ])
+
+    def test_new_turns_are_kept_even_over_the_budget(self):
+        self.assertEqual(self.context_for(padded("a"), padded("b"), context_tokens=20, context_trim_step=1), [
+            "summary", "a", "b",
+        ])
+
+    def test_summary_is_scheduled_once_enough_messages_dropped_out(self):
+        self.context_for(padded("new"), context_tokens=64, context_trim_step=1, summary_batch=9)
+        self.schedule.assert_not_called()
+        self.context_for(padded("new"), context_tokens=64, context_trim_step=1, summary_batch=8)
+        self.schedule.assert_called_once_with(self.conversation.pk, 8)
+
+
+class RememberWindowTests(TestCase):
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(sender_id="u1")
+        self.conversation.append_messages([{"role": "user", "content": f"m{i}"} for i in range(1, 24)])
+
+    def context_for(self, *new_turns, **config) -> list:
+        set_config(self, **config)
+        history, first_seq = context.load_history(self.conversation)
+        stored_count = len(history)
+        history += [{"role": "user", "content": turn} for turn in new_turns]
+        return [m["content"] for m in context.build_context(self.conversation, history, first_seq, stored_count)]
+
+    def test_window_never_exceeds_remember(self):
+        for count in range(1, 24):
+            Message.objects.filter(conversation=self.conversation, seq__gt=count).delete()
+            window = self.context_for("new", remember=20, context_trim_step=10)
+            self.assertLessEqual(len(window), 20)
+            self.assertEqual(window[-1], "new")
+
+    def test_window_start_moves_a_trim_step_at_a_time(self):
+        # 23 stored + 1 new: the last 20 start at m5, aligning up moves that to m11
+        self.assertEqual(self.context_for("new", remember=20, context_trim_step=10)[0], "m11")
+        self.conversation.append_messages([{"role": "user", "content": "m24"}, {"role": "user", "content": "m25"}])
+        self.assertEqual(self.context_for("new", remember=20, context_trim_step=10)[0], "m11")
+        self.assertEqual(self.context_for("new", remember=20, context_trim_step=1)[0], "m7")
+
+    def test_new_turns_are_kept_when_remember_is_below_the_step(self):
+        self.assertEqual(self.context_for("a", "b", remember=3, context_trim_step=10), ["a", "b"])
+
+
+class UpdateSummaryTests(TestCase):
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(sender_id="u1", summary="Asked about shoes.", summary_seq=2)
+        self.conversation.append_messages([
+            {"role": "user", "content": "shoes?"}, {"role": "assistant", "content": "Yes."},
+            {"role": "user", "content": "size 42"}, {"role": "assistant", "content": "In stock."},
+            {"role": "user", "content": "price?"},
+        ])
+        patcher = mock.patch.object(context, "get_client")
+        self.gemini = patcher.start().return_value.models
+        self.addCleanup(patcher.stop)
+        self.gemini.generate_content.return_value = gemini_response(" Wants size 42 shoes, in stock. ")
+
+    def test_messages_after_summary_seq_are_folded_in(self):
+        context._scheduled.add(self.conversation.pk)
+        context.update_summary(self.conversation.pk, 4)
+        prompt = self.gemini.generate_content.call_args.kwargs["contents"]
+        self.assertIn("Current summary:\nAsked about shoes.", prompt)
+        self.assertIn("New messages:\nuser: size 42\nassistant: In stock.", prompt)
+        self.assertNotIn("price?", prompt)
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.summary, self.conversation.summary_seq), ("Wants size 42 shoes, in stock.", 4))
+        self.assertNotIn(self.conversation.pk, context._scheduled)
+
+    def test_summary_already_past_upto_seq_is_left_alone(self):
+        context.update_summary(self.conversation.pk, 2)
+        self.gemini.generate_content.assert_not_called()
+
+    def test_empty_summary_is_not_saved(self):
+        self.gemini.generate_content.return_value = gemini_response("  ")
+        context.update_summary(self.conversation.pk, 4)
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.summary, self.conversation.summary_seq), ("Asked about shoes.", 2))
+
+    def test_summary_moved_on_by_another_run_is_not_overwritten(self):
+        def generate_content(**kwargs):
+            Conversation.objects.filter(pk=self.conversation.pk).update(summary="Newer.", summary_seq=5)
+            return gemini_response("Older.")
+
+        self.gemini.generate_content.side_effect = generate_content
+        context.update_summary(self.conversation.pk, 4)
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.summary, self.conversation.summary_seq), ("Newer.", 5))
+
+    def test_one_run_folds_at_most_summary_max_messages(self):
+        with mock.patch.object(context, "SUMMARY_MAX_MESSAGES", 1):
+            context.update_summary(self.conversation.pk, 5)
+        self.conversation.refresh_from_db()
+        self.assertEqual(self.conversation.summary_seq, 3)
+
+
+# --- Metrics ---
+
+class RegistryTests(SimpleTestCase):
+
+    def test_counter_help_and_type_name_the_sample_family(self):
+        registry = metrics.Registry()
+        counter = registry.register(metrics.Counter("mbot_things", "Things.", ("kind",)))
+        counter.inc(kind='a "b"')
+        counter.inc(2, kind='a "b"')
+        self.assertEqual(registry.render().splitlines(), [
+            "# HELP mbot_things_total Things.",
+            "# TYPE mbot_things_total counter",
+            'mbot_things_total{kind="a \\"b\\""} 3',
+        ])
+
+    def test_histogram_buckets_are_cumulative(self):
+        registry = metrics.Registry()
+        histogram = registry.register(metrics.Histogram("mbot_wait_seconds", "Waits.", buckets=(1, 5)))
+        for value in (0.5, 2, 10):
+            histogram.observe(value)
+        self.assertEqual(registry.render().splitlines()[1:], [
+            "# TYPE mbot_wait_seconds histogram",
+            'mbot_wait_seconds_bucket{le="1.0"} 1',
+            'mbot_wait_seconds_bucket{le="5.0"} 2',
+            'mbot_wait_seconds_bucket{le="+Inf"} 3',
+            "mbot_wait_seconds_sum 12.5",
+            "mbot_wait_seconds_count 3",
+        ])
+
+    def test_numeric_stats_are_exported_as_gauges(self):
+        rendered = metrics.Registry().render({"mbot_pool": {"size": 3, "hit_rate": 0.5, "backend": "db", "on": True}})
+        self.assertEqual(rendered.splitlines(), [
+            "# TYPE mbot_pool_size gauge", "mbot_pool_size 3",
+            "# TYPE mbot_pool_hit_rate gauge", "mbot_pool_hit_rate 0.5",
+        ])
+
+
+# --- Answer Cache ---
+
+class AnswerCacheTests(TestCase):
+
+    def setUp(self):
+        self.clock = patch_clock(self, answer_cache_module)
+        set_config(self, answer_cache="on", answer_cache_skip="order\n\\d{5,}")
+        self.cache = AnswerCache(max_entries=2)
+
+    def key(self, *messages) -> str | None:
+        return self.cache.key([{"role": role, "content": content} for role, content in messages])
+
+    def test_normalize_folds_case_width_and_punctuation(self):
+        self.assertEqual(normalize("  What's the PRICE?? "), "what s the price")
+        self.assertEqual(normalize("ＰＲＩＣＥ！"), "price")
+        # Bengali vowel signs are combining marks and must survive
+        self.assertEqual(normalize("দাম কত?"), "দাম কত")
+
+    def test_equivalent_questions_share_a_key(self):
+        self.assertEqual(self.key(("user", "Price?")), self.key(("user", "  price ")))
+        self.assertNotEqual(self.key(("user", "Price?")), self.key(("user", "Size?")))
+
+    def test_key_depends_on_the_previous_message_but_not_the_summary(self):
+        question = ("user", "How much?")
+        self.assertNotEqual(self.key(("assistant", "Red shirt."), question), self.key(("assistant", "Blue shirt."), question))
+        self.assertEqual(self.key(("summary", "Asked about shirts."), question), self.key(question))
+
+    def test_key_changes_with_the_prompt(self):
+        first = self.key(("user", "Price?"))
+        SystemPrompt.objects.create(name="rules", prompt="Prices went up.")
+        self.assertNotEqual(self.key(("user", "Price?")), first)
+
+    def test_uncacheable_contexts_have_no_key(self):
+        self.assertIsNone(self.key(("assistant", "Hi")))
+        self.assertIsNone(self.key(("user", "?!")))
+        self.assertIsNone(self.key(("user", "Where is my ORDER?")))
+        self.assertIsNone(self.key(("user", "Tracking 123456")))
+        self.assertIsNone(self.cache.key([]))
+        self.assertEqual(self.cache.skips, 3)
+
+    def test_entries_expire_and_the_least_recently_used_is_evicted(self):
+        self.cache.put("a", [{"text": "A"}])
+        self.cache.put("b", [{"text": "B"}])
+        self.cache.put("empty", [])
+        self.assertEqual(self.cache.get("a"), [{"text": "A"}])
+        self.cache.put("c", [{"text": "C"}])
+        self.assertIsNone(self.cache.get("b"))
+        self.clock.now += 3601
+        self.assertIsNone(self.cache.get("a"))
+        self.assertEqual((self.cache.hits, self.cache.misses, self.cache.evictions), (1, 2, 1))
+
+    def test_cached_reply_key_is_none_when_the_cache_is_off(self):
+        self.assertIsNotNone(cached_reply_key([{"role": "user", "content": "Price?"}]))
+        set_config(self, answer_cache="off")
+        self.assertIsNone(cached_reply_key([{"role": "user", "content": "Price?"}]))
+
+
+# --- Logging ---
+
+class QueueHandlerTests(SimpleTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.handler = log.queue_handler(os.path.join(self.dir.name, "mbot.{pid}.log"))
+        self.addCleanup(self.handler.stop)
+        self.logger = logging.getLogger("core.tests.log")
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+
+    def lines(self, pid: int) -> list:
+        # Stopping the listener flushes the queue to the file
+        self.handler.stop()
+        with open(os.path.join(self.dir.name, f"mbot.{pid}.log"), encoding="utf-8") as f:
+            return [json.loads(line) for line in f]
+
+    def test_records_are_written_as_json_lines_with_the_correlation_id(self):
+        with log.correlation("mid-1"):
+            self.logger.warning("Hello %s", "there")
+        [line] = self.lines(os.getpid())
+        self.assertEqual((line["level"], line["message"], line["correlation_id"]), ("WARNING", "Hello there", "mid-1"))
+
+    def test_forked_process_writes_its_own_file(self):
+        # A real child has no copy of the parent's listener thread
+        self.addCleanup(self.handler._listener.stop)
+        with mock.patch.object(log.os, "getpid", return_value=424242):
+            self.logger.warning("from the child")
+            self.assertEqual([line["message"] for line in self.lines(424242)], ["from the child"])
+        self.assertFalse(os.path.exists(os.path.join(self.dir.name, f"mbot.{os.getpid()}.log")))
+
+    def test_content_is_sampled_per_correlation_id(self):
+        sampler = log.ContentSampler(rate=0.5)
+
+        def kept(cid: str, level: int = logging.INFO, content: bool = True) -> bool:
+            record = self.logger.makeRecord("core", level, __file__, 1, "text", None, None, extra={"content": content})
+            record.correlation_id = cid
+            return sampler.filter(record)
+
+        decisions = [kept(f"event-{i}") for i in range(200)]
+        # The user and model messages of one event are kept or dropped together
+        self.assertEqual(decisions, [kept(f"event-{i}") for i in range(200)])
+        self.assertTrue(60 < sum(decisions) < 140)
+        self.assertTrue(all(kept(f"event-{i}", level=logging.ERROR) for i in range(200)))
+        self.assertTrue(all(kept(f"event-{i}", content=False) for i in range(200)))
+
+
+# --- Archive ---
+
+class MessageArchiveTests(TestCase):
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(sender_id="u1")
+        self.conversation.append_messages([{"role": "user", "content": f"m{i}"} for i in range(1, 26)])
+
+    def seqs(self, messages: list) -> list:
+        return [m["seq"] for m in messages]
+
+    def archive_in_two_chunks(self):
+        self.assertEqual(self.conversation.archive_messages(keep=15), 10)
+        self.assertEqual(self.conversation.archive_messages(keep=10), 5)
+
+    def test_archive_keeps_the_last_keep_messages(self):
+        self.assertEqual(self.conversation.archive_messages(keep=15), 10)
+        self.assertEqual(list(self.conversation.archives.values_list("first_seq", "last_seq", "count")), [(1, 10, 10)])
+        self.assertEqual(self.conversation.messages.count(), 15)
+        self.conversation.refresh_from_db()
+        self.assertEqual((self.conversation.archived_seq, self.conversation.archived_count), (10, 10))
+
+    def test_keep_and_upto_seq_are_clamped(self):
+        self.assertEqual(self.conversation.archive_messages(keep=1, upto_seq=12), 12)
+        # Nothing new up to upto_seq, and keep never goes below one message
+        self.assertEqual(self.conversation.archive_messages(keep=0, upto_seq=12), 0)
+        self.assertEqual(self.conversation.archive_messages(keep=0), 12)
+        self.assertEqual(list(self.conversation.messages.values_list("seq", flat=True)), [25])
+        self.assertEqual(self.conversation.archive_messages(keep=0), 0)
+        self.assertEqual(self.conversation.archives.count(), 2)
+
+    def test_archived_messages_keep_their_content(self):
+        self.archive_in_two_chunks()
+        self.assertEqual(self.conversation.get_messages(), [{"role": "user", "content": f"m{i}"} for i in range(1, 26)])
+
+    def test_get_messages_limit_on_both_sides_of_the_boundary(self):
+        self.archive_in_two_chunks()
+        self.assertEqual(self.conversation.archived_count, 15)
+        for limit in range(1, 28):
+            with self.subTest(limit=limit):
+                messages = self.conversation.get_messages(limit=limit, with_seq=True)
+                self.assertEqual(self.seqs(messages), list(range(max(1, 26 - limit), 26)))
+                self.assertEqual(set(messages[0]), {"seq", "role", "content"})
+
+    def test_hot_reads_do_not_open_the_archive(self):
+        self.archive_in_two_chunks()
+        with self.assertNumQueries(1):
+            self.conversation.get_messages(limit=10)
+
+    def test_message_page_on_both_sides_of_the_boundary(self):
+        self.archive_in_two_chunks()
+        for offset in range(0, 27):
+            for limit in range(1, 27):
+                with self.subTest(offset=offset, limit=limit):
+                    page = self.conversation.get_message_page(offset, limit)
+                    self.assertEqual(self.seqs(page), list(range(offset + 1, min(25, offset + limit) + 1)))
+
+    def test_archive_conversation_stays_behind_the_summary(self):
+        set_config(self, context_tokens=1000, context_max_messages=5)
+        self.conversation.summary_seq = 8
+        self.assertEqual(archive.archive_conversation(self.conversation, keep=5), 8)
+        set_config(self, context_tokens=0, remember=10)
+        self.assertEqual(archive.archive_conversation(self.conversation, keep=5), 7)
+        self.assertEqual(self.conversation.messages.count(), 10)
+
+
+# --- Admission ---
+
+class SenderRateLimiterTests(SimpleTestCase):
+
+    def setUp(self):
+        self.clock = patch_clock(self, admission)
+        self.settings = {"sender_rate_per_minute": 6.0, "sender_burst": 2.0}
+        patcher = mock.patch.object(config_cache, "get_float", lambda name, default=None: self.settings.get(name, default))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_burst_then_refill_at_the_rate(self):
+        limiter = SenderRateLimiter()
+        self.assertEqual([limiter.allow("a") for _ in range(3)], [True, True, False])
+        self.clock.now += 10  # 6 per minute refills one token every 10s
+        self.assertEqual([limiter.allow("a") for _ in range(2)], [True, False])
+
+    def test_senders_have_separate_buckets(self):
+        limiter = SenderRateLimiter()
+        limiter.allow("a")
+        limiter.allow("a")
+        self.assertFalse(limiter.allow("a"))
+        self.assertTrue(limiter.allow("b"))
+
+    def test_tokens_never_exceed_the_burst(self):
+        limiter = SenderRateLimiter()
+        limiter.allow("a")
+        self.clock.now += 3600
+        self.assertEqual([limiter.allow("a") for _ in range(3)], [True, True, False])
+
+    def test_zero_rate_disables_the_limit(self):
+        self.settings["sender_rate_per_minute"] = 0
+        limiter = SenderRateLimiter()
+        self.assertTrue(all(limiter.allow("a") for _ in range(50)))
+
+    def test_forgotten_sender_starts_with_a_full_bucket(self):
+        limiter = SenderRateLimiter(max_senders=1)
+        limiter.allow("a")
+        limiter.allow("a")
+        limiter.allow("b")  # evicts a
+        self.assertTrue(limiter.allow("a"))
+
+
+class ConcurrencyLimiterTests(SimpleTestCase):
+
+    def test_callers_past_the_cap_wait_then_time_out(self):
+        limiter = ConcurrencyLimiter(max_in_flight=1, max_waiting=1, timeout=0.05)
+        self.assertTrue(limiter.acquire())
+        self.assertFalse(limiter.acquire())
+        self.assertEqual(limiter.stats()["waiting"], 0)
+        limiter.release()
+        self.assertTrue(limiter.acquire())
+
+    def test_released_slot_goes_to_a_waiting_caller(self):
+        limiter = ConcurrencyLimiter(max_in_flight=1, max_waiting=1, timeout=5)
+        limiter.acquire()
+        threading.Timer(0.05, limiter.release).start()
+        self.assertTrue(limiter.acquire())
+        self.assertEqual(limiter.stats()["in_flight"], 1)
+
+    def test_full_wait_queue_is_refused_at_once(self):
+        limiter = ConcurrencyLimiter(max_in_flight=1, max_waiting=0, timeout=5)
+        limiter.acquire()
+        start = time.monotonic()
+        self.assertFalse(limiter.acquire())
+        self.assertLess(time.monotonic() - start, 1)
+
+    def test_async_acquire_waits_for_a_release(self):
+        limiter = ConcurrencyLimiter(max_in_flight=1, max_waiting=1, timeout=5)
+        limiter.acquire()
+
+        async def wait_for_slot():
+            asyncio.get_running_loop().call_later(0.05, limiter.release)
+            return await limiter.async_acquire()
+
+        self.assertTrue(asyncio.run(wait_for_slot()))
+        self.assertEqual(limiter.stats()["waiting"], 0)
+
+
+class GeminiLimiterCoverageTests(TestCase):
+    """Media descriptions and summaries count against the same cap as replies."""
+
+    def setUp(self):
+        full = ConcurrencyLimiter(max_in_flight=0, max_waiting=0)
+        patchers = [
+            mock.patch.object(media, "gemini_limiter", full),
+            mock.patch.object(context, "gemini_limiter", full),
+            mock.patch.object(media, "get_client"),
+            mock.patch.object(context, "get_client"),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_media_is_not_described_past_the_cap(self):
+        with mock.patch.object(media._session, "get", return_value=media_response(b"photo")):
+            self.assertEqual(media.describe_attachments([{"type": "image", "payload": {"url": "https://cdn/a.jpg"}}]), [
+                '>user sent an "image" not described',
+            ])
+        media.get_client.assert_not_called()
+        self.assertFalse(MediaDescription.objects.exists())
+
+    def test_summary_is_skipped_past_the_cap(self):
+        conversation = Conversation.objects.create(sender_id="u1")
+        conversation.append_messages([{"role": "user", "content": "hi"}])
+        context.update_summary(conversation.pk, 1)
+        context.get_client.assert_not_called()
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.summary_seq, 0)
+
+
+# --- Events ---
+
+class EventClassificationTests(SimpleTestCase):
+
+    def test_each_event_type_is_named_from_its_fields(self):
+        sender = {"sender": {"id": "u1"}}
+        cases = [
+            ({"message": {"text": "hi"}}, "message"),
+            ({"message": {"attachments": [{"type": "image"}]}}, "message"),
+            ({"message": {"text": "hi", "is_echo": True}}, "echo"),
+            ({"message": {"mid": "m1"}}, "empty_message"),
+            ({"postback": {"payload": "START"}}, "postback"),
+            ({"delivery": {"mids": ["m1"]}}, "delivery"),
+            ({"read": {"watermark": 1}}, "read"),
+            ({"reaction": {"reaction": "love"}}, "reaction"),
+            ({"something_new": {}}, "other"),
+        ]
+        for fields, expected in cases:
+            with self.subTest(expected=expected):
+                self.assertEqual(classify_event({**sender, **fields}), expected)
+        self.assertEqual(classify_event({"message": {"text": "hi"}}), "no_sender")
+        self.assertEqual(classify_event({"sender": {}, "message": {"text": "hi"}}), "no_sender")
+
+    def test_split_events_groups_replyable_events_by_sender_in_order(self):
+        def event(sender_id, **fields):
+            return {"sender": {"id": sender_id}, **fields}
+
+        data = {"entry": [
+            {"messaging": [
+                event("a", message={"text": "1"}), event("b", read={"watermark": 1}), event("b", postback={"payload": "P"}),
+            ]},
+            {"messaging": [event("a", message={"text": "2", "is_echo": True}), event("a", message={"text": "3"})]},
+        ]}
+        before = {t: events.webhook_events.value(type=t) for t in ("message", "postback", "read", "echo")}
+        grouped = split_events(data)
+        self.assertEqual(list(grouped), ["a", "b"])
+        self.assertEqual([e["message"]["text"] for e in grouped["a"]], ["1", "3"])
+        self.assertEqual([e["postback"]["payload"] for e in grouped["b"]], ["P"])
+        self.assertEqual(
+            {t: events.webhook_events.value(type=t) - count for t, count in before.items()},
+            {"message": 2, "postback": 1, "read": 1, "echo": 1},
+        )
+        self.assertEqual(split_events({}), {})
+
+
+# --- Outbox ---
+
+class OutboxTests(TestCase):
+
+    def setUp(self):
+        self.conversation = Conversation.objects.create(sender_id="u1")
+        patcher = mock.patch.object(outbox, "delivery_worker")
+        self.worker = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def save(self, *texts):
+        messages = [{"role": "user", "content": "hi"}] + [{"role": "assistant", "content": t} for t in texts]
+        outbox.save_reply(self.conversation, messages, [{"text": t} for t in texts])
+
+    def test_reply_parts_are_keyed_by_their_message_seq(self):
+        self.save("a", "b")
+        self.assertEqual(
+            list(OutboxMessage.objects.values_list("seq", "message", "status")),
+            [(2, {"text": "a"}, "pending"), (3, {"text": "b"}, "pending")],
+        )
+        self.assertEqual(self.conversation.message_count, 3)
+
+    def test_parts_are_sent_in_order_and_only_once(self):
+        self.save("a", "b")
+        sent = []
+        send = lambda recipient, message: sent.append((recipient, message["text"])) or True
+        self.assertTrue(outbox.deliver(self.conversation, send))
+        self.assertTrue(outbox.deliver(self.conversation, send))
+        self.assertEqual(sent, [("u1", "a"), ("u1", "b")])
+        self.assertEqual(set(OutboxMessage.objects.values_list("status", flat=True)), {"sent"})
+
+    def test_failed_part_backs_off_and_holds_back_later_parts(self):
+        self.save("a", "b")
+        sent = []
+        self.assertFalse(outbox.deliver(self.conversation, lambda r, m: sent.append(m["text"]) and False))
+        self.worker.wake.assert_called_once()
+        first = OutboxMessage.objects.get(seq=2)
+        self.assertEqual((first.status, first.attempts), ("pending", 1))
+        self.assertGreater(first.next_attempt_at, timezone.now())
+        # Not due yet: nothing is sent, and "b" stays behind "a"
+        self.assertFalse(outbox.deliver(self.conversation, lambda r, m: sent.append(m["text"]) or True))
+        self.assertEqual(sent, ["a"])
+
+        OutboxMessage.objects.filter(seq=2).update(next_attempt_at=timezone.now())
+        self.assertTrue(outbox.deliver(self.conversation, lambda r, m: sent.append(m["text"]) or True))
+        self.assertEqual(sent, ["a", "a", "b"])
+
+    def test_backoff_doubles_up_to_the_cap(self):
+        with mock.patch.object(outbox.random, "uniform", return_value=1.0):
+            self.assertEqual([outbox.backoff(n) for n in (1, 2, 3)], [
+                outbox.OUTBOX_BACKOFF, outbox.OUTBOX_BACKOFF * 2, outbox.OUTBOX_BACKOFF * 4,
+            ])
+            self.assertEqual(outbox.backoff(100), outbox.OUTBOX_MAX_BACKOFF)
+
+    def test_part_gives_up_after_max_attempts(self):
+        self.save("a", "b")
+        part = OutboxMessage.objects.get(seq=2)
+        part.attempts = outbox.OUTBOX_MAX_ATTEMPTS - 1
+        self.assertTrue(outbox.claim(part))
+        outbox.finish(part, False)
+        self.assertEqual(OutboxMessage.objects.get(seq=2).status, "failed")
+        # A given-up part no longer blocks the rest of the reply
+        sent = []
+        self.assertTrue(outbox.deliver(self.conversation, lambda r, m: sent.append(m["text"]) or True))
+        self.assertEqual(sent, ["b"])
+
+    def test_only_one_worker_claims_a_part(self):
+        self.save("a")
+        first, second = outbox.undelivered(self.conversation.pk), outbox.undelivered(self.conversation.pk)
+        self.assertTrue(outbox.claim(first[0]))
+        self.assertFalse(outbox.claim(second[0]))
+
+    def test_sending_part_is_taken_over_after_its_lease(self):
+        self.save("a")
+        self.assertTrue(outbox.claim(outbox.undelivered(self.conversation.pk)[0]))
+        self.assertFalse(outbox.claim(outbox.undelivered(self.conversation.pk)[0]))
+        OutboxMessage.objects.update(claimed_at=timezone.now() - timedelta(seconds=outbox.OUTBOX_LEASE + 1))
+        self.assertTrue(outbox.claim(outbox.undelivered(self.conversation.pk)[0]))
+
+    def test_deliver_due_leaves_fresh_parts_to_their_request(self):
+        self.save("a")
+        sent = []
+        outbox.deliver_due(lambda r, m: sent.append(m["text"]) or True)
+        self.assertEqual(sent, [])
+        OutboxMessage.objects.update(created_at=timezone.now() - timedelta(seconds=outbox.OUTBOX_LEASE + 1))
+        self.assertEqual(outbox.deliver_due(lambda r, m: sent.append(m["text"]) or True), 0)
+        self.assertEqual(sent, ["a"])
+
+
+# --- Stream Parser ---
+
+class JSONArrayStreamParserTests(SimpleTestCase):
+
+    def parse(self, *chunks) -> list:
+        parser = JSONArrayStreamParser()
+        elements = []
+        for chunk in chunks:
+            elements += parser.feed(chunk)
+        parser.close()
+        return elements
+
+    def test_elements_are_returned_as_they_complete(self):
+        parser = JSONArrayStreamParser()
+        self.assertEqual(parser.feed('[{"text": "a"}, {"te'), [{"text": "a"}])
+        self.assertEqual(parser.feed('xt": "b"}]'), [{"text": "b"}])
+        parser.close()
+
+    def test_split_at_every_character(self):
+        text = '[{"text": "hi"}, {"attachment": {"type": "image", "payload": {"url": "u"}}}]'
+        self.assertEqual(self.parse(*text), [
+            {"text": "hi"}, {"attachment": {"type": "image", "payload": {"url": "u"}}},
+        ])
+
+    def test_escapes_and_brackets_inside_strings(self):
+        text = r'[{"text": "a \"quoted\" [x], {y} \\"}, {"text": "b"}]'
+        self.assertEqual(self.parse(text[:14], text[14:15], text[15:]), [
+            {"text": 'a "quoted" [x], {y} \\'}, {"text": "b"},
+        ])
+
+    def test_escape_split_across_chunks(self):
+        self.assertEqual(self.parse('[{"text": "a\\', '"b"}]'), [{"text": 'a"b'}])
+
+    def test_nested_arrays_and_objects(self):
+        self.assertEqual(self.parse('[{"a": [1, [2, {"b": 3}]]}, [4, 5]]'), [{"a": [1, [2, {"b": 3}]]}, [4, 5]])
+
+    def test_empty_array_and_surrounding_whitespace(self):
+        self.assertEqual(self.parse('  [ ]  \n'), [])
+
+    def test_trailing_comma_is_rejected(self):
+        parser = JSONArrayStreamParser()
+        with self.assertRaises(ValueError):
+            parser.feed('[{"text": "a"}, ]')
+
+    def test_unclosed_array_is_rejected_on_close(self):
+        parser = JSONArrayStreamParser()
+        self.assertEqual(parser.feed('[{"text": "a"}, {"text": "b"'), [{"text": "a"}])
+        with self.assertRaises(ValueError):
+            parser.close()
+
+    def test_non_array_and_trailing_data_are_rejected(self):
+        with self.assertRaises(ValueError):
+            JSONArrayStreamParser().feed('{"text": "a"}')
+        with self.assertRaises(ValueError):
+            JSONArrayStreamParser().feed('[] x')
+
+
+# --- Webhook ---
+
+class WebhookTests(TestCase):
+    """The real request path, from webhook_view to the Send API, with Gemini and Facebook mocked."""
+
+    def setUp(self):
+        patchers = [
+            mock.patch.object(views, "APP_SECRET", "secret"),
+            mock.patch.object(views, "GEMINI_API_KEY", "key"),
+            mock.patch.object(views, "queue_enabled", return_value=False),
+            mock.patch.object(views, "get_client"),
+            mock.patch.object(views, "send_api_request", return_value=True),
+            mock.patch.object(outbox, "delivery_worker"),
+        ]
+        mocks = []
+        for patcher in patchers:
+            mocks.append(patcher.start())
+            self.addCleanup(patcher.stop)
+        self.gemini, self.send = mocks[3].return_value.models, mocks[4]
+        self.gemini.generate_content.return_value = gemini_response('[{"text": "Hello!"}, {"text": "How can I help?"}]')
+
+    def post(self, *events):
+        body = json.dumps({"object": "page", "entry": [{"messaging": list(events)}]}).encode()
+        signature = hmac.new(b"secret", body, hashlib.sha256).hexdigest()
+        return self.client.post(
+            "/webhook/", body, content_type="application/json", HTTP_X_HUB_SIGNATURE_256=f"sha256={signature}",
+        )
+
+    def message(self, sender_id: str, mid: str, text: str, timestamp: int = 1) -> dict:
+        return {"sender": {"id": sender_id}, "timestamp": timestamp, "message": {"mid": mid, "text": text}}
+
+    def sent_messages(self) -> list:
+        return [call.args[0]["message"] for call in self.send.call_args_list if "message" in call.args[0]]
+
+    def test_message_is_answered_saved_and_delivered(self):
+        receipt = {"sender": {"id": "web-1"}, "read": {"watermark": 1}}
+        response = self.post(self.message("web-1", "web-mid-1", "Hi there"), receipt)
+
+        self.assertEqual(response.status_code, 200)
+        self.gemini.generate_content.assert_called_once()
+        self.assertEqual(self.sent_messages(), [{"text": "Hello!"}, {"text": "How can I help?"}])
+        actions = [call.args[0].get("sender_action") for call in self.send.call_args_list]
+        self.assertEqual([a for a in actions if a], ["mark_seen", "typing_on", "typing_off"])
+        conversation = Conversation.objects.get(sender_id="web-1")
+        self.assertEqual(conversation.get_messages(), [
+            {"role": "user", "content": "Hi there"},
+            {"role": "assistant", "content": "Hello!"},
+            {"role": "assistant", "content": "How can I help?"},
+        ])
+        self.assertEqual(list(conversation.outbox.values_list("status", flat=True)), ["sent", "sent"])
+
+    def test_redelivered_message_is_answered_once(self):
+        self.post(self.message("web-2", "web-mid-2", "Hi"))
+        self.post(self.message("web-2", "web-mid-2", "Hi"))
+        self.gemini.generate_content.assert_called_once()
+        self.assertEqual(Conversation.objects.get(sender_id="web-2").message_count, 3)
+
+    def test_events_of_one_sender_get_one_reply(self):
+        self.post(self.message("web-3", "web-mid-3b", "second", 2), self.message("web-3", "web-mid-3a", "first", 1))
+        self.gemini.generate_content.assert_called_once()
+        self.assertEqual(
+            [m["content"] for m in Conversation.objects.get(sender_id="web-3").get_messages()][:2], ["first", "second"],
+        )
+
+    def test_streamed_reply_is_sent_part_by_part(self):
+        self.gemini.generate_content_stream.return_value = iter([
+            mock.Mock(text='[{"text": "Hel', usage_metadata=None),
+            mock.Mock(text='lo!"}, {"text": "Bye"}]', usage_metadata=None),
+        ])
+        with mock.patch.object(views.config_cache, "get_bool", lambda name, default=False: name == "stream_replies"):
+            self.post(self.message("web-4", "web-mid-4", "Hi"))
+        self.gemini.generate_content.assert_not_called()
+        self.assertEqual(self.sent_messages(), [{"text": "Hello!"}, {"text": "Bye"}])
+        self.assertEqual(OutboxMessage.objects.filter(conversation__sender_id="web-4", status="sent").count(), 2)
+
+    def test_failed_send_is_left_to_the_outbox(self):
+        self.send.return_value = False
+        self.post(self.message("web-5", "web-mid-5", "Hi"))
+        # The first part failed, so the second was not tried and both wait for a retry
+        self.assertEqual(self.sent_messages(), [{"text": "Hello!"}])
+        self.assertEqual(
+            list(OutboxMessage.objects.filter(conversation__sender_id="web-5").values_list("status", "attempts")),
+            [("pending", 1), ("pending", 0)],
+        )
+        outbox.delivery_worker.wake.assert_called_once()
+
+    def test_throttled_sender_is_saved_without_any_gemini_call(self):
+        attachment = {"sender": {"id": "web-6"}, "timestamp": 1, "message": {
+            "mid": "web-mid-6", "attachments": [{"type": "image", "payload": {"url": "https://cdn/a.jpg"}}],
+        }}
+        with mock.patch.object(views.sender_limiter, "allow", return_value=False), \
+                mock.patch.object(media, "process_media") as process_media:
+            self.post(attachment)
+        process_media.assert_not_called()
+        self.gemini.generate_content.assert_not_called()
+        self.assertEqual(self.sent_messages(), admission.overload_reply())
+        self.assertEqual(Conversation.objects.get(sender_id="web-6").get_messages()[0], {
+            "role": "user", "content": '>user sent an "image" not described',
+        })
+
+    def test_invalid_signature_is_rejected(self):
+        response = self.client.post(
+            "/webhook/", b"{}", content_type="application/json", HTTP_X_HUB_SIGNATURE_256="sha256=bad",
+        )
+        self.assertEqual(response.status_code, 403)
+        self.gemini.generate_content.assert_not_called()
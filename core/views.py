@@ -4,21 +4,39 @@ import os
 import hmac
 import hashlib
 import requests
-import mimetypes
+import time
+from contextlib import closing
 
 from django.http import HttpResponse, JsonResponse, HttpResponseForbidden
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
-from google import genai
 from google.genai import types
 
-from .models import Conversation, APIKey, Config
-from .sys_prompt import get_prompt
+from .models import Conversation, APIKey
+from .sys_prompt import get_prompt_with_version
+from .admission import gemini_limiter, overload_reply, sender_limiter
+from .answer_cache import answer_cache, cached_reply_key
+from .archive import maybe_schedule_archive
+from .config import config_cache
+from .db import retry_on_lock
+from .contents import to_contents
+from .context import load_history, build_context
+from .context_cache import prompt_context_cache
+from .coalesce import SenderCoalescer
+from .dedup import get_dedup_store
+from .events import REPLY_TYPES, classify_event, split_events
+from . import log, metrics, outbox
+from .media import attachment_placeholders, describe_attachments
+from .hedge import get_hedge_delay, hedged_reply, hedge_stats
+from .router import router
+from .stream import JSONArrayStreamParser
+from .clients import get_client, mask_key
+from .session import get_session, pool_gauges, SEND_API_TIMEOUT
+from .worker import queue_enabled, get_task_queue
 
 # --- Setup and Configuration ---
-logging.basicConfig(level=logging.DEBUG,
-                    filename='mbot.log',)
+# Handlers are configured by settings.LOGGING
 logger = logging.getLogger(__name__)
 
 # --- Environment Variables ---
@@ -32,36 +50,33 @@ SEND_API_URL = "https://graph.facebook.com/v23.0/me/messages"
 
 # --- Database & History Management ---
 
+@retry_on_lock
 def get_or_create_conversation(sender_id: str):
     """Retrieves or creates a conversation record for a given sender ID."""
-    try:
-        return Conversation.objects.get(sender_id=sender_id)
-    except Conversation.DoesNotExist:
-        return Conversation.objects.create(sender_id=sender_id)
-
-def add_user_message_to_history(history: list, msg: dict) -> list | None:
+    conversation, _ = Conversation.objects.get_or_create(sender_id=sender_id)
+    return conversation
+
+def save_reply(conversation: Conversation, messages: list, parts: list):
+    """Appends the new turns to the stored history and queues the reply parts for delivery."""
+    with metrics.span("history_save"):
+        outbox.save_reply(conversation, messages, parts)
+    # Also picks up parts a previous process left undelivered
+    outbox.delivery_worker.start()
+    maybe_schedule_archive(conversation)
+
+def add_user_message_to_history(history: list, msg: dict, describe: bool = True) -> list | None:
     """
     Parses a user's message, adds it to the history, and returns the updated history.
-    Returns None if the message is not processable.
+    Returns None if the message is not processable. With describe=False attachments
+    get a placeholder instead of a (paid) Gemini description.
     """
     if msg.get("text"):
         user_text = msg["text"]
+    elif msg.get("attachments") and not describe:
+        user_text = "\n".join(attachment_placeholders(msg["attachments"]))
     elif msg.get("attachments"):
-        attachment = msg["attachments"][0] # Process the first attachment
-        attachment_type = attachment.get("type")
-        payload = attachment.get("payload", {})
-        
-        if payload.get("sticker_id") == 369239263222822: # Thumbs-up sticker
-            user_text = ">thumbsup sticker"
-        else:
-            try:
-                url = payload["url"]
-                attachment_content = process_media(str(url))
-                user_text = f'>user sent an "{attachment_type}" which may have: {attachment_content}'
-            except KeyError:
-                # Fallback for unexpected format from user
-                logger.error("Unexpected attachment format from user")
-                user_text = f'>user sent an "{attachment_type}" can\'t be seen'
+        # Every attachment is described, all at the same time
+        user_text = "\n".join(describe_attachments(msg["attachments"]))
     else:
         return None
     
@@ -69,7 +84,16 @@ def add_user_message_to_history(history: list, msg: dict) -> list | None:
         user_text = f'>user replied to a previous message'
 
     history.append({"role": "user", "content": user_text})
-    logger.info(f"User: {history[-1]['content']}")
+    logger.info(f"User: {history[-1]['content']}", extra={"content": True})
+    return history
+
+def add_postback_to_history(history: list, postback: dict) -> list:
+    """Adds a postback button click to the history as user input."""
+    payload = postback.get("payload", "")
+    title = postback.get("title", payload)
+    user_text = f'user clicked: "{title}"' # Treat button click as user input
+    history.append({"role": "user", "content": user_text})
+    logger.info(f"User Postback: {user_text}", extra={"content": True})
     return history
 
 def add_model_message_to_history(history: list, model_responses: list) -> list:
@@ -90,7 +114,7 @@ def add_model_message_to_history(history: list, model_responses: list) -> list:
             content = json.dumps(res_part)
 
         history.append({"role": "assistant", "content": content})
-        logger.info(f"Model: {history[-1]['content']}")
+        logger.info(f"Model: {history[-1]['content']}", extra={"content": True})
     return history
 
 
@@ -100,7 +124,7 @@ def send_api_request(payload: dict) -> bool:
     """Generic function to send a POST request to the Messenger Send API."""
     params = {"access_token": PAGE_TOKEN}
     try:
-        r = requests.post(SEND_API_URL, params=params, json=payload, timeout=10)
+        r = get_session().post(SEND_API_URL, params=params, json=payload, timeout=SEND_API_TIMEOUT)
         r.raise_for_status()
         response_data = r.json()
         if "error" in response_data:
@@ -114,16 +138,19 @@ def send_api_request(payload: dict) -> bool:
 def send_message(recipient_id: str, message: dict):
     """Sends a message object (text, attachment, quick replies) via Facebook."""
     payload = {"recipient": {"id": recipient_id}, "message": message, "messaging_type": "RESPONSE"}
-    return send_api_request(payload)
+    with metrics.span("send_message"):
+        return send_api_request(payload)
 
 def send_action(recipient_id: str, action: str):
     """Sends sender actions like 'typing_on' or 'mark_seen'."""
     payload = {"recipient": {"id": recipient_id}, "sender_action": action}
-    return send_api_request(payload)
+    with metrics.span("send_action"):
+        return send_api_request(payload)
 
 
 # --- Security ---
 
+@metrics.span("verify_signature")
 def verify_signature(request) -> bool:
     """Verifies the Facebook webhook signature for security."""
     if not APP_SECRET:
@@ -152,191 +179,335 @@ def get_thinking_budget(history: list, model: str) -> int:
             return 0
         return -1  # let the model decide
 
-    config = Config.objects.filter(name="thinking_budget").first()
-
-    if not config:    
-        logger.warning("thinking_budget config not found. Using default value.")
+    budget = config_cache.get_int("thinking_budget")
+    if budget is None:
         return -1
 
-    try:
-        budget = int(config.value)
-    except (ValueError, TypeError):
-        logger.warning("Invalid value for thinking_budget config. Using default value.")
-        return -1 
-
     if budget < 0:
         return -1
     return max(128, min(budget, 4096))
     
 def get_config(name, default):
-    config = Config.objects.filter(name=name).first()
-    if not config:
-        logger.warning(f"{name} config not found. Using default value.")
-        return default
-    try:
-        return config.value.strip() if config.value is not None else default
-    except (ValueError, TypeError):
-        logger.warning(f"Invalid value for {name} config. Using default value.")
-        return default
+    """Returns the string value of a Config row, served from the in-process cache."""
+    return config_cache.get(name, default)
    
 
-def process_media(media_url: str, prompt: str = "Describe this media content in less.") -> str:
-
-    resp = requests.get(media_url, timeout=15)
-    resp.raise_for_status()
+def build_generate_config(history: list, model: str, api_key: str | None = None) -> types.GenerateContentConfig:
+    """Builds the Gemini request config for a reply to the given history."""
+    with metrics.span("get_prompt"):
+        prompt, version = get_prompt_with_version()
+    prompt_config = {"system_instruction": prompt}
+    if prompt_context_cache.enabled():
+        cached_content = prompt_context_cache.get_cached_content(api_key, model, prompt, version)
+        if cached_content:
+            prompt_config = {"cached_content": cached_content}
+
+    return types.GenerateContentConfig(
+        temperature=config_cache.get_float('temperature', 1.0),
+        response_mime_type="application/json",
+        thinking_config=types.ThinkingConfig(thinking_budget=get_thinking_budget(history, model),),
+        **prompt_config,
+    )
 
-    # Create Gemini client
-    client = genai.Client()
-    
-    media = client.files.upload(resp)
+def parse_reply(text: str) -> list:
+    """Parses the model's JSON reply. Returns [] if it is not a JSON array."""
+    try:
+        parsed_response = json.loads(text)
+    except json.JSONDecodeError as e:
+        logger.error(f"JSON decode error: {e}")
+        metrics.json_decode_failures.inc()
+        return []
 
-    # Send request
-    response = client.models.generate_content(
-        model="gemini-2.5-flash",
-        contents=[media, prompt],
-    )
+    # Validate response format
+    if not isinstance(parsed_response, list):
+        logger.error(f"Invalid response format: {type(parsed_response)}")
+        return []
 
-    return response.text.strip()
+    return parsed_response
 
 def process_reply(history: list, model: str, api_key: str) -> list:
     """Generate AI response using Gemini API"""
+    start = time.monotonic()
+    router.begin(api_key, model)
     try:
-        client = genai.Client(api_key=api_key)
+        client = get_client(api_key)
         
         # Convert history to proper format for Gemini
 
         response = client.models.generate_content(
             model=model,
-            contents=str(history),
-            config=types.GenerateContentConfig(
-                temperature=float(get_config('temperature', 1.0)),
-                system_instruction=get_prompt(),
-                response_mime_type="application/json",
-                thinking_config=types.ThinkingConfig(thinking_budget=get_thinking_budget(history, model),),
-            ),
+            contents=to_contents(history),
+            config=build_generate_config(history, model, api_key),
         )
+        metrics.record_usage(model, response.usage_metadata)
         
-        # Parse the JSON response
-        parsed_response = json.loads(response.text)
-        
-        # Validate response format
-        if not isinstance(parsed_response, list):
-            logger.error(f"Invalid response format: {type(parsed_response)}")
-            return []
-            
-        return parsed_response
+        reply = parse_reply(response.text)
         
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON decode error: {e}")
-        return []
     except Exception as e:
-        logger.error(f"AI generation error: {e}")
+        logger.error(f"AI generation error from {model} using {mask_key(api_key)}: {e}")
+        router.record_failure(api_key, model, e)
+        record_attempt(model, api_key, start, "error")
         return []
+
+    if reply:
+        router.record_success(api_key, model, time.monotonic() - start)
+    else:
+        router.record_failure(api_key, model)
+    record_attempt(model, api_key, start, "success" if reply else "invalid")
+    return reply
     
-def ai_reply(history: list) -> list:
-    
-    MODELS = ["gemini-2.5-pro", "gemini-2.5-flash"]
+def record_attempt(model: str, api_key: str, start: float, outcome: str):
+    """Observes one Gemini attempt in mbot_gemini_request_seconds."""
+    metrics.gemini_request_seconds.observe(
+        time.monotonic() - start, model=model, key=mask_key(api_key), outcome=outcome,
+    )
 
-    API_KEYS = [key.get_api_key() for key in APIKey.objects.all()]
-    # Try with Gemini API key first
-    if GEMINI_API_KEY:
-        for model in MODELS:
-            try:
-                response = process_reply(history, model, GEMINI_API_KEY)
-                if response:
-                    return response
-            except Exception as e:
-                logger.error(f"Failed to get response from {model} using GEMINI_API_KEY(.env)")
-
-    # Fallback: try with other API keys
-    for model in MODELS:
-        for key in API_KEYS:
-            try:
-                response = process_reply(history, model, key)
-                if response:
-                    return response
-            except Exception as e:
-                logger.error(f"Failed to get response from {model} using {key[:4]}...{key[-4:]}")
+def get_api_keys() -> list:
+    """The .env key first, then every APIKey row."""
+    keys = [GEMINI_API_KEY] if GEMINI_API_KEY else []
+    return keys + [key.get_api_key() for key in APIKey.objects.all()]
+
+def ai_reply(history: list) -> list:
+    """Tries (key, model) pairs in the router's order until one gives a valid reply."""
+    candidates = router.candidates(get_api_keys())
+    delay = get_hedge_delay(candidates)
+    if delay is not None:
+        return hedged_reply(history, candidates, process_reply, delay)
+
+    for attempt, (key, model) in enumerate(candidates):
+        if attempt:
+            metrics.gemini_fallbacks.inc()
+        response = process_reply(history, model, key)
+        if response:
+            return response
+        logger.error(f"Failed to get response from {model} using {mask_key(key)}")
 
     logger.error("[FAIL] No valid response from any model/key")
     return []
 
+def process_reply_stream(history: list, model: str, api_key: str):
+    """Streams the reply from Gemini, yielding each message object as soon as it is complete."""
+    start = time.monotonic()
+    router.begin(api_key, model)
+    parts = 0
+    usage_metadata = None
+    try:
+        client = get_client(api_key)
+        parser = JSONArrayStreamParser()
+        for chunk in client.models.generate_content_stream(
+            model=model,
+            contents=to_contents(history),
+            config=build_generate_config(history, model, api_key),
+        ):
+            # Every chunk reports the usage so far, the last one has the totals
+            usage_metadata = chunk.usage_metadata or usage_metadata
+            for res_part in parser.feed(chunk.text or ""):
+                parts += 1
+                yield res_part
+        parser.close()
+
+    except GeneratorExit:
+        # The caller stopped reading, e.g. after a failed send
+        router.record_cancelled(api_key, model)
+        record_attempt(model, api_key, start, "cancelled")
+        raise
+    except Exception as e:
+        logger.error(f"AI streaming error from {model} using {mask_key(api_key)}: {e}")
+        if isinstance(e, ValueError):
+            # Raised by the parser, json.JSONDecodeError included
+            metrics.json_decode_failures.inc()
+        router.record_failure(api_key, model, e)
+        record_attempt(model, api_key, start, "error")
+        return
+    finally:
+        metrics.record_usage(model, usage_metadata)
+
+    if parts:
+        router.record_success(api_key, model, time.monotonic() - start)
+    else:
+        router.record_failure(api_key, model)
+    record_attempt(model, api_key, start, "success" if parts else "invalid")
+
+def stream_ai_reply(history: list):
+    """
+    Streaming version of ai_reply. Falls back to the next (key, model) pair only
+    while nothing has been yielded; once parts were sent, a failure ends the reply.
+    """
+    for attempt, (key, model) in enumerate(router.candidates(get_api_keys())):
+        if attempt:
+            metrics.gemini_fallbacks.inc()
+        parts = 0
+        for res_part in process_reply_stream(history, model, key):
+            parts += 1
+            yield res_part
+        if parts:
+            return
+        logger.error(f"Failed to get response from {model} using {mask_key(key)}")
+
+    logger.error("[FAIL] No valid response from any model/key")
+
 # --- Main Webhook Logic ---
 
-PROCESSED_MIDS = set()
+coalescer = SenderCoalescer()
 
-def process_event(event: dict):
-    sender_id = event.get("sender", {}).get("id")
-    if not sender_id:
-        return False
+def process_events(sender_id: str, events: list):
+    """Filters out events without user input and duplicates, then queues the sender's events for a reply."""
+    accepted = []
+    for event in events:
+        event_type = classify_event(event)
+        if event_type not in REPLY_TYPES:
+            logger.info(f"Ignoring {event_type} event.")
+            continue
 
-    msg = event.get("message", {})
-    if msg.get("is_echo"):
-        logger.info("Ignoring echo message.")
-        return False
+        mid = event["message"].get("mid") if event_type == "message" else None
+        if mid and get_dedup_store().is_duplicate(mid):
+            logger.info(f"Ignoring duplicate mid {mid}")
+            metrics.dedup_hits.inc()
+            continue
+
+        accepted.append(event)
 
-    mid = msg.get("mid")
-    if mid and mid in PROCESSED_MIDS:
-        logger.info(f"Ignoring duplicate mid {mid}")
+    if not accepted:
         return False
-    if mid:
-        PROCESSED_MIDS.add(mid)
 
-    conversation = get_or_create_conversation(sender_id)
-    history = json.loads(conversation.get_history() or "[]")
+    # Rapid-fire messages from one sender are answered with a single reply,
+    # and a sender's batches never run concurrently
+    window = config_cache.get_float('coalesce_window', 0.0)
+    result = coalescer.submit(sender_id, accepted, window, process_batch)
+    return True if result is None else result
+
+def process_batch(sender_id: str, events: list):
+    """Adds every event's user input to the history and answers them with one reply."""
+    # A sender over their rate still has their input saved, but gets no Gemini call,
+    # not even to describe their attachments
+    throttled = not sender_limiter.allow(sender_id)
+
+    with metrics.span("conversation_load"):
+        conversation = get_or_create_conversation(sender_id)
+        history, first_seq = load_history(conversation)
+    stored_count = len(history)
     
     user_input_received = False
     
     send_action(sender_id, "mark_seen")
     
-    # Case 1: User sent a standard message (text, attachment)
-    if "message" in event:
-        updated_history = add_user_message_to_history(history, event["message"])
-        if updated_history:
-            history = updated_history
+    # Workers may add events to a batch out of order, Facebook's timestamp is authoritative
+    for event in sorted(events, key=lambda e: e.get("timestamp", 0)):
+        # Case 1: User sent a standard message (text, attachment)
+        if "message" in event:
+            updated_history = add_user_message_to_history(history, event["message"], describe=not throttled)
+            if updated_history:
+                history = updated_history
+                user_input_received = True
+
+        # Case 2: User clicked a postback button (from quick replies, etc.)
+        elif "postback" in event:
+            history = add_postback_to_history(history, event["postback"])
             user_input_received = True
 
-    # Case 2: User clicked a postback button (from quick replies, etc.)
-    elif "postback" in event:
-        payload = event["postback"].get("payload", "")
-        title = event["postback"].get("title", payload)
-        user_text = f'user clicked: "{title}"' # Treat button click as user input
-        history.append({"role": "user", "content": user_text})
-        logger.info(f"User Postback: {user_text}")
-        user_input_received = True
-
     if not user_input_received:
         # Ignore events without user input (e.g., delivery receipts, read receipts)
         return False
 
+    if len(events) > 1:
+        logger.info(f"Coalesced {len(events)} events from {sender_id} into one reply")
+
     # --- Generate and Send AI Response ---
     send_action(sender_id, "typing_on")
 
-    remember_count = int(get_config('remember', 20))
-    model_responses = ai_reply(history[-remember_count:])
+    context = build_context(conversation, history, first_seq, stored_count)
+
+    # Repeated questions are answered from the cache without calling Gemini
+    cache_key = cached_reply_key(context)
+    model_responses = answer_cache.get(cache_key) if cache_key else None
+    if model_responses is None and throttled:
+        logger.warning(f"Throttled {sender_id}, sending the overload message")
+        model_responses = overload_reply()
+    if model_responses is None:
+        # Past the in-flight cap and its wait queue the sender gets a canned reply instead
+        if not gemini_limiter.acquire():
+            logger.warning(f"Overloaded, sending {sender_id} the overload message")
+            model_responses = overload_reply()
+        else:
+            try:
+                if config_cache.get_bool('stream_replies', False):
+                    send_streamed_reply(sender_id, conversation, history, stored_count, context)
+                    return True
+
+                model_responses = ai_reply(context)
+            finally:
+                gemini_limiter.release()
+            if cache_key:
+                answer_cache.put(cache_key, model_responses)
     
     send_action(sender_id, "typing_off")
 
-    # Send all parts of the AI's response
-    #success = all(send_message(sender_id, res_part) for res_part in model_responses)
-    success = []
-    for res_part in model_responses:
-        if not send_message(sender_id, res_part):
-            logger.error(f"Failed to send message to {sender_id}")
-            success.append(False)
-        else:
-            success.append(True)
-
-    if all(success):
-        final_history = add_model_message_to_history(history, model_responses)
-        conversation.history = json.dumps(final_history)
-        conversation.save()
-    else:
-        failed_count = success.count(False)
-        logger.error(f"Failed to send {failed_count} messages to {sender_id}")
+    # The reply is saved before it is sent, so a part the Send API rejects is
+    # retried by the outbox instead of costing another Gemini call
+    final_history = add_model_message_to_history(history, model_responses)
+    # Append-only: just the new user and model turns are written
+    save_reply(conversation, final_history[stored_count:], model_responses)
+    if not outbox.deliver(conversation, send_message):
+        logger.error(f"Failed to send the reply to {sender_id}, retrying in the background")
 
     return True
 
+def send_streamed_reply(sender_id: str, conversation, history: list, stored_count: int, context: list):
+    """Saves and sends each reply part as soon as it is generated."""
+    # The new user turns are saved together with the first part
+    unsaved = history[stored_count:]
+    delivered = True
+    with closing(stream_ai_reply(context)) as replies:
+        for res_part in replies:
+            save_reply(conversation, unsaved + add_model_message_to_history([], [res_part]), [res_part])
+            unsaved = []
+            # After a failure the rest is only queued, it goes out behind the failed part
+            if delivered and not outbox.deliver(conversation, send_message):
+                logger.error(f"Failed to send the reply to {sender_id}, retrying in the background")
+                delivered = False
+
+    if unsaved:
+        # No part was generated, keep the user's message like an empty reply would
+        save_reply(conversation, unsaved, [])
+
+    send_action(sender_id, "typing_off")
+
+
+def handle_events(events: list):
+    """Processes one sender's events, logging instead of raising on failure."""
+    sender_id = events[0].get("sender", {}).get("id")
+    if not sender_id:
+        return
+    with log.correlation(event_correlation_id(events)):
+        try:
+            process_events(sender_id, events)
+        except Exception as e:
+            # Catch errors in single sender processing to not fail the whole batch
+            logger.error(f"Error processing {describe_events(events)}. Exception: {e}", exc_info=True)
+
+def event_correlation_id(events: list) -> str | None:
+    """The first message ID of a sender's events, to follow them through the logs."""
+    for event in events:
+        mid = event.get("message", {}).get("mid")
+        if mid:
+            return mid
+    return None
+
+def describe_events(events: list) -> str:
+    """Names a sender's events for error logs without logging the message contents."""
+    sender_id = events[0].get("sender", {}).get("id")
+    mids = ", ".join(event.get("message", {}).get("mid") or "no mid" for event in events)
+    return f"{len(events)} event(s) from {sender_id} ({mids})"
+
+def dispatch_events(events: list):
+    """Hands one sender's events to the background workers, or processes them inline."""
+    if queue_enabled():
+        if get_task_queue().submit(handle_events, events):
+            return
+        # Queue is at its depth limit: apply backpressure instead of dropping the events
+        logger.warning("Event queue is full. Processing events inline.")
+    handle_events(events)
+
 
 @require_http_methods(["GET", "POST"])
 @csrf_exempt
@@ -363,13 +534,29 @@ def webhook_view(request):
         logger.error("Invalid JSON received in webhook request body.")
         return HttpResponse("Invalid JSON", status=400)
 
-    for entry in data.get("entry", []):
-        for event in entry.get("messaging", []):
-            try:
-                process_event(event)
-            except Exception as e:
-                # Catch errors in single event processing to not fail the whole batch
-                logger.error(f"Error processing event: {event}. Exception: {e}", exc_info=True)
-                
-        
-    return JsonResponse({"status": "ok"})
\ No newline at end of file
+    # Receipts, echoes and other events without user input are dropped here, before any I/O
+    for events in split_events(data).values():
+        dispatch_events(events)
+
+    return JsonResponse({"status": "ok"})
+
+
+@require_http_methods(["GET"])
+def metrics_view(request):
+    """Prometheus scrape endpoint for this process's metrics."""
+    if metrics.METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {metrics.METRICS_TOKEN}"
+    ):
+        return HttpResponseForbidden("Invalid token")
+
+    stats = {
+        "mbot_dedup_store": get_dedup_store().stats(),
+        "mbot_hedge": hedge_stats.stats(),
+        "mbot_gemini_cache": metrics.cache_stats(),
+        "mbot_answer_cache": answer_cache.stats(),
+        "mbot_gemini_limiter": gemini_limiter.stats(),
+        "mbot_send_pool": pool_gauges(),
+    }
+    if queue_enabled():
+        stats["mbot_task_queue"] = get_task_queue().stats()
+    return HttpResponse(metrics.registry.render(stats), content_type=metrics.CONTENT_TYPE)
\ No newline at end of file
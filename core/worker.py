@@ -0,0 +1,97 @@
+import logging
+import os
+import queue
+import threading
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+# --- Environment Variables ---
+# "inline" processes events inside the webhook request, "queue" hands them to
+# the background worker pool and acknowledges Facebook immediately.
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "inline")
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "4"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+
+
+class TaskQueue:
+    """A bounded queue drained by a pool of daemon worker threads."""
+
+    def __init__(self, workers: int, maxsize: int, name: str = "mbot-worker"):
+        self.workers = max(1, workers)
+        self.name = name
+        self._queue = queue.Queue(maxsize=max(0, maxsize))
+        self._threads = []
+        self._lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.rejected = 0
+
+    def start(self):
+        """Starts the worker threads. Safe to call more than once."""
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._run, name=f"{self.name}-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+            logger.info(f"Started {self.workers} workers (queue limit {self._queue.maxsize})")
+
+    def submit(self, func, *args) -> bool:
+        """Enqueues func(*args). Returns False if the queue is full."""
+        self.start()
+        try:
+            self._queue.put_nowait((func, args))
+            return True
+        except queue.Full:
+            self.rejected += 1
+            return False
+
+    def join(self):
+        """Blocks until every queued task has been processed."""
+        self._queue.join()
+
+    def stats(self) -> dict:
+        return {
+            "workers": len(self._threads),
+            "depth": self._queue.qsize(),
+            "maxsize": self._queue.maxsize,
+            "processed": self.processed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+        }
+
+    def _run(self):
+        while True:
+            func, args = self._queue.get()
+            # Worker threads outlive requests, so manage DB connections like a request would
+            close_old_connections()
+            try:
+                func(*args)
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Background task {getattr(func, '__name__', func)} failed: {e}", exc_info=True)
+            finally:
+                close_old_connections()
+                self._queue.task_done()
+
+
+_task_queue = None
+_task_queue_lock = threading.Lock()
+
+
+def queue_enabled() -> bool:
+    return WEBHOOK_MODE == "queue"
+
+
+def get_task_queue() -> TaskQueue:
+    """Returns the process-wide task queue, created on first use (after any fork)."""
+    global _task_queue
+    if _task_queue is None:
+        with _task_queue_lock:
+            if _task_queue is None:
+                _task_queue = TaskQueue(WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+    return _task_queue
@@ -14,3 +14,9 @@ from django.core.asgi import get_asgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mbot.settings')
 
 application = get_asgi_application()
+
+# Build Gemini clients for every API key before the first message arrives.
+# Under gunicorn --preload this runs before fork; use a post_fork hook there instead.
+if os.getenv('GEMINI_PREWARM'):
+    from core.clients import prewarm_clients
+    prewarm_clients()
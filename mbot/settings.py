@@ -60,10 +60,35 @@ WSGI_APPLICATION = 'mbot.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# DB_PROFILE=concurrent tunes SQLite for several workers writing at once:
+# WAL lets readers run alongside the writer, IMMEDIATE transactions take the
+# write lock up front (a deferred one can fail to upgrade its lock instead of
+# waiting), timeout is how long to wait for the lock, and connections are reused.
+DB_PROFILES = {
+    'default': {},
+    'concurrent': {
+        'CONN_MAX_AGE': int(os.environ.get('DB_CONN_MAX_AGE', '600')),
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': (
+                'PRAGMA journal_mode=WAL;'
+                'PRAGMA synchronous=NORMAL;'
+                'PRAGMA cache_size=-20000;'
+                'PRAGMA temp_store=MEMORY;'
+                'PRAGMA mmap_size=134217728;'
+            ),
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': float(os.environ.get('DB_TIMEOUT', '20')),
+        },
+    },
+}
+DB_PROFILE = os.environ.get('DB_PROFILE', 'default')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        **DB_PROFILES[DB_PROFILE],
     }
 }
 
@@ -106,6 +131,29 @@ STATIC_URL = 'static/'
 
 STATIC_ROOT = BASE_DIR / 'static'
 
+# Logging
+# Records are written off the request thread as JSON lines; see core/log.py
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'file': {
+            '()': 'core.log.queue_handler',
+            # One file per process: {pid} is filled in by each worker, which rotates only its own
+            'filename': os.environ.get('LOG_FILE', str(BASE_DIR / 'mbot.{pid}.log')),
+            'max_bytes': int(os.environ.get('LOG_MAX_BYTES', str(10 * 1024 * 1024))),
+            'backup_count': int(os.environ.get('LOG_BACKUP_COUNT', '5')),
+            # Share of events whose message texts are logged at INFO
+            'content_sample_rate': float(os.environ.get('LOG_CONTENT_SAMPLE_RATE', '0.1')),
+        },
+    },
+    'root': {
+        'handlers': ['file'],
+        'level': os.environ.get('LOG_LEVEL', 'INFO'),
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
@@ -1,6 +1,7 @@
 from django.contrib import admin
 from django.urls import path
-from core.views import webhook_view
+from core.views import webhook_view, metrics_view
+from core.async_views import async_webhook_view
 from django.http import HttpResponse
 
 privacy_policy="""
@@ -52,5 +53,7 @@ privacy_policy="""
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("webhook/", webhook_view, name="webhook"),
+    path("webhook/async/", async_webhook_view, name="webhook_async"),
+    path("metrics", metrics_view, name="metrics"),
     path("privacy/", lambda request: HttpResponse(privacy_policy), name="privacy"),
 ]
\ No newline at end of file